@@ -6,3 +6,9 @@ worker_class = 'uvicorn.workers.UvicornWorker'
 loglevel = 'error'
 pidfile = 'gunicorn.pid'
 reload = True
+
+def post_worker_init(worker):
+    # Load the puzzles and templates before the first request needs them, and
+    # again just before the hunt starts; see puzzles/surge.py.
+    from puzzles import surge
+    surge.schedule_warmup()
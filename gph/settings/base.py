@@ -53,6 +53,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'puzzles.metrics.metrics_middleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -251,6 +252,15 @@ LOGGING = {
 # Google Analytics
 GA_CODE = ''
 
+# Fraction of requests whose timing, queries and cache use are recorded for
+# the /metrics page. If METRICS_TOKEN is set, /metrics.json?token=... can be
+# read without logging in, e.g. by an external monitor.
+METRICS_SAMPLE_RATE = 0.1
+METRICS_TOKEN = None
+# Also profile every context property computed in sampled requests (see
+# puzzles/metrics.py). In DEBUG, this adds a Server-Timing header.
+PROFILE_CONTEXT_CACHE = False
+
 LOGIN_REDIRECT_URL = 'index'
 LOGOUT_REDIRECT_URL = 'index'
 
@@ -20,6 +20,9 @@ HUNT_START_TIME = timezone.make_aware(datetime.datetime(
 
 STATIC_ROOT = 'static'
 
+METRICS_SAMPLE_RATE = 1
+PROFILE_CONTEXT_CACHE = True
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
@@ -68,6 +68,7 @@ urlpatterns = [
 
     path('teams', views.teams, name='teams'),
     path('team/<quotedstr:team_name>', views.team, name='team'),
+    path('team/<quotedstr:team_name>/rank', views.team_rank, name='team-rank'),
     path('teams/unhidden', views.teams_unhidden, name='teams-unhidden'),
     path('edit-team', views.edit_team, name='edit-team'),
 
@@ -101,6 +102,9 @@ urlpatterns = [
     path('bigboard', views.bigboard, name='bigboard'),
     path('bigboard/unhidden', views.bigboard_unhidden, name='bigboard-unhidden'),
     path('biggraph', views.biggraph, name='biggraph'),
+    path('wrong-answers', views.wrong_answers, name='wrong-answers'),
+    path('metrics', views.metrics, name='metrics'),
+    path('metrics.json', views.metrics_json, name='metrics-json'),
     path('bridge/guess.csv', views.guess_csv, name='guess-csv'),
     path('bridge/hint.csv', views.hint_csv, name='hint-csv'),
     path('bridge/puzzle.log', views.puzzle_log, name='puzzle-log'),
@@ -14,6 +14,7 @@ from puzzles.models import (
     Erratum,
     Survey,
     Hint,
+    OutboundMessage,
 )
 
 class RoundAdmin(admin.ModelAdmin):
@@ -61,6 +62,17 @@ class TeamAdmin(admin.ModelAdmin):
     search_fields = ('team_name',)
     readonly_fields = ('id',)
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Team.save leaves these out (see Team.DERIVED_FIELDS), so apply the
+        # change as an award, which adds up with any made in the meantime.
+        if change:
+            Team.award(
+                Team.objects.filter(id=obj.id),
+                hints=obj.total_hints_awarded - form.initial['total_hints_awarded'],
+                free_answers=obj.total_free_answers_awarded - form.initial['total_free_answers_awarded'],
+            )
+
 class PuzzleUnlockAdmin(admin.ModelAdmin):
     list_display = ('team', 'puzzle', 'unlock_datetime')
     list_filter = ('puzzle', 'puzzle__round', 'team')
@@ -92,6 +104,11 @@ class HintAdmin(admin.ModelAdmin):
     list_filter = ('status', 'puzzle', 'puzzle__round', 'team', 'claimer')
     search_fields = ('hint_question', 'response')
 
+class OutboundMessageAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'destination', 'created_datetime', 'sent_datetime', 'attempts', 'next_attempt_datetime')
+    list_filter = ('kind',)
+    search_fields = ('payload', 'last_error')
+
 admin.site.register(Round, RoundAdmin)
 admin.site.register(Puzzle, PuzzleAdmin)
 admin.site.register(Team, TeamAdmin)
@@ -102,3 +119,4 @@ admin.site.register(ExtraGuessGrant, ExtraGuessGrantAdmin)
 admin.site.register(Erratum, ErratumAdmin)
 admin.site.register(Survey, SurveyAdmin)
 admin.site.register(Hint, HintAdmin)
+admin.site.register(OutboundMessage, OutboundMessageAdmin)
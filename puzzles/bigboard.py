@@ -0,0 +1,356 @@
+# The bigboard is a teams x puzzles matrix of everyone's progress. Building it
+# means scanning every submission, hint and unlock, so each worker builds it
+# once and then keeps it current by applying the events that the receivers in
+# models.py record as things happen. Events are numbered by a counter in the
+# shared cache, so every worker sees every event. They're all idempotent, so
+# it's harmless to apply one to a board that already reflects it. A worker
+# that can't find an event (e.g. because it expired) just rebuilds.
+#
+# The matrix lives in flat arrays indexed by row * number of puzzles + column,
+# with the state of each cell packed into bit flags, and it's sent to the page
+# as plain lists of numbers for bigboard.html to render.
+import array
+import datetime
+import threading
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from puzzles import models
+from puzzles.catalog import get_catalog
+from puzzles.hunt_config import HUNT_END_TIME
+
+# Cell flags. At most one of the first four is shown, in this order of
+# priority; see bigboard.html.
+FREE = 1
+SOLVED = 2
+WRONG = 4
+UNLOCKED = 8
+HINTED = 16
+POST_HUNT = 32
+BACKSOLVED = 64
+
+SEQUENCE_KEY = 'bigboard-sequence'
+EVENT_KEY = 'bigboard-event:%d'
+EVENT_TIMEOUT = 60 * 60
+# Rebuilding is faster than fetching and applying more events than this.
+MAX_CATCH_UP = 10000
+
+# A solve counts as a backsolve if it's after (or just before) the round's
+# meta was solved.
+BACKSOLVE_WINDOW = datetime.timedelta(minutes=5).total_seconds()
+
+_lock = threading.Lock()
+_boards = {}
+
+
+class Board:
+    def __init__(self, hide_hidden, sequence):
+        self.hide_hidden = hide_hidden
+        self.sequence = sequence
+
+        catalog = get_catalog()
+        self.puzzles = catalog.puzzles
+        self.puzzle_index = {puzzle.id: i for (i, puzzle) in enumerate(self.puzzles)}
+        self.is_meta = [puzzle.is_meta for puzzle in self.puzzles]
+        # For puzzles that aren't metas, the column of their round's meta.
+        self.meta_of = [
+            -1 if puzzle.is_meta else self.puzzle_index.get(puzzle.round.meta_id, -1)
+            for puzzle in self.puzzles
+        ]
+        self.feeders = {}
+        for (i, meta) in enumerate(self.meta_of):
+            if meta >= 0:
+                self.feeders.setdefault(meta, []).append(i)
+        self.meta_meta = self.puzzle_index.get(catalog.meta_meta_id, -1)
+
+        # Per cell
+        self.flags = bytearray()
+        self.positions = array.array('I')  # n if the team was the nth solver
+        self.wrong_guesses = array.array('I')
+        self.hints = array.array('I')
+        self.solve_times = array.array('d')
+
+        # Per row; rows are only added for teams that have done something.
+        self.rows = {}
+        self.team_solves = array.array('I')
+        self.team_free_solves = array.array('I')
+        self.team_wrong_guesses = array.array('I')
+        self.team_hints = array.array('I')
+        self.team_meta_solves = array.array('I')
+        self.team_finished = array.array('I')
+        self.team_last_solve = array.array('d')
+
+        # Per column
+        n = len(self.puzzles)
+        self.puzzle_solves = array.array('I', [0] * n)
+        self.puzzle_free_solves = array.array('I', [0] * n)
+        self.puzzle_guesses = array.array('I', [0] * n)
+        self.puzzle_unlocks = array.array('I', [0] * n)
+        self.puzzle_hints = array.array('I', [0] * n)
+
+        self.load()
+
+    def load(self):
+        visible = {'team__is_hidden': False} if self.hide_hidden else {}
+        for (team_id, puzzle_id, used_free_answer, submitted_datetime) in (
+            models.AnswerSubmission.objects
+            .filter(is_correct=True, **visible)
+            .order_by('submitted_datetime')
+            .values_list('team_id', 'puzzle_id', 'used_free_answer', 'submitted_datetime')
+        ):
+            self.solve(team_id, puzzle_id, used_free_answer, submitted_datetime.timestamp())
+        for (team_id, puzzle_id, count) in (
+            models.AnswerSubmission.objects
+            .filter(is_correct=False, **visible)
+            .values('team_id', 'puzzle_id')
+            .annotate(count=Count('*'))
+            .values_list('team_id', 'puzzle_id', 'count')
+        ):
+            self.set_wrong_guesses(team_id, puzzle_id, count)
+        for (team_id, puzzle_id, count) in (
+            models.Hint.objects
+            .filter(status=models.Hint.ANSWERED, is_followup=False, **visible)
+            .values('team_id', 'puzzle_id')
+            .annotate(count=Count('*'))
+            .values_list('team_id', 'puzzle_id', 'count')
+        ):
+            self.set_hints(team_id, puzzle_id, count)
+        for (team_id, puzzle_id) in (
+            models.PuzzleUnlock.objects
+            # The scheduler inserts time unlocks ahead of time.
+            .filter(unlock_datetime__lte=timezone.now(), **visible)
+            .values_list('team_id', 'puzzle_id')
+        ):
+            self.unlock(team_id, puzzle_id)
+
+    def _cell(self, team_id, puzzle_id):
+        column = self.puzzle_index.get(puzzle_id)
+        if column is None:
+            return None
+        row = self.rows.get(team_id)
+        if row is None:
+            row = self.rows[team_id] = len(self.rows)
+            n = len(self.puzzles)
+            self.flags.extend(bytes(n))
+            for cells in (self.positions, self.wrong_guesses, self.hints, self.solve_times):
+                cells.extend([0] * n)
+            for values in (
+                self.team_solves, self.team_free_solves, self.team_wrong_guesses,
+                self.team_hints, self.team_meta_solves, self.team_finished,
+                self.team_last_solve,
+            ):
+                values.append(0)
+        return (row, column, row * len(self.puzzles) + column)
+
+    def _check_backsolve(self, row, column):
+        meta = self.meta_of[column]
+        if meta < 0:
+            return
+        cell = row * len(self.puzzles) + column
+        meta_cell = row * len(self.puzzles) + meta
+        if (
+            self.flags[cell] & SOLVED and self.flags[meta_cell] & SOLVED and
+            self.solve_times[cell] > self.solve_times[meta_cell] - BACKSOLVE_WINDOW
+        ):
+            self.flags[cell] |= BACKSOLVED
+
+    # The events. These are named after the methods that apply them.
+
+    def solve(self, team_id, puzzle_id, used_free_answer, solve_time):
+        position = self._cell(team_id, puzzle_id)
+        if position is None:
+            return
+        (row, column, cell) = position
+        if self.flags[cell] & (FREE | SOLVED):
+            return
+        self.puzzle_guesses[column] += 1
+        if self.is_meta[column]:
+            self.team_meta_solves[row] += 1
+        if used_free_answer:
+            self.flags[cell] |= FREE
+            self.puzzle_free_solves[column] += 1
+            self.team_free_solves[row] += 1
+            return
+        self.flags[cell] |= SOLVED
+        if solve_time > HUNT_END_TIME.timestamp():
+            self.flags[cell] |= POST_HUNT
+        self.puzzle_solves[column] += 1
+        self.positions[cell] = self.puzzle_solves[column]
+        self.solve_times[cell] = solve_time
+        self.team_solves[row] += 1
+        self.team_last_solve[row] = max(self.team_last_solve[row], solve_time)
+        if column == self.meta_meta:
+            self.team_finished[row] = self.positions[cell]
+        self._check_backsolve(row, column)
+        for feeder in self.feeders.get(column, ()):
+            self._check_backsolve(row, feeder)
+
+    def set_wrong_guesses(self, team_id, puzzle_id, count):
+        position = self._cell(team_id, puzzle_id)
+        if position is None:
+            return
+        (row, column, cell) = position
+        delta = count - self.wrong_guesses[cell]
+        self.wrong_guesses[cell] = count
+        self.puzzle_guesses[column] += delta
+        self.team_wrong_guesses[row] += delta
+        if count:
+            self.flags[cell] |= WRONG
+        else:
+            self.flags[cell] &= ~WRONG
+
+    def set_hints(self, team_id, puzzle_id, count):
+        position = self._cell(team_id, puzzle_id)
+        if position is None:
+            return
+        (row, column, cell) = position
+        delta = count - self.hints[cell]
+        self.hints[cell] = count
+        self.puzzle_hints[column] += delta
+        self.team_hints[row] += delta
+        if count:
+            self.flags[cell] |= HINTED
+        else:
+            self.flags[cell] &= ~HINTED
+
+    def unlock(self, team_id, puzzle_id):
+        position = self._cell(team_id, puzzle_id)
+        if position is None:
+            return
+        (row, column, cell) = position
+        if not self.flags[cell] & UNLOCKED:
+            self.flags[cell] |= UNLOCKED
+            self.puzzle_unlocks[column] += 1
+
+    def catch_up(self, sequence):
+        '''
+        Applies the events up to the given sequence number. Returns False if
+        the board needs to be rebuilt instead.
+        '''
+        if sequence < self.sequence or sequence - self.sequence > MAX_CATCH_UP:
+            return False
+        keys = [EVENT_KEY % i for i in range(self.sequence + 1, sequence + 1)]
+        events = cache.get_many(keys)
+        if len(events) < len(keys):
+            return False
+        for key in keys:
+            (name, hidden, *args) = events[key]
+            if name == 'reset':
+                return False
+            if not (hidden and self.hide_hidden):
+                getattr(self, name)(*args)
+        self.sequence = sequence
+        return True
+
+    def puzzle_totals(self):
+        return [{
+            'puzzle': puzzle,
+            'solves': self.puzzle_solves[i],
+            'free_solves': self.puzzle_free_solves[i],
+            'total_guesses': self.puzzle_guesses[i],
+            'total_unlocks': self.puzzle_unlocks[i],
+            'hints': self.puzzle_hints[i],
+        } for (i, puzzle) in enumerate(self.puzzles)]
+
+    def team_rows(self, teams):
+        '''
+        For each of the given teams, its totals and its cells as a flat list of
+        (flags, solve position, wrong guesses, hints) for each puzzle.
+        '''
+        n = len(self.puzzles)
+        empty = [0] * (4 * n)
+        rows = []
+        for team in teams:
+            row = self.rows.get(team.id)
+            if row is None:
+                rows.append((team, {
+                    'total_solves': 0,
+                    'free_solves': 0,
+                    'wrong_guesses': 0,
+                    'used_hints': 0,
+                    'meta_solves': 0,
+                    'finished': 0,
+                    'last_solve_time': team.creation_time,
+                }, empty))
+                continue
+            start = row * n
+            cells = [0] * (4 * n)
+            cells[0::4] = self.flags[start:start + n]
+            cells[1::4] = self.positions[start:start + n]
+            cells[2::4] = self.wrong_guesses[start:start + n]
+            cells[3::4] = self.hints[start:start + n]
+            last_solve = self.team_last_solve[row]
+            rows.append((team, {
+                'total_solves': self.team_solves[row],
+                'free_solves': self.team_free_solves[row],
+                'wrong_guesses': self.team_wrong_guesses[row],
+                'used_hints': self.team_hints[row],
+                'meta_solves': self.team_meta_solves[row],
+                'finished': self.team_finished[row],
+                'last_solve_time': max(team.creation_time, datetime.datetime.fromtimestamp(
+                    last_solve, datetime.timezone.utc)) if last_solve else team.creation_time,
+            }, cells))
+        return rows
+
+
+def bigboard_data(hide_hidden, teams):
+    '''
+    Brings this worker's board up to date and returns its per-puzzle totals and
+    the rows for the given teams; see Board.team_rows.
+    '''
+    with _lock:
+        sequence = cache.get(SEQUENCE_KEY)
+        if sequence is None:
+            # The cache was cleared, so we might have missed events.
+            cache.add(SEQUENCE_KEY, 0, None)
+            sequence = cache.get(SEQUENCE_KEY, 0)
+            _boards.clear()
+        board = _boards.get(hide_hidden)
+        if board is None or not board.catch_up(sequence):
+            board = _boards[hide_hidden] = Board(hide_hidden, sequence)
+        return board.puzzle_totals(), board.team_rows(teams)
+
+
+def _record(event):
+    try:
+        sequence = cache.incr(SEQUENCE_KEY)
+    except ValueError:
+        cache.add(SEQUENCE_KEY, 0, None)
+        sequence = cache.incr(SEQUENCE_KEY)
+    cache.set(EVENT_KEY % sequence, event, EVENT_TIMEOUT)
+
+
+def record(name, hidden, *args):
+    '''Records an event for every worker's boards once the transaction commits.'''
+    event = (name, hidden, *args)
+    transaction.on_commit(lambda: _record(event))
+
+
+def record_submission(submission):
+    if submission.is_correct:
+        record(
+            'solve', submission.team.is_hidden, submission.team_id, submission.puzzle_id,
+            submission.used_free_answer, submission.submitted_datetime.timestamp())
+    else:
+        record(
+            'set_wrong_guesses', submission.team.is_hidden, submission.team_id,
+            submission.puzzle_id, models.AnswerSubmission.objects.filter(
+                team_id=submission.team_id, puzzle_id=submission.puzzle_id, is_correct=False,
+            ).count())
+
+
+def record_hints(hint):
+    record(
+        'set_hints', hint.team.is_hidden, hint.team_id, hint.puzzle_id,
+        models.Hint.objects.filter(
+            team_id=hint.team_id, puzzle_id=hint.puzzle_id,
+            status=models.Hint.ANSWERED, is_followup=False,
+        ).count())
+
+
+def reset():
+    '''Makes every worker rebuild its boards, for changes events can't express.'''
+    record('reset', False)
@@ -0,0 +1,170 @@
+# The puzzles, rounds, puzzle messages and errata essentially never change
+# during the hunt, so rather than querying for them on every request, each worker keeps an
+# in-memory snapshot of them and only rebuilds it after someone edits one of
+# them (see the receivers at the bottom of models.py). Edits made in one worker
+# reach the others through a version number in the shared cache, which each
+# worker checks at most once every CHECK_INTERVAL seconds.
+#
+# Everything in the catalog is shared between requests (and threads), so treat
+# the model instances in it as read-only.
+import collections
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+from puzzles import models
+from puzzles.hunt_config import META_META_SLUG
+
+VERSION_KEY = 'catalog-version'
+CHECK_INTERVAL = 1  # seconds
+
+_lock = threading.Lock()
+_catalog = None
+_checked_at = 0
+
+
+class Catalog:
+    def __init__(self, version):
+        self.version = version
+        self.rounds = tuple(models.Round.objects.order_by('order'))
+        self.rounds_by_slug = {round.slug: round for round in self.rounds}
+        rounds_by_id = {round.id: round for round in self.rounds}
+        self.puzzles = tuple(models.Puzzle.objects.order_by('round__order', 'order'))
+        for puzzle in self.puzzles:
+            # Share the round objects rather than loading a copy per puzzle.
+            puzzle.round = rounds_by_id[puzzle.round_id]
+        self.puzzles_by_id = {puzzle.id: puzzle for puzzle in self.puzzles}
+        self.puzzles_by_slug = {puzzle.slug: puzzle for puzzle in self.puzzles}
+        self.metas = tuple(puzzle for puzzle in self.puzzles if puzzle.is_meta)
+        meta_meta = self.puzzles_by_slug.get(META_META_SLUG)
+        self.meta_meta_id = meta_meta.id if meta_meta else None
+        self.answers = {puzzle.id: puzzle.normalized_answer for puzzle in self.puzzles}
+        # Both map (puzzle id, semicleaned guess) to the messages for that
+        # guess; the second is for messages that match any guess starting
+        # with it. prefix_lengths has each puzzle's prefix lengths, longest
+        # first, so finding the longest matching prefix takes one lookup per
+        # distinct length rather than one per message.
+        messages = collections.defaultdict(list)
+        prefix_messages = collections.defaultdict(list)
+        prefix_lengths = collections.defaultdict(set)
+        for message in models.PuzzleMessage.objects.order_by('id'):
+            message.puzzle = self.puzzles_by_id[message.puzzle_id]
+            key = (message.puzzle_id, message.semicleaned_guess)
+            if message.is_prefix:
+                prefix_messages[key].append(message)
+                prefix_lengths[message.puzzle_id].add(len(message.semicleaned_guess))
+            else:
+                messages[key].append(message)
+        self.messages = {key: tuple(value) for key, value in messages.items()}
+        self.prefix_messages = {key: tuple(value) for key, value in prefix_messages.items()}
+        self.prefix_lengths = {
+            puzzle_id: sorted(lengths, reverse=True)
+            for puzzle_id, lengths in prefix_lengths.items()
+        }
+        self.errata = tuple(models.Erratum.objects.order_by('timestamp'))
+        for erratum in self.errata:
+            if erratum.puzzle_id is not None:
+                erratum.puzzle = self.puzzles_by_id[erratum.puzzle_id]
+        self.published_errata = tuple(erratum for erratum in self.errata if erratum.published)
+        self.has_puzzle_errata = any(erratum.puzzle_id for erratum in self.published_errata)
+
+    def puzzle_messages(self, puzzle, semicleaned_guess):
+        messages = self.messages.get((puzzle.id, semicleaned_guess))
+        if messages:
+            return messages
+        for length in self.prefix_lengths.get(puzzle.id, ()):
+            if length <= len(semicleaned_guess):
+                messages = self.prefix_messages.get((puzzle.id, semicleaned_guess[:length]))
+                if messages:
+                    return messages
+        return ()
+
+    def check_answer(self, puzzle, guess):
+        '''
+        Returns the normalized guess, whether it's correct, and the messages
+        to show for it instead of submitting it (if any).
+        '''
+        normalized_answer = models.Puzzle.normalize_answer(guess)
+        is_correct = normalized_answer == self.answers[puzzle.id]
+        semicleaned_guess = models.PuzzleMessage.semiclean_guess(guess)
+        messages = self.messages.get((puzzle.id, semicleaned_guess), ())
+        if not messages and not is_correct:
+            # A prefix rule shouldn't stop anyone from submitting the answer.
+            messages = self.puzzle_messages(puzzle, semicleaned_guess)
+        return normalized_answer, is_correct, messages
+
+    def visible_errata(self, context):
+        '''
+        The errata the context can see: all of them for admins, and otherwise
+        the published ones that aren't about a puzzle they can't see. This
+        avoids computing the unlocks unless it has to, by going by the team's
+        saved unlocks (which are only out of date until the team next loads a
+        page that needs its unlocks).
+        '''
+        if context.is_superuser:
+            return self.errata
+        if (not self.has_puzzle_errata or
+                context.hunt_is_prereleased or context.hunt_is_over):
+            return self.published_errata
+        if context.team and not context.is_computed('unlocks'):
+            visible = context.team.db_unlocks
+        else:
+            visible = {puzzle.id for puzzle in context.unlocks}
+        return tuple(
+            erratum for erratum in self.published_errata
+            if erratum.puzzle_id is None or erratum.puzzle_id in visible
+        )
+
+
+def get_catalog():
+    global _catalog, _checked_at
+    now = time.monotonic()
+    catalog = _catalog
+    if catalog is not None and now - _checked_at < CHECK_INTERVAL:
+        return catalog
+    version = cache.get(VERSION_KEY)
+    _checked_at = now
+    if catalog is None or catalog.version != version:
+        with _lock:
+            if _catalog is None or _catalog.version != version:
+                _catalog = Catalog(version)
+            catalog = _catalog
+    return catalog
+
+
+def reload():
+    '''
+    Rebuilds this worker's catalog now, whatever its version, for when it's
+    missing something that must exist (its version might not have been
+    checked lately, or the version in the cache might have been evicted).
+    '''
+    global _catalog, _checked_at
+    version = cache.get(VERSION_KEY)
+    with _lock:
+        _catalog = Catalog(version)
+        _checked_at = time.monotonic()
+        return _catalog
+
+
+def _reset():
+    global _catalog
+    _catalog = None
+
+
+def _broadcast():
+    _reset()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+
+
+def invalidate():
+    '''
+    Drop this worker's catalog right away, so the change is visible to the rest
+    of this request, and tell the other workers once it's committed.
+    '''
+    _reset()
+    transaction.on_commit(_broadcast)
@@ -5,15 +5,22 @@
 # https://docs.djangoproject.com/en/3.1/ref/templates/api/#using-requestcontext
 import datetime
 import inspect
+import os
+import sys
+import threading
 import types
+import weakref
 
 from django.conf import settings
+from django.template.base import Template
 from django.urls import reverse
 from django.utils import timezone
 
 from puzzles import hunt_config
-from puzzles.hunt_config import HUNT_START_TIME, HUNT_END_TIME, HUNT_CLOSE_TIME, META_META_SLUG
+from puzzles import metrics
+from puzzles.hunt_config import HUNT_START_TIME, HUNT_END_TIME, HUNT_CLOSE_TIME
 from puzzles import models
+from puzzles.catalog import get_catalog
 from puzzles.shortcuts import get_shortcuts
 
 
@@ -30,26 +37,89 @@ def context_processor(request):
         return lambda: getattr(request.context, name)
     return {name: thunk(name) for name in request.context._cached_names}
 
+# The properties being computed on this thread, innermost last, as
+# (weakref to object, name) pairs.
+class Computing(threading.local):
+    def __init__(self):
+        self.stack = []
+
+computing = Computing()
+
 # Construct a get/set property from a name and a function to compute a value.
 # Doing this with name="foo" causes accesses to self.foo to call fn and cache
 # the result.
+#
+# Reading a property while computing another one records the second as
+# depending on the first (even if they're on different objects, like a
+# Context's unlocks depending on its Team's solves), so that invalidating or
+# setting the first also throws away the second.
 def wrap_cacheable(name, fn):
     def fget(self):
         if not hasattr(self, '_cache'):
             self._cache = {}
+            self._dependents = {}
+        stack = computing.stack
+        if stack:
+            self._dependents.setdefault(name, set()).add(stack[-1])
         if name not in self._cache:
-            self._cache[name] = fn(self)
+            token = metrics.computing()
+            stack.append((weakref.ref(self), name))
+            try:
+                value = fn(self)
+            finally:
+                stack.pop()
+            self._cache[name] = value
+            if token is not None:
+                metrics.computed(token, '%s.%s' % (type(self).__name__, name), toucher)
         return self._cache[name]
     def fset(self, value):
         if not hasattr(self, '_cache'):
             self._cache = {}
+            self._dependents = {}
+        invalidate(self, name)
         self._cache[name] = value
     return property(fget, fset)
 
+def invalidate(self, *names):
+    '''
+    Throws away the cached values of the given properties and of everything
+    that was computed from them, so that they're recomputed when next used.
+    '''
+    if not hasattr(self, '_cache'):
+        return
+    for name in names:
+        self._cache.pop(name, None)
+        for ref, dependent in self._dependents.pop(name, ()):
+            obj = ref()
+            if obj is not None:
+                invalidate(obj, dependent)
+
+def is_computed(self, name):
+    '''Whether the given property has a cached value right now.'''
+    return name in getattr(self, '_cache', {})
+
+# For profiling: describes what asked for the property being computed, which
+# is the innermost template being rendered if it came from a template, or else
+# the function that used it (which might be another property). Looks past
+# Django and the wrappers in this file.
+DJANGO_DIR = os.path.dirname(sys.modules['django'].__file__)
+def toucher():
+    frame = sys._getframe(2)
+    while frame:
+        code = frame.f_code
+        if code.co_filename.startswith(DJANGO_DIR):
+            if code.co_name.endswith('render') and isinstance(frame.f_locals.get('self'), Template):
+                return frame.f_locals['self'].origin.template_name or '?'
+        elif not (code.co_filename == __file__ and code.co_name in ('fget', '<lambda>')):
+            return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+        frame = frame.f_back
+    return '?'
+
 # Decorator for a class, like the `Context` class below but also the `Team`
 # model, that replaces all non-special methods that take no arguments other
 # than `self` with a get/set property as constructed above, and also gather
-# their names into the property `_cached_names`.
+# their names into the property `_cached_names`. It also adds the methods
+# invalidate(*names) and is_computed(name) above.
 def context_cache(cls):
     cached_names = []
     for c in (BaseContext, cls):
@@ -62,6 +132,8 @@ def context_cache(cls):
                 setattr(cls, name, wrap_cacheable(name, fn))
                 cached_names.append(name)
     cls._cached_names = tuple(cached_names)
+    cls.invalidate = invalidate
+    cls.is_computed = is_computed
     return cls
 
 
@@ -150,14 +222,19 @@ class Context:
     def unlocks(self):
         return models.Team.compute_unlocks(self)
 
+    # Fetched once per request, so that a request sees a consistent catalog
+    # even if it's rebuilt partway through.
+    def catalog(self):
+        return get_catalog()
+
     def all_puzzles(self):
-        return tuple(models.Puzzle.objects.select_related('round').order_by('round__order', 'order'))
+        return self.catalog.puzzles
 
     def unclaimed_hints(self):
-        return models.Hint.objects.filter(status=models.Hint.NO_RESPONSE, claimer='').count()
+        return models.Hint.unclaimed_count()
 
     def visible_errata(self):
-        return models.Erratum.get_visible_errata(self)
+        return self.catalog.visible_errata(self)
 
     def errata_page_visible(self):
         return self.is_superuser or any(erratum.updates_text for erratum in self.visible_errata)
@@ -188,4 +265,4 @@ class Context:
         return reverse('archive') if settings.DEBUG else 'https://FIXME/archive'
 
     def has_finished_hunt(self):
-        return any(puzzle.slug == META_META_SLUG for puzzle in self.team.solves.values()) if self.team else False
+        return self.catalog.meta_meta_id in self.team.solves if self.team else False
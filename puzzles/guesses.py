@@ -0,0 +1,105 @@
+# How many teams have submitted each answer to each puzzle, for the sigils on
+# submission alerts (first place, skull and crossbones, ...) and the staff
+# page of the most common wrong answers. Only visible teams' answers that
+# weren't free count, and each team can only submit an answer once, so these
+# are counts of distinct teams.
+#
+# Each count lives in the shared cache and is bumped with cache.incr as
+# submissions are committed, so formatting an alert doesn't need to query
+# anything. A missing count (never seen, or evicted) is counted from the
+# database once.
+# Anything rarer that could change the counts (deleting or editing a
+# submission, hiding a team) bumps a version number that's part of every key,
+# which starts them all over.
+import hashlib
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
+from puzzles import models
+
+VERSION_KEY = 'guess-counts-version'
+COUNT_KEY = 'guess-count:%d:%d:%s'
+TOP_WRONG_ANSWERS = 10
+
+
+def _key(puzzle_id, answer):
+    version = cache.get_or_set(VERSION_KEY, 0, None)
+    # Answers can be longer than some caches allow keys to be.
+    digest = hashlib.sha1(answer.encode()).hexdigest()
+    return COUNT_KEY % (version, puzzle_id, digest)
+
+
+def _count_from_db(puzzle_id, answer):
+    return models.AnswerSubmission.objects.filter(
+        puzzle_id=puzzle_id,
+        submitted_answer=answer,
+        used_free_answer=False,
+        team__is_hidden=False,
+    ).count()
+
+
+def get(puzzle_id, answer):
+    '''How many visible teams have submitted this answer to this puzzle.'''
+    key = _key(puzzle_id, answer)
+    count = cache.get(key)
+    if count is None:
+        count = _count_from_db(puzzle_id, answer)
+        cache.add(key, count, None)
+    return count
+
+
+def record(submission):
+    '''
+    Counts a new submission, if it counts, once it's committed, and returns
+    how many visible teams have submitted its answer including it.
+    '''
+    if submission.used_free_answer or submission.team.is_hidden:
+        return get(submission.puzzle_id, submission.submitted_answer)
+    key = _key(submission.puzzle_id, submission.submitted_answer)
+    count = cache.get(key)
+    if count is None:
+        # This count includes the new submission.
+        count = _count_from_db(submission.puzzle_id, submission.submitted_answer)
+    else:
+        count += 1
+    transaction.on_commit(lambda: _increment(
+        key, submission.puzzle_id, submission.submitted_answer))
+    return count
+
+
+def _increment(key, puzzle_id, answer):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Committed now, so this count includes the new submission.
+        cache.add(key, _count_from_db(puzzle_id, answer), None)
+
+
+def reset():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+
+
+def top_wrong_answers(limit=TOP_WRONG_ANSWERS):
+    '''
+    Returns a dictionary from puzzle ids to lists of up to limit (answer,
+    number of teams) pairs, most common first. This one queries the database,
+    so it's only for staff pages.
+    '''
+    answers = {}
+    for puzzle_id, answer, teams in (
+        models.AnswerSubmission.objects
+        .filter(is_correct=False, used_free_answer=False, team__is_hidden=False)
+        .values('puzzle_id', 'submitted_answer')
+        .annotate(teams=Count('id'))
+        .order_by('puzzle_id', '-teams', 'submitted_answer')
+        .values_list('puzzle_id', 'submitted_answer', 'teams')
+    ):
+        puzzle_answers = answers.setdefault(puzzle_id, [])
+        if len(puzzle_answers) < limit:
+            puzzle_answers.append((answer, teams))
+    return answers
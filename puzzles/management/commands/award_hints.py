@@ -8,8 +8,5 @@ class Command(BaseCommand):
         parser.add_argument('num_hints', nargs=1, type=int)
 
     def handle(self, *args, **options):
-        teams = Team.objects.all()
-        for team in teams:
-            team.total_hints_awarded += options['num_hints'][0]
-            team.save()
-        self.stdout.write(self.style.SUCCESS('Successfully awarded hints'))
\ No newline at end of file
+        Team.award(Team.objects.all(), hints=options['num_hints'][0])
+        self.stdout.write(self.style.SUCCESS('Successfully awarded hints'))
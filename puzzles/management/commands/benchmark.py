@@ -0,0 +1,196 @@
+# Measures the pages that get hammered during the hunt against whatever is in
+# the database. For realistic numbers, run it against a copy seeded with
+# generate_random_puzzles and generate_random_teams, not against the live site:
+# the solve benchmark submits real (wrong) answers.
+#
+# Typical use: save a baseline before a change, then compare against it after.
+#   ./manage.py benchmark --save-baseline before.json
+#   ./manage.py benchmark --baseline before.json
+import itertools
+import json
+import statistics
+import string
+import time
+import tracemalloc
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from puzzles.context import Context
+from puzzles.hunt_config import HUNT_START_TIME, HUNT_END_TIME
+from puzzles.messaging import HintsConsumer
+from puzzles.models import Team
+
+real_now = timezone.now
+real_localtime = timezone.localtime
+
+
+class Command(BaseCommand):
+    help = 'Measures latency, query counts and memory of the busiest pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--team', help='Team to browse as (default: the median team)')
+        parser.add_argument('--listeners', type=int, default=500,
+            help='Websocket connections to broadcast hint updates to')
+        parser.add_argument('--only', nargs='+', help='Names of the benchmarks to run')
+        parser.add_argument('--save-baseline', metavar='PATH')
+        parser.add_argument('--baseline', metavar='PATH',
+            help='Fail if anything got slower or made more queries than in this baseline')
+        parser.add_argument('--threshold', type=float, default=0.2,
+            help='How much slower than the baseline counts as a regression (default 20%%)')
+        parser.add_argument('--force', action='store_true',
+            help='Run even though this isn\'t a test deployment')
+
+    def handle(self, *args, **options):
+        if not settings.IS_TEST and not options['force']:
+            raise CommandError('This submits answers; use --force to run it outside a test deployment')
+
+        if options['team']:
+            team = Team.objects.get(team_name=options['team'])
+        else:
+            # Someone from the middle of the pack, who has solved plenty but
+            # still has puzzles left.
+            teams = Team.leaderboard_teams(None)
+            team = teams[teams.count() // 2] if teams.exists() else None
+        if team is None:
+            raise CommandError('No teams to benchmark with; try generate_random_teams')
+        admin = User.objects.filter(is_superuser=True).first()
+        if admin is None:
+            raise CommandError('No superuser to benchmark with; try createsuperuser')
+
+        # Pages that teams can only see during the hunt are measured halfway
+        # through it, and those that need the hunt to be over just after it.
+        during = HUNT_START_TIME + (HUNT_END_TIME - HUNT_START_TIME) / 2
+        after = HUNT_END_TIME + timedelta(minutes=1)
+        with self.clock(during):
+            context = Context(None)
+            context.request_user = team.user
+            unsolved = [puzzle for puzzle in context.unlocks if puzzle.id not in context.team.solves]
+        if not unsolved:
+            raise CommandError('%s has no unsolved puzzles; try generate_random_puzzles' % team)
+        puzzle = unsolved[-1]
+        # Spread the wrong answers over every unsolved puzzle so that we don't
+        # run out of guesses.
+        solve_puzzles = itertools.cycle(unsolved)
+
+        team_client = Client()
+        team_client.force_login(team.user)
+        admin_client = Client()
+        admin_client.force_login(admin)
+        # The hint list is only for admins impersonating a team.
+        hinter_client = Client()
+        hinter_client.force_login(admin)
+        hinter_client.get(reverse('impersonate-start', args=(team.user_id,)))
+        # Answers are normalized to letters, so count in letters.
+        guesses = ('BENCHMARK' + ''.join(letters) for length in itertools.count(1)
+            for letters in itertools.product(string.ascii_uppercase, repeat=length))
+
+        # name => (when, what to run, the status code it should get)
+        benchmarks = {
+            'puzzles': (during, lambda: team_client.get(reverse('puzzles')), 200),
+            'puzzle': (during, lambda: team_client.get(reverse('puzzle', args=(puzzle.slug,))), 200),
+            'solve': (during, lambda: team_client.post(reverse('solve', args=(next(solve_puzzles).slug,)),
+                {'answer': next(guesses)}), 302),
+            'teams': (during, lambda: team_client.get(reverse('teams')), 200),
+            'team': (during, lambda: team_client.get(reverse('team', args=(team.team_name,))), 200),
+            'bigboard': (during, lambda: admin_client.get(reverse('bigboard')), 200),
+            'stats': (after, lambda: team_client.get(reverse('hunt-stats')), 200),
+            'hints': (during, lambda: hinter_client.get(reverse('hint-list')), 200),
+            'hint-broadcast': (during, self.broadcaster(options['listeners']), None),
+        }
+        if options['only']:
+            unknown = set(options['only']) - set(benchmarks)
+            if unknown:
+                raise CommandError('Unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+            benchmarks = {name: benchmarks[name] for name in options['only']}
+
+        results = {}
+        for name, (at, run, status) in benchmarks.items():
+            with self.clock(at):
+                results[name] = self.measure(name, run, status, options['iterations'])
+            self.stdout.write('{:16} {:9.2f}ms median {:9.2f}ms p95 {:5d} queries {:9.1f}KiB peak'.format(
+                name, results[name]['median'], results[name]['p95'],
+                results[name]['queries'], results[name]['memory'] / 1024))
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = []
+            for name, result in results.items():
+                old = baseline.get(name)
+                if old is None:
+                    continue
+                if result['median'] > old['median'] * (1 + options['threshold']):
+                    regressions.append('{}: median {:.2f}ms -> {:.2f}ms'.format(
+                        name, old['median'], result['median']))
+                if result['queries'] > old['queries']:
+                    regressions.append('{}: {} -> {} queries'.format(
+                        name, old['queries'], result['queries']))
+            if regressions:
+                raise CommandError('Regressions against {}:\n{}'.format(
+                    options['baseline'], '\n'.join(regressions)))
+            self.stdout.write(self.style.SUCCESS('No regressions against %s' % options['baseline']))
+
+    def clock(self, at):
+        # Shifts the site's clock (which reads timezone.localtime) but not
+        # Django's, or sessions would expire.
+        offset = at - real_now()
+        def localtime(value=None, *args):
+            return real_localtime(value or real_now() + offset, *args)
+        return mock.patch('django.utils.timezone.localtime', localtime)
+
+    def measure(self, name, run, status, iterations):
+        # One warmup run fills the caches, then one counts queries and one
+        # measures memory (tracemalloc slows everything down, so it isn't on
+        # while timing).
+        response = run()
+        if status is not None and response.status_code != status:
+            raise CommandError('%s: expected a %d but got a %d' % (name, status, response.status_code))
+        with CaptureQueriesContext(connection) as queries:
+            run()
+        # (Count them now, since the next request clears the log.)
+        query_count = len(queries)
+        tracemalloc.start()
+        run()
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        times = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            run()
+            times.append((time.perf_counter() - start) * 1000)
+        times.sort()
+        return {
+            'median': statistics.median(times),
+            'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+            'queries': query_count,
+            'memory': memory,
+        }
+
+    def broadcaster(self, listeners):
+        # Fans a hint update out to this many connected admins. Their channels
+        # are never read, so with the in-memory layer this only measures our
+        # side of the send.
+        layer = get_channel_layer()
+        channels = []
+        def run():
+            if not channels:
+                for _ in range(listeners):
+                    channels.append(async_to_sync(layer.new_channel)())
+                    async_to_sync(layer.group_add)(HintsConsumer.group_id, channels[-1])
+            HintsConsumer.send_to_all(json.dumps({'id': 0, 'content': 'x' * 500}))
+        return run
@@ -1,4 +1,5 @@
 from django.core.management.base import BaseCommand
+from django.utils import timezone
 from puzzles.models import PuzzleUnlock, TeamMember
 
 class Command(BaseCommand):
@@ -10,7 +11,10 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         slug = options['puzzle_slug'][0]
         self.stdout.write('Getting email addresses for puzzle {}...\n\n'.format(slug))
-        teams = PuzzleUnlock.objects.filter(puzzle__slug=slug).values_list('team_id', flat=True)
+        # The scheduler inserts time unlocks ahead of time, so skip any not due yet.
+        teams = PuzzleUnlock.objects.filter(
+            puzzle__slug=slug, unlock_datetime__lte=timezone.now(),
+        ).values_list('team_id', flat=True)
         members = TeamMember.objects.filter(team_id__in=teams).exclude(email='').values_list('email', flat=True)
         if members:
             self.stdout.write(', '.join(members))
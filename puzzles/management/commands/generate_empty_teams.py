@@ -2,12 +2,11 @@
 # randomly generating stuff. If we get unlucky and generate something
 # non-unique, just try again.
 from django.core.management.base import BaseCommand
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
-from django.utils import timezone
-from datetime import datetime, timedelta
-from puzzles.models import Team, Puzzle, AnswerSubmission, Survey
-from puzzles.hunt_config import HUNT_START_TIME
-from unittest import mock
+from django.db import transaction
+from puzzles import bigboard, ranking
+from puzzles.models import Team
 import random
 
 # for flavor, and to test unicode // http://racepics.weihwa.com/
@@ -45,7 +44,6 @@ class Command(BaseCommand):
         n = options['num_teams'][0]
         username_prefix = options['username_prefix'][0]
         name_prefix = options['name_prefix'][0]
-        teams = []
         existing_users = User.objects.all().filter(username__startswith=username_prefix)
         existing_teams = Team.objects.all().filter(user__username__startswith=username_prefix)
         self.stdout.write(self.style.ERROR('These will be deleted:'))
@@ -56,18 +54,20 @@ class Command(BaseCommand):
         existing_teams.delete()
         existing_users.delete()
 
-        for i in range(n):
-            username = '{}_{}'.format(username_prefix, i)
-
-            user = User.objects.create_user(
-                username=username, password="pw"
-            )
-            team = Team(
+        # Hashing is deliberately slow, so only do it once, and skip save() so
+        # that we don't send an alert for every team.
+        password = make_password('pw')
+        with transaction.atomic():
+            User.objects.bulk_create([User(
+                username='{}_{}'.format(username_prefix, i),
+                password=password,
+            ) for i in range(n)], batch_size=500)
+            users = User.objects.filter(username__startswith=username_prefix + '_')
+            Team.objects.bulk_create([Team(
                 user=user,
                 team_name=random_team_name(name_prefix),
-                creation_time=datetime.now(),
-            )
-            team.save()
-            teams.append(team)
+            ) for user in users], batch_size=500)
+        bigboard.reset()
+        ranking.rebuild()
 
         self.stdout.write(self.style.SUCCESS('Generated {} teams'.format(n)))
@@ -1,117 +1,224 @@
-# Note: for simplicity, we don't try to check uniqueness constraints when
-# randomly generating stuff. If we get unlucky and generate something
-# non-unique, just try again.
-from django.core.management.base import BaseCommand
-from django.contrib.auth.models import User
-from django.utils import timezone
-from datetime import datetime, timedelta
-from puzzles.models import Team, Puzzle, AnswerSubmission, Survey
-from puzzles.hunt_config import HUNT_START_TIME
-from unittest import mock
+# Generates teams with a plausible hunt's worth of progress, fast enough to
+# seed load tests: everything is built in memory with ids assigned up front and
+# written with bulk_create, so there's no per-row save() and none of the
+# receivers in models.py run. The leaderboard columns are filled in here, each
+# batch's hint and free answer counts are recounted after it's written, and the
+# rest of the derived data (puzzle stats, bigboard, rank index) is rebuilt at
+# the end.
+#
+# Every team gets a skill and every puzzle a difficulty. Teams work through the
+# puzzles in order, taking longer on harder puzzles, until they either finish
+# or run out of hunt. Weaker teams make more wrong guesses and ask for more
+# hints along the way. With the same --seed and the same puzzles, you get the
+# same hunt.
+import contextlib
 import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+
+from puzzles import bigboard, ranking
+from puzzles.catalog import get_catalog
+from puzzles.hunt_config import HUNT_START_TIME, HUNT_END_TIME, META_META_SLUG, MAX_GUESSES_PER_PUZZLE
+from puzzles.models import Team, PuzzleUnlock, AnswerSubmission, Hint, Survey, PuzzleStats
 
 # for flavor, and to test unicode // http://racepics.weihwa.com/
 emoji = "💥💫🐒🦍🐕🐺🦊🐈🦁🐅🐆🐎🦄🦌🐂🐃🐄🐖🐗🐏🐑🐐🐪🐘🦏🐁🐀🐹🐇🐿🦇🐻🐨🐼🐾🦃🐔🐓🐤🐦🐧🕊🦅🦆🦉🐸🐊🐢🦎🐍🐉🐳🐋🐬🐟🐠🐡🦈🐙🐚🐌🦋🐛🐜🐝🐞🕷🕸🦂💐🌸💮🌹🌺🌻🌼🌷🌱🌲🌳🌴🌵🌾🌿☘🍀🍁🍃🍄🌰🦀🦐🦑🌐🌙⭐🌈⚡🔥🌊✨🎮🎲🧩♟🎭🎨🧵🎤🎧🎷🎸🎹🎺🎻🥁🎬🏹🌋🏖🏜🏝🏠🏤🏥🏦🏫🌃🏙🌅🌇🚆🚌🚕🚗🚲⚓✈🚁🚀🛸🎆"
 adjectives = "Alien Alpha Aquatic Avian Bio-Hazard Blaster Comet Contact Deep-Space Deficit Deserted Destroyed Distant Empath Epsilon Expanding Expedition Galactic Gambling Gem Genetics Interstellar Lost Malevolent Military Mining Mining New Old Outlaw Pan-Galactic Pilgrimage Pirate Plague Pre-Sentient Prosperous Public Radioactive Rebel Replicant Reptilian Research Scout Terraformed Terraforming Uplift".split()
 nouns = "Alliance Bankers Base Battle Bazaar Cache Center Code Colony Consortium Developers Earth Economy Engineers Exchange Factory Federation Fleet Fortress Guild Imperium Institute Lab Lair League Lifeforms Mercenaries Monolith Order Outpost Pact Port Program Project Prospectors Renaissance Repository Resort Robots Shop Sparta Stronghold Studios Survey Symbionts Sympathizers Technology Trendsetters Troops Warlord Warship World".split()
-wrong_answers = [x + y for x in ["RED", "WRONG", "INCORRECT"] for y in ["", "ANSWER", "SOLUTION", "HERRING"]]
+wrong_answers = [x + y for x in ["RED", "WRONG", "INCORRECT", "BAD", "NOPE"] for y in ["", "ANSWER", "SOLUTION", "HERRING"]]
+claimers = ["Alice", "Bob", "Carol", "Dave", "Eve", "Mallory"]
 
-def random_team_name():
+# The models whose rows get generated, in the order they have to be written.
+MODELS = (User, Team, PuzzleUnlock, AnswerSubmission, Hint, Survey)
+
+def random_team_name(rng):
     return "{}{}{} {} {} {}{}{}".format(
-        random.choice(emoji),
-        random.choice(emoji),
-        random.choice(emoji),
-        random.choice(adjectives),
-        random.choice(nouns),
-        random.choice(emoji),
-        random.choice(emoji),
-        random.choice(emoji),
+        rng.choice(emoji),
+        rng.choice(emoji),
+        rng.choice(emoji),
+        rng.choice(adjectives),
+        rng.choice(nouns),
+        rng.choice(emoji),
+        rng.choice(emoji),
+        rng.choice(emoji),
     )
 
-def random_datetime_since(start):
-    now = timezone.make_aware(datetime.now())
-    if start > now: return now
-
-    delta = now - start
-    ret = start + timedelta(seconds=random.randint(0, int(delta.total_seconds())))
-    print(start, now, delta, ret)
-    return ret
+@contextlib.contextmanager
+def keep_timestamps():
+    # bulk_create would otherwise overwrite our made-up times with now.
+    fields = [
+        (field, field.auto_now, field.auto_now_add)
+        for model in MODELS for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    for field, _, _ in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in fields:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
 
 class Command(BaseCommand):
-    help = 'Randomly generate n teams for testing, complete with solves and surveys'
+    help = 'Randomly generate n teams for testing, complete with solves, hints and surveys'
 
     def add_arguments(self, parser):
         parser.add_argument('num_teams', nargs=1, type=int)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--hours', type=float, default=72,
+            help='How long the simulated hunt lasts (at most until HUNT_END_TIME)')
+        parser.add_argument('--puzzle-hours', type=float, default=3,
+            help='How long an average team takes on an average puzzle')
+        parser.add_argument('--parallelism', type=float, default=4,
+            help='How many puzzles a team works on at once')
+        parser.add_argument('--hint-rate', type=float, default=0.1,
+            help='Chance an average team asks for a hint on an average puzzle')
+        parser.add_argument('--survey-rate', type=float, default=0.75)
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='Teams generated and written at a time')
+        parser.add_argument('--jsonl', metavar='PATH',
+            help='Write a fixture for loaddata here instead of to the database')
 
     def handle(self, *args, **options):
-        # Annotate every puzzle and every team with a rating to get a more
-        # interesting and realistic scoreboard, where there are trends across
-        # teams and puzzles.
-        puzzles = [(p, random.random()) for p in Puzzle.objects.all()]
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        self.puzzles = get_catalog().puzzles
+        if not self.puzzles:
+            raise CommandError('No puzzles; try generate_random_puzzles')
+        self.difficulty = {puzzle.id: self.rng.lognormvariate(0, 0.5) for puzzle in self.puzzles}
+        self.start = HUNT_START_TIME
+        self.end = min(HUNT_END_TIME, self.start + timedelta(hours=options['hours']))
+        # Hashing is deliberately slow, so only do it once.
+        self.password = make_password('password')
+        self.team_names = set(Team.objects.values_list('team_name', flat=True))
+        self.next_ids = {
+            model: (model.objects.aggregate(id=Max('id'))['id'] or 0) + 1
+            for model in MODELS
+        }
+
         n = options['num_teams'][0]
-        teams = []
-        for i in range(n):
-            username = 'team{}'.format(random.randint(0,10**10))
-
-            user = User.objects.create_user(
-                username=username, email=username + "@example.com", password="password"
-            )
-            with mock.patch("django.utils.timezone.now") as mock_now:
-                mock_now.return_value = random_datetime_since(HUNT_START_TIME)
-                team = Team(
-                    user=user,
-                    team_name=random_team_name(),
-                    creation_time=random_datetime_since(HUNT_START_TIME),
-                )
-                team.save()
-            # Teams have a wider range of skill than puzzles.
-            teams.append((team, random.random() * 2 + 0.05))
-
-        for puzzle, puzzle_rating in puzzles:
-            # Shuffle every time so puzzles don't all get solved by teams in a
-            # consistent order and the bigboard looks nontrivial.
-            random.shuffle(teams)
-            for team, team_rating in teams:
-                success_prob = team_rating - puzzle_rating
-
-                if success_prob < 0: continue
-
-                cur_time = team.creation_time
-
-                for i in range(random.randint(0, 10)):
-                    if random.random() < success_prob:
-                        break
-                    cur_time = random_datetime_since(cur_time)
-                    with mock.patch("django.utils.timezone.now") as mock_now:
-                        mock_now.return_value = cur_time
-                        AnswerSubmission(
-                            team=team,
-                            puzzle=puzzle,
-                            submitted_answer=wrong_answers[i],
-                            is_correct=False,
-                            used_free_answer=False,
-                            submitted_datetime=cur_time,
-                        ).save()
-
-                if random.random() < success_prob:
-                    cur_time = random_datetime_since(cur_time)
-                    with mock.patch("django.utils.timezone.now") as mock_now:
-                        mock_now.return_value = cur_time
-                        AnswerSubmission(
-                            team=team,
-                            puzzle=puzzle,
-                            submitted_answer=puzzle.normalized_answer,
-                            is_correct=True,
-                            used_free_answer=False,
-                            submitted_datetime=cur_time,
-                        ).save()
-
-                        if random.random() < 0.75:
-                            Survey(
-                                team=team,
-                                puzzle=puzzle,
-                                fun=random.randint(1, 6),
-                                difficulty=random.randint(1, 6),
-                            ).save()
-
-        self.stdout.write(self.style.SUCCESS('Randomly generated {} teams'.format(n)))
+        out = open(options['jsonl'], 'w') if options['jsonl'] else None
+        counts = dict.fromkeys(MODELS, 0)
+        try:
+            with keep_timestamps():
+                for first in range(0, n, options['batch_size']):
+                    rows = {model: [] for model in MODELS}
+                    for _ in range(min(options['batch_size'], n - first)):
+                        self.generate_team(rows)
+                    if out:
+                        for model in MODELS:
+                            serializers.serialize('jsonl', rows[model], stream=out)
+                    else:
+                        with transaction.atomic():
+                            for model in MODELS:
+                                model.objects.bulk_create(rows[model], batch_size=500)
+                            Team.update_allowances([team.id for team in rows[Team]])
+                    for model in MODELS:
+                        counts[model] += len(rows[model])
+        finally:
+            if out:
+                out.close()
+
+        if not out:
+            # We chose the ids, so the database's sequences need catching up.
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), MODELS):
+                    cursor.execute(sql)
+            PuzzleStats.recompute()
+            bigboard.reset()
+            ranking.rebuild()
+
+        self.stdout.write(self.style.SUCCESS('Randomly generated {} teams ({})'.format(n, ', '.join(
+            '{} {}'.format(count, model._meta.verbose_name_plural) for model, count in counts.items()))))
+        if out:
+            self.stdout.write('Load it with loaddata, then run rebuild_leaderboard, rebuild_allowances and rebuild_puzzle_stats.')
+
+    def new_id(self, model):
+        self.next_ids[model] += 1
+        return self.next_ids[model] - 1
+
+    def generate_team(self, rows):
+        rng = self.rng
+        options = self.options
+        user_id = self.new_id(User)
+        rows[User].append(User(
+            id=user_id,
+            username='team{}'.format(user_id),
+            email='team{}@example.com'.format(user_id),
+            password=self.password,
+        ))
+        team_name = random_team_name(rng)
+        while team_name in self.team_names:
+            team_name = random_team_name(rng)
+        self.team_names.add(team_name)
+        team = Team(
+            id=self.new_id(Team),
+            user_id=user_id,
+            team_name=team_name,
+            # Most teams register in the last couple of weeks.
+            creation_time=self.start - timedelta(days=rng.expovariate(1 / 7)),
+        )
+        rows[Team].append(team)
+
+        # Teams have a wider range of skill than puzzles have of difficulty.
+        skill = rng.lognormvariate(0, 0.8)
+        now = self.start
+        for puzzle in self.puzzles:
+            if now >= self.end:
+                break
+            unlocked = now
+            rows[PuzzleUnlock].append(PuzzleUnlock(
+                id=self.new_id(PuzzleUnlock), team_id=team.id, puzzle_id=puzzle.id,
+                unlock_datetime=unlocked))
+            hardness = self.difficulty[puzzle.id] / skill
+            solve_time = unlocked + timedelta(
+                hours=rng.expovariate(1 / (options['puzzle_hours'] * hardness)))
+            now += (solve_time - unlocked) / options['parallelism']
+            solved = solve_time < self.end
+            stop = solve_time if solved else self.end
+
+            # A geometric number of wrong guesses, more for harder puzzles.
+            wrong = 0
+            while wrong < MAX_GUESSES_PER_PUZZLE - 1 and rng.random() < hardness / (1 + hardness):
+                wrong += 1
+            for answer in rng.sample(wrong_answers, min(wrong, len(wrong_answers))):
+                rows[AnswerSubmission].append(AnswerSubmission(
+                    id=self.new_id(AnswerSubmission), team_id=team.id, puzzle_id=puzzle.id,
+                    submitted_answer=answer, is_correct=False, used_free_answer=False,
+                    submitted_datetime=unlocked + (stop - unlocked) * rng.random()))
+
+            if rng.random() < min(0.9, options['hint_rate'] * hardness):
+                asked = unlocked + (stop - unlocked) * rng.random()
+                claimed = asked + timedelta(minutes=rng.expovariate(1 / 10))
+                rows[Hint].append(Hint(
+                    id=self.new_id(Hint), team_id=team.id, puzzle_id=puzzle.id,
+                    submitted_datetime=asked,
+                    hint_question='Are we on the right track?',
+                    claimed_datetime=claimed,
+                    claimer=rng.choice(claimers),
+                    answered_datetime=claimed + timedelta(minutes=rng.expovariate(1 / 5)),
+                    status=Hint.ANSWERED,
+                    response='Yes, keep going!'))
+
+            if not solved:
+                continue
+            rows[AnswerSubmission].append(AnswerSubmission(
+                id=self.new_id(AnswerSubmission), team_id=team.id, puzzle_id=puzzle.id,
+                submitted_answer=puzzle.normalized_answer, is_correct=True,
+                used_free_answer=False, submitted_datetime=solve_time))
+            team.total_solves += 1
+            team.last_solve_time = max(team.last_solve_time or solve_time, solve_time)
+            if puzzle.slug == META_META_SLUG:
+                team.metameta_solve_time = solve_time
+            if rng.random() < options['survey_rate']:
+                rows[Survey].append(Survey(
+                    id=self.new_id(Survey), team_id=team.id, puzzle_id=puzzle.id,
+                    submitted_datetime=solve_time + timedelta(minutes=rng.expovariate(1 / 5)),
+                    fun=rng.randint(1, 6), difficulty=rng.randint(1, 6)))
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from puzzles.models import Team
+
+class Command(BaseCommand):
+    help = 'Recounts the hints and free answers every team has used'
+
+    def handle(self, *args, **options):
+        Team.update_allowances(Team.objects.values_list('id', flat=True))
+        self.stdout.write(self.style.SUCCESS('Successfully rebuilt allowances'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from puzzles import ranking
+from puzzles.models import Team
+
+class Command(BaseCommand):
+    help = 'Recomputes every team\'s leaderboard columns and reloads the rank index'
+
+    def handle(self, *args, **options):
+        Team.update_scoreboard(Team.objects.values_list('id', flat=True))
+        ranking.rebuild()
+        self.stdout.write(self.style.SUCCESS('Successfully rebuilt leaderboard'))
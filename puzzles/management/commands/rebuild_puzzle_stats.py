@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from puzzles.models import PuzzleStats
+
+class Command(BaseCommand):
+    help = 'Recomputes the solve, guess and hint counts for every puzzle'
+
+    def handle(self, *args, **options):
+        PuzzleStats.recompute()
+        self.stdout.write(self.style.SUCCESS('Successfully rebuilt puzzle stats'))
@@ -0,0 +1,15 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+from puzzles.messaging import discord_interface
+
+class Command(BaseCommand):
+    help = 'Posts and updates the hint messages in Discord, forever'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll', type=float, default=1, help='Seconds to sleep when idle')
+
+    def handle(self, *args, **options):
+        if not discord_interface.enabled:
+            raise CommandError('Set DiscordInterface.TOKEN in puzzles/messaging.py first')
+        asyncio.run(discord_interface.serve(options['poll']))
@@ -0,0 +1,35 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from puzzles import scheduler
+
+
+class Command(BaseCommand):
+    help = 'Releases time unlocks and hint and free answer allowances on schedule, forever'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lead', type=float, default=scheduler.LEAD_TIME.total_seconds(),
+            help='Seconds before a time unlock to insert its rows')
+        parser.add_argument('--poll', type=float, default=1, help='Seconds to sleep between checks')
+
+    def handle(self, *args, **options):
+        lead = datetime.timedelta(seconds=options['lead'])
+        # Boundaries up to these times have been prepared and fired. Anything
+        # before starting up is left for teams to pick up on their own.
+        prepared = fired = timezone.now()
+        while True:
+            now = timezone.now()
+            for event in scheduler.events(prepared, now + lead):
+                scheduler.prepare(event)
+                self.stdout.write('Prepared %s at %s for offset %s' % (
+                    event.kind, event.time, event.start_offset))
+            prepared = max(prepared, now + lead)
+            for event in scheduler.events(fired, now):
+                scheduler.fire(event)
+                self.stdout.write('Fired %s at %s for offset %s' % (
+                    event.kind, event.time, event.start_offset))
+            fired = now
+            time.sleep(options['poll'])
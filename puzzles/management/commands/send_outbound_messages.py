@@ -0,0 +1,25 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from puzzles import outbound
+
+class Command(BaseCommand):
+    help = 'Sends queued Discord alerts and emails, forever unless --once is given'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Send what is due now and exit')
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--batch', type=int, default=outbound.BATCH_SIZE)
+        parser.add_argument('--poll', type=float, default=1, help='Seconds to sleep when idle')
+
+    def handle(self, *args, **options):
+        sink = outbound.default_sink()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            while True:
+                count = outbound.deliver_pending(executor, sink, options['batch'])
+                if options['once']:
+                    break
+                if count < options['batch']:
+                    time.sleep(options['poll'])
+        self.stdout.write(self.style.SUCCESS('Successfully sent outbound messages'))
@@ -1,12 +1,10 @@
 from django.core.management.base import BaseCommand
-from puzzles.models import Team, Hint
+from django.db.models import F
+from puzzles.models import Team
 
 class Command(BaseCommand):
     help = 'Takes away all unused hints from teams'
 
     def handle(self, *args, **options):
-        teams = Team.objects.all()
-        for team in teams:
-            team.total_hints_awarded = team.num_hints_used
-            team.save()
+        Team.objects.update(total_hints_awarded=F('hints_used'))
         self.stdout.write(self.style.SUCCESS('Successfully taken away hints'))
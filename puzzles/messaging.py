@@ -2,28 +2,27 @@ import asyncio
 import collections
 import json
 import logging
-import requests
+import time
 import traceback
 
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 from channels.generic.websocket import WebsocketConsumer
 from channels.layers import get_channel_layer
 import discord
 
 from django.conf import settings
 from django.contrib import messages
-from django.core.mail.message import EmailMultiAlternatives
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.translation import gettext as _
 
+from puzzles import models
+from puzzles import outbound
 from puzzles.context import Context
 from puzzles.hunt_config import (
     HUNT_TITLE,
     HUNT_ORGANIZERS,
-    CONTACT_EMAIL,
-    MESSAGING_SENDER_EMAIL,
     META_META_SLUG,
 )
 
@@ -51,16 +50,20 @@ VICTORY_WEBHOOK_URL = 'FIXME'
 
 # Assuming you want messages on a messaging platform that's not Discord but
 # supports at least a vaguely similar API, change the following code
-# accordingly:
+# accordingly (and LiveSink.send_discord in outbound.py).
+#
+# Alerts and emails aren't sent right away; they're queued in the database and
+# sent by the send_outbound_messages command (see outbound.py), so requests
+# don't wait on Discord or the mail server.
 def dispatch_discord_alert(webhook, content, username):
     content = '[{}] {}'.format(timezone.localtime().strftime('%H:%M:%S'), content)
     if len(content) >= 2000:
         content = content[:1996] + '...'
-    if settings.IS_TEST:
-        logger.info(_('(Test) Discord alert:\n') + content)
-        return
-    logger.info(_('(Real) Discord alert:\n') + content)
-    requests.post(webhook, json={'username': username, 'content': content, 'allowed_mentions': {'parse': []}})
+    logger.info(_('Queued Discord alert:\n') + content)
+    models.OutboundMessage.objects.create(
+        kind=models.OutboundMessage.DISCORD,
+        destination=webhook,
+        payload=json.dumps({'username': username, 'content': content}))
 
 def dispatch_general_alert(content):
     dispatch_discord_alert(ALERT_WEBHOOK_URL, content, ALERT_DISCORD_USERNAME)
@@ -100,24 +103,16 @@ def send_mail_wrapper(subject, template, context, recipients):
     context['hunt_organizers'] = HUNT_ORGANIZERS
     subject = settings.EMAIL_SUBJECT_PREFIX + subject
     body = render_to_string(template + '.txt', context)
-    if settings.IS_TEST:
-        logger.info(_('Sending mail <{}> to <{}>:\n{}').format(
-            subject, ', '.join(recipients), body))
-        return
-    mail = EmailMultiAlternatives(
-        subject=subject,
-        body=body,
-        from_email=MESSAGING_SENDER_EMAIL,
-        to=recipients,
-        alternatives=[(render_to_string(template + '.html', context), 'text/html')],
-        reply_to=[CONTACT_EMAIL])
-    try:
-        if mail.send() != 1:
-            raise RuntimeError(_('Unknown failure???'))
-    except Exception:
-        dispatch_general_alert(_('Could not send mail <{}> to <{}>:\n{}').format(
-            subject, ', '.join(recipients), traceback.format_exc()))
-
+    logger.info(_('Queued mail <{}> to <{}>:\n{}').format(
+        subject, ', '.join(recipients), body))
+    models.OutboundMessage.objects.create(
+        kind=models.OutboundMessage.EMAIL,
+        payload=json.dumps({
+            'subject': subject,
+            'body': body,
+            'html': render_to_string(template + '.html', context),
+            'recipients': recipients,
+        }))
 
 class DiscordInterface:
     TOKEN = None # FIXME a long token from Discord
@@ -127,36 +122,111 @@ class DiscordInterface:
     GUILD = 'FIXME'
     HINT_CHANNEL = 'FIXME'
 
+    # How long to trust the list of avatars before fetching it again.
+    AVATAR_TTL = 3600 # seconds
+
     # You also need to enable the "Server Members Intent" under the "Privileged
     # Gateway Intents" section of the "Bot" page of your application from the
-    # Discord Developer Portal. Or you can comment out the code that
-    # initializes `self.avatars` below.
+    # Discord Developer Portal. Or you can make get_avatar always return None.
+
+    # Requests never talk to Discord themselves. update_hint and clear_hint
+    # work out what the hint's message should look like and queue it as an
+    # OutboundMessage, in the same transaction as the change to the hint. A
+    # single long-lived client in ./manage.py run_discord_bot sends them (see
+    # serve). Being the only sender, it can trust the discord_id on the Hint
+    # row, so it never posts two messages for one hint. If a hint changes again
+    # before the bot gets to it, only its latest state gets sent.
 
     def __init__(self):
+        self.enabled = bool(self.TOKEN) and not settings.IS_TEST
         self.client = None
-        self.avatars = None
-        if self.TOKEN and not settings.IS_TEST:
-            self.client = discord.Client()
-            self.client.loop = asyncio.new_event_loop()
-            self.client.loop.run_until_complete(self.client.login(self.TOKEN))
-            # Look man, I dunno. I have no clue how Python async works and this
-            # is all a house of cards that probably works totally differently
-            # depending on your environment. If you can find a way to reliably
-            # call these async things from here, please send us a PR.
-
-    def get_avatar(self, claimer):
-        if self.avatars is None:
-            self.avatars = {}
-            if self.client is not None:
-                guild = discord.Guild(data=self.client.loop.run_until_complete(
-                    self.client.http.get_guild(self.GUILD)), state=self.client._connection)
-                for data in self.client.loop.run_until_complete(
-                    self.client.http.get_members(self.GUILD, limit=1000, after=None)):
+        self.avatars = {}
+        self.avatars_fetched_at = None
+
+    async def serve(self, poll):
+        self.client = discord.Client()
+        await self.client.login(self.TOKEN)
+        while True:
+            if not await self.deliver_pending():
+                await asyncio.sleep(poll)
+
+    def due(self):
+        # Each hint's unsent messages, oldest first, leaving out hints with any
+        # message still waiting out a backoff.
+        now = timezone.now()
+        by_hint = {}
+        for message in (models.OutboundMessage.objects
+                .filter(kind=models.OutboundMessage.HINT, next_attempt_datetime__isnull=False)
+                .order_by('id')):
+            message.data = json.loads(message.payload)
+            by_hint.setdefault(message.destination, []).append(message)
+        return [
+            messages for messages in by_hint.values()
+            if all(message.next_attempt_datetime <= now for message in messages)
+        ]
+
+    async def deliver_pending(self):
+        '''
+        Sends the latest state of every hint with messages due. Returns the
+        number of hints it tried to send.
+        '''
+        groups = await sync_to_async(self.due)()
+        for messages in groups:
+            try:
+                await self.send(messages[-1].data)
+            except Exception:
+                error = traceback.format_exc()
+                logger.error(_('Discord API failure: {}\n{}').format(
+                    messages[-1].data['action'], error))
+            else:
+                error = None
+            await sync_to_async(outbound.record)(messages, error, timezone.now())
+        return len(groups)
+
+    def enqueue(self, job):
+        models.OutboundMessage.objects.create(
+            kind=models.OutboundMessage.HINT,
+            destination=str(job['hint_id']),
+            payload=json.dumps(job))
+
+    async def get_avatar(self, claimer):
+        now = time.monotonic()
+        if self.avatars_fetched_at is None or now - self.avatars_fetched_at > self.AVATAR_TTL:
+            # Even if this fails, don't try again until the TTL is up.
+            self.avatars_fetched_at = now
+            avatars = {}
+            try:
+                guild = discord.Guild(data=await self.client.http.get_guild(self.GUILD),
+                    state=self.client._connection)
+                for data in await self.client.http.get_members(self.GUILD, limit=1000, after=None):
                     avatar = discord.Member(data=data, guild=guild, state=self.client._connection).display_avatar.url
                     for name in (data.get('nick'), data['user'].get('username'), data['user'].get('global_name')):
-                        if name: self.avatars[name] = avatar
+                        if name: avatars[name] = avatar
+            except Exception:
+                logger.exception(_('Could not fetch Discord avatars'))
+            else:
+                self.avatars = avatars
         return self.avatars.get(claimer)
 
+    async def send(self, job):
+        embed = job['embed']
+        if job['claimer']:
+            avatar = await self.get_avatar(job['claimer'])
+            if avatar: embed['author']['icon_url'] = avatar
+        discord_id = await sync_to_async(
+            models.Hint.objects.filter(id=job['hint_id']).values_list('discord_id', flat=True).first)()
+        if discord_id:
+            fields = {'embeds': [embed]}
+            if job['action'] == 'clear':
+                fields['content'] = job['content']
+            await self.client.http.edit_message(self.HINT_CHANNEL, discord_id, **fields)
+        elif job['action'] == 'update':
+            discord_id = (await self.client.http.send_message(
+                self.HINT_CHANNEL, job['content'], embeds=[embed]))['id']
+            # update() rather than save() so that this doesn't notify anyone.
+            await sync_to_async(models.Hint.objects.filter(id=job['hint_id']).update)(
+                discord_id=discord_id)
+
     # If you get an error code 50001 when trying to create a message, even
     # though you're sure your bot has all the permissions, it might be because
     # you need to "connect to and identify with a gateway at least once"??
@@ -182,8 +252,6 @@ class DiscordInterface:
             embed['color'] = 0xdddddd
             embed['timestamp'] = hint.claimed_datetime.isoformat()
             embed['author']['name'] = _('Claimed by {}').format(hint.claimer)
-            avatar = self.get_avatar(hint.claimer)
-            if avatar: embed['author']['icon_url'] = avatar
             debug = _('claimed by {}').format(hint.claimer)
         else:
             embed['color'] = 0xff00ff
@@ -193,56 +261,46 @@ class DiscordInterface:
             embed['url'] = claim_url
             debug = 'unclaimed'
 
-        if self.client is None:
-            message = hint.long_discord_message()
+        message = hint.long_discord_message()
+        if not self.enabled:
             logger.info(_('Hint, {}: {}\n{}').format(debug, hint, message))
             logger.info(_('Embed: {}').format(embed))
-        elif hint.discord_id:
-            try:
-                self.client.loop.run_until_complete(self.client.http.edit_message(
-                    self.HINT_CHANNEL, hint.discord_id, embeds=[embed]))
-            except Exception:
-                dispatch_general_alert(_('Discord API failure: modify\n{}').format(
-                    traceback.format_exc()))
-        else:
-            message = hint.long_discord_message()
-            try:
-                discord_id = self.client.loop.run_until_complete(self.client.http.send_message(
-                    self.HINT_CHANNEL, message, embeds=[embed]))['id']
-            except Exception:
-                dispatch_general_alert(_('Discord API failure: create\n{}').format(
-                    traceback.format_exc()))
-                return
-            hint.discord_id = discord_id
-            hint.save(update_fields=('discord_id',))
+            return
+        job = {
+            'action': 'update',
+            'hint_id': hint.id,
+            'content': message,
+            'embed': embed,
+            'claimer': hint.claimer if hint.claimed_datetime else None,
+        }
+        self.enqueue(job)
 
     def clear_hint(self, hint):
         HintsConsumer.send_to_all(json.dumps({'id': hint.id}))
-        if self.client is None:
+        if not self.enabled:
             logger.info(_('Hint done: {}').format(hint))
-        elif hint.discord_id:
-            # what DPPH did instead of deleting messages:
-            # (nb. I tried to make these colors color-blind friendly)
-
-            embed = collections.defaultdict(lambda: collections.defaultdict(dict))
-            if hint.status == hint.ANSWERED:
-                embed['color'] = 0xaaffaa
-            elif hint.status == hint.REFUNDED:
-                embed['color'] = 0xcc6600
-            # nothing for obsolete
-
-            embed['author']['name'] = _('{} by {}').format(hint.get_status_display(), hint.claimer)
-            embed['author']['url'] = hint.full_url()
-            embed['description'] = hint.response[:250]
-            avatar = self.get_avatar(hint.claimer)
-            if avatar: embed['author']['icon_url'] = avatar
-            debug = _('claimed by {}').format(hint.claimer)
-            try:
-                self.client.loop.run_until_complete(self.client.http.edit_message(
-                    self.HINT_CHANNEL, hint.discord_id, content=hint.short_discord_message(), embeds=[embed]))
-            except Exception:
-                dispatch_general_alert(_('Discord API failure: modify\n{}').format(
-                    traceback.format_exc()))
+            return
+        # what DPPH did instead of deleting messages:
+        # (nb. I tried to make these colors color-blind friendly)
+
+        embed = collections.defaultdict(lambda: collections.defaultdict(dict))
+        if hint.status == hint.ANSWERED:
+            embed['color'] = 0xaaffaa
+        elif hint.status == hint.REFUNDED:
+            embed['color'] = 0xcc6600
+        # nothing for obsolete
+
+        embed['author']['name'] = _('{} by {}').format(hint.get_status_display(), hint.claimer)
+        embed['author']['url'] = hint.full_url()
+        embed['description'] = hint.response[:250]
+        job = {
+            'action': 'clear',
+            'hint_id': hint.id,
+            'content': hint.short_discord_message(),
+            'embed': embed,
+            'claimer': hint.claimer,
+        }
+        self.enqueue(job)
 
 discord_interface = DiscordInterface()
 
@@ -300,6 +358,16 @@ class TeamWebsocketConsumer(BroadcastWebsocketConsumer):
             '%s-%d' % (cls.group_id, team.user_id),
             {'type': 'channel.receive_broadcast', 'data': text_data})
 
+    @classmethod
+    def send_to_teams(cls, teams, text_data):
+        # Like send_to_team for each team, but in one trip to the event loop.
+        layer = get_channel_layer()
+        message = {'type': 'channel.receive_broadcast', 'data': text_data}
+        async def send():
+            for team in teams:
+                await layer.group_send('%s-%d' % (cls.group_id, team.user_id), message)
+        async_to_sync(send)()
+
 class TeamNotificationsConsumer(TeamWebsocketConsumer):
     group_id = 'team'
 
@@ -322,6 +390,9 @@ class AdminWebsocketConsumer(BroadcastWebsocketConsumer):
 class HintsConsumer(AdminWebsocketConsumer):
     group_id = 'hints'
 
+class GuessesConsumer(AdminWebsocketConsumer):
+    group_id = 'guesses'
+
 def show_unlock_notification(context, unlock):
     data = json.dumps({
         'title': str(unlock.puzzle),
@@ -334,6 +405,36 @@ def show_unlock_notification(context, unlock):
     messages.info(context.request, data)
     TeamNotificationsConsumer.send_to_team(unlock.team, data)
 
+def show_time_unlock_notification(teams, puzzles):
+    # For the scheduler; see scheduler.py.
+    if len(puzzles) == 1:
+        data = json.dumps({
+            'title': str(puzzles[0]),
+            'text': _('You’ve unlocked a new puzzle!'),
+            'link': reverse('puzzle', args=(puzzles[0].slug,)),
+        })
+    else:
+        data = json.dumps({
+            'title': _('New puzzles'),
+            'text': _('You’ve unlocked %d new puzzles!') % len(puzzles),
+            'link': reverse('puzzles'),
+        })
+    TeamNotificationsConsumer.send_to_teams(teams, data)
+
+def show_new_hints_notification(teams):
+    TeamNotificationsConsumer.send_to_teams(teams, json.dumps({
+        'title': _('Hints'),
+        'text': _('You’ve been given more hints!'),
+        'link': reverse('puzzles'),
+    }))
+
+def show_new_free_answers_notification(teams):
+    TeamNotificationsConsumer.send_to_teams(teams, json.dumps({
+        'title': _('Free answers'),
+        'text': _('You’ve been given more free answers!'),
+        'link': reverse('puzzles'),
+    }))
+
 def show_solve_notification(submission):
     if not submission.puzzle.is_meta or submission.puzzle.slug == META_META_SLUG:
         return
@@ -361,3 +462,15 @@ def show_hint_notification(hint):
         'link': reverse('hints', args=(hint.puzzle.slug,)),
     })
     TeamNotificationsConsumer.send_to_team(hint.team, data)
+
+def show_unclaimed_hints(count):
+    # Keeps the count in admins' nav bars up to date.
+    HintsConsumer.send_to_all(json.dumps({'unclaimed': count}))
+
+def show_wrong_answer(puzzle, answer, teams):
+    # For the staff page of common wrong answers.
+    GuessesConsumer.send_to_all(json.dumps({
+        'puzzle': puzzle.id,
+        'answer': answer,
+        'teams': teams,
+    }))
@@ -0,0 +1,292 @@
+# Per-request performance numbers, for the /metrics page. For a sample of
+# requests (METRICS_SAMPLE_RATE), metrics_middleware records wall time,
+# database queries and query time, cache hits and misses, and how many context
+# properties were computed. It keeps recent samples per URL name in memory,
+# along with a count of all requests.
+# Every so often each worker also copies its numbers to the shared cache, so
+# the page can combine all the workers' numbers. Requests that aren't sampled
+# cost one random() call.
+#
+# Other modules can count things against the current request with
+# count(name), which does nothing if the request isn't being sampled.
+#
+# With PROFILE_CONTEXT_CACHE on, sampled requests also profile each context
+# property they compute (see wrap_cacheable in context.py): how often, how
+# long it took and how many queries it made, including any properties it
+# used in turn, and what first asked for it. These are totalled per property
+# for the /metrics page and, with DEBUG on, sent back in a Server-Timing
+# header that the browser's dev tools can show.
+import collections
+import contextvars
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import connection
+
+from puzzles import surge
+
+# How many recent requests to keep per URL name, per worker.
+WINDOW = 1000
+# How often each worker copies its samples to the cache.
+PUBLISH_INTERVAL = 10  # seconds
+PUBLISH_TIMEOUT = 300  # seconds
+WORKERS_KEY = 'metrics-workers'
+
+FIELDS = ('time', 'queries', 'query_time', 'cache_hits', 'cache_misses', 'computations')
+
+_current = contextvars.ContextVar('metrics', default=None)
+_profile = contextvars.ContextVar('metrics-profile', default=None)
+_lock = threading.Lock()
+_samples = collections.defaultdict(lambda: collections.deque(maxlen=WINDOW))
+_totals = collections.Counter()
+# property => [requests, computations, seconds, queries, Counter of touchers]
+_properties = {}
+_published_at = 0
+_worker = '%d-%d' % (os.getpid(), random.getrandbits(32))
+_missing = object()
+
+
+def count(name, amount=1):
+    sample = _current.get()
+    if sample is not None:
+        sample[name] += amount
+
+
+def computing():
+    '''
+    Call just before computing a context property. Returns a token to pass to
+    computed() afterwards if the property should be profiled, or None.
+    '''
+    sample = _current.get()
+    if sample is None:
+        return None
+    sample['computations'] += 1
+    if _profile.get() is None:
+        return None
+    return time.perf_counter(), sample['queries']
+
+
+def computed(token, label, toucher):
+    '''
+    Records a property computation started with computing(). toucher is
+    called, only the first time label is computed in this request, to
+    describe what asked for it.
+    '''
+    start, queries = token
+    stats = _profile.get().get(label)
+    if stats is None:
+        stats = _profile.get()[label] = [0, 0, 0, toucher()]
+    stats[0] += 1
+    stats[1] += time.perf_counter() - start
+    stats[2] += _current.get()['queries'] - queries
+
+
+def _instrument_cache():
+    # Django's caches have no hooks, so wrap get and get_many on the
+    # configured caches, only for the instances that sampled requests use
+    # (Django keeps one per thread). The wrappers pass straight through
+    # outside a sampled request.
+    for alias in settings.CACHES:
+        instance = caches[alias]
+        if not getattr(instance, '_metrics_instrumented', False):
+            instance.get = _wrap_get(instance.get)
+            instance.get_many = _wrap_get_many(instance.get_many)
+            instance._metrics_instrumented = True
+
+
+def _wrap_get(get):
+    # Backends can take more arguments (django-redis has client), so pass on
+    # whatever we're given.
+    def counted_get(key, default=None, *args, **kwargs):
+        if _current.get() is None:
+            return get(key, default, *args, **kwargs)
+        value = get(key, _missing, *args, **kwargs)
+        if value is _missing:
+            count('cache_misses')
+            return default
+        count('cache_hits')
+        return value
+    return counted_get
+
+
+def _wrap_get_many(get_many):
+    def counted_get_many(keys, *args, **kwargs):
+        if _current.get() is None:
+            return get_many(keys, *args, **kwargs)
+        keys = list(keys)
+        # Don't count again if the backend implements get_many with get.
+        token = _current.set(None)
+        try:
+            values = get_many(keys, *args, **kwargs)
+        finally:
+            _current.reset(token)
+        count('cache_hits', len(values))
+        count('cache_misses', len(keys) - len(values))
+        return values
+    return counted_get_many
+
+
+def metrics_middleware(get_response):
+    def middleware(request):
+        if random.random() >= settings.METRICS_SAMPLE_RATE:
+            response = get_response(request)
+            with _lock:
+                _totals[_url_name(request)] += 1
+            return response
+        _instrument_cache()
+        sample = collections.Counter()
+        profile = {} if settings.PROFILE_CONTEXT_CACHE else None
+        token = _current.set(sample)
+        profile_token = _profile.set(profile)
+
+        def execute(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                sample['queries'] += 1
+                sample['query_time'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(execute):
+                response = get_response(request)
+        finally:
+            _current.reset(token)
+            _profile.reset(profile_token)
+        sample['time'] = time.perf_counter() - start
+        if profile and settings.DEBUG:
+            response['Server-Timing'] = _server_timing(sample, profile)
+        _record(_url_name(request), sample, profile)
+        return response
+    return middleware
+
+
+def _url_name(request):
+    match = request.resolver_match
+    return match.url_name if match and match.url_name else 'other'
+
+
+def _server_timing(sample, profile):
+    def entry(name, seconds, description):
+        description = description.replace('\\', '').replace('"', '')
+        return '%s;dur=%.1f;desc="%s"' % (name, seconds * 1000, description)
+    entries = [
+        entry('total', sample['time'], 'Total'),
+        entry('db', sample['query_time'], '%d queries' % sample['queries']),
+    ]
+    for label, (computes, seconds, queries, toucher) in sorted(
+            profile.items(), key=lambda item: -item[1][1]):
+        entries.append(entry(label, seconds, '%dx, %d queries, first by %s' % (
+            computes, queries, toucher)))
+    return ', '.join(entries)
+
+
+def _snapshot():
+    # Call with _lock held.
+    return {
+        'samples': {name: list(samples) for name, samples in _samples.items()},
+        'totals': dict(_totals),
+        'properties': {
+            label: stats[:4] + [dict(stats[4])] for label, stats in _properties.items()
+        },
+    }
+
+
+def _record(name, sample, profile):
+    global _published_at
+    with _lock:
+        _samples[name].append(tuple(sample[field] for field in FIELDS))
+        _totals[name] += 1
+        for label, (computes, seconds, queries, toucher) in (profile or {}).items():
+            stats = _properties.get(label)
+            if stats is None:
+                stats = _properties[label] = [0, 0, 0, 0, collections.Counter()]
+            stats[0] += 1
+            stats[1] += computes
+            stats[2] += seconds
+            stats[3] += queries
+            stats[4][toucher] += 1
+        now = time.monotonic()
+        if now - _published_at < PUBLISH_INTERVAL:
+            return
+        _published_at = now
+        data = _snapshot()
+    cache.set('metrics:%s' % _worker, data, PUBLISH_TIMEOUT)
+    workers = cache.get(WORKERS_KEY) or []
+    if _worker not in workers:
+        # Racy, but a worker that loses just adds itself next time.
+        cache.set(WORKERS_KEY, workers[-100:] + [_worker], None)
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summary():
+    '''
+    Combines every worker's recent samples into per-URL-name stats, and their
+    profiles into per-property stats, both sorted by total time spent.
+    '''
+    workers = cache.get(WORKERS_KEY) or []
+    data = cache.get_many(['metrics:%s' % worker for worker in workers])
+    with _lock:
+        # Our own numbers may be newer than what we last published.
+        data['metrics:%s' % _worker] = _snapshot()
+    samples = collections.defaultdict(list)
+    totals = collections.Counter()
+    properties = {}
+    for worker in data.values():
+        for name, rows in worker['samples'].items():
+            samples[name].extend(rows)
+        totals.update(worker['totals'])
+        for label, stats in worker.get('properties', {}).items():
+            combined = properties.setdefault(label, [0, 0, 0, 0, collections.Counter()])
+            for i in range(4):
+                combined[i] += stats[i]
+            combined[4].update(stats[4])
+
+    rows = []
+    for name, rows_for_name in samples.items():
+        columns = dict(zip(FIELDS, zip(*rows_for_name)))
+        times = sorted(columns['time'])
+        n = len(rows_for_name)
+        rows.append({
+            'name': name,
+            'requests': totals[name],
+            'sampled': n,
+            'p50_ms': _percentile(times, 0.5) * 1000,
+            'p95_ms': _percentile(times, 0.95) * 1000,
+            'p99_ms': _percentile(times, 0.99) * 1000,
+            'total_ms': sum(times) * 1000,
+            **{
+                'mean_' + field: sum(columns[field]) / n * (1000 if field == 'query_time' else 1)
+                for field in FIELDS[1:]
+            },
+        })
+    rows.sort(key=lambda row: -row['total_ms'])
+
+    property_rows = [{
+        'name': label,
+        'requests': requests,
+        'computations': computes,
+        'per_request': computes / requests,
+        'total_ms': seconds * 1000,
+        'mean_ms': seconds * 1000 / computes,
+        'mean_queries': queries / computes,
+        'touchers': [
+            {'name': name, 'requests': count} for name, count in touchers.most_common(3)
+        ],
+    } for label, (requests, computes, seconds, queries, touchers) in properties.items()]
+    property_rows.sort(key=lambda row: -row['total_ms'])
+    return {
+        'workers': len(data),
+        'sample_rate': settings.METRICS_SAMPLE_RATE,
+        'urls': rows,
+        'properties': property_rows,
+        'surge': surge.counts(),
+    }
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.23 on 2026-10-17 00:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puzzles', '0005_auto_20220903_1806'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='unlocks_valid_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Unlocks valid until'),
+        ),
+    ]
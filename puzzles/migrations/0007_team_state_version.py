@@ -0,0 +1,18 @@
+# Generated by Django 3.2.23 on 2026-10-17 00:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puzzles', '0006_team_unlocks_valid_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='state_version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='State version'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.2.23 on 2026-10-17 00:19
+
+from django.db import migrations, models
+import django.db.models.expressions
+import django.db.models.functions.comparison
+import puzzles.models
+
+from puzzles.hunt_config import HUNT_END_TIME, META_META_SLUG
+
+
+def fill_scoreboard(apps, schema_editor):
+    Team = apps.get_model('puzzles', 'Team')
+    AnswerSubmission = apps.get_model('puzzles', 'AnswerSubmission')
+    for team_id in Team.objects.values_list('id', flat=True):
+        Team.objects.filter(id=team_id).update(**AnswerSubmission.objects.filter(
+            team_id=team_id,
+            used_free_answer=False,
+            is_correct=True,
+            submitted_datetime__lt=HUNT_END_TIME,
+        ).aggregate(
+            total_solves=models.functions.Coalesce(models.Count('id'), 0),
+            last_solve_time=models.Max('submitted_datetime'),
+            metameta_solve_time=models.Min(models.Case(models.When(
+                puzzle__slug=META_META_SLUG, then='submitted_datetime'))),
+        ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puzzles', '0007_team_state_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='metameta_solve_time',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Metameta solve time'),
+        ),
+        migrations.AddField(
+            model_name='team',
+            name='total_solves',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Total solves'),
+        ),
+        migrations.AlterField(
+            model_name='team',
+            name='last_solve_time',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Last solve time'),
+        ),
+        migrations.AddIndex(
+            model_name='team',
+            index=models.Index(puzzles.models.IsNull('metameta_solve_time'), django.db.models.expressions.F('metameta_solve_time'), django.db.models.expressions.OrderBy(django.db.models.expressions.F('total_solves'), descending=True), django.db.models.functions.comparison.Coalesce('last_solve_time', 'creation_time'), name='puzzles_team_leaderboard'),
+        ),
+        migrations.RunPython(fill_scoreboard, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 3.2.23 on 2026-10-17 00:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from puzzles.hunt_config import HUNT_END_TIME
+
+
+def fill_stats(apps, schema_editor):
+    Puzzle = apps.get_model('puzzles', 'Puzzle')
+    PuzzleStats = apps.get_model('puzzles', 'PuzzleStats')
+    AnswerSubmission = apps.get_model('puzzles', 'AnswerSubmission')
+    Hint = apps.get_model('puzzles', 'Hint')
+    stats = {
+        puzzle_id: PuzzleStats(puzzle_id=puzzle_id)
+        for puzzle_id in Puzzle.objects.values_list('id', flat=True)
+    }
+    for row in AnswerSubmission.objects.filter(
+        used_free_answer=False,
+        team__is_hidden=False,
+        submitted_datetime__lt=HUNT_END_TIME,
+    ).values('puzzle_id').annotate(
+        solves=models.Count('id', filter=models.Q(is_correct=True)),
+        guesses=models.Count('id'),
+        guess_teams=models.Count('team_id', distinct=True),
+    ):
+        stats[row['puzzle_id']].solves = row['solves']
+        stats[row['puzzle_id']].guesses = row['guesses']
+        stats[row['puzzle_id']].guess_teams = row['guess_teams']
+    for row in Hint.objects.filter(team__is_hidden=False).values('puzzle_id').annotate(
+        hints=models.Count('id'),
+    ):
+        stats[row['puzzle_id']].hints = row['hints']
+    PuzzleStats.objects.bulk_create(stats.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puzzles', '0008_team_scoreboard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PuzzleStats',
+            fields=[
+                ('puzzle', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='puzzles.puzzle', verbose_name='puzzle')),
+                ('solves', models.PositiveIntegerField(default=0, verbose_name='Solves')),
+                ('guesses', models.PositiveIntegerField(default=0, verbose_name='Guesses')),
+                ('guess_teams', models.PositiveIntegerField(default=0, verbose_name='Guessing teams')),
+                ('hints', models.PositiveIntegerField(default=0, verbose_name='Hints')),
+            ],
+            options={
+                'verbose_name': 'puzzle stats',
+                'verbose_name_plural': 'puzzle stats',
+            },
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.23 on 2026-10-17 00:28
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puzzles', '0009_puzzlestats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('DIS', 'Discord'), ('EML', 'Email')], max_length=3, verbose_name='Kind')),
+                ('destination', models.CharField(blank=True, max_length=255, verbose_name='Destination')),
+                ('payload', models.TextField(verbose_name='Payload')),
+                ('created_datetime', models.DateTimeField(auto_now_add=True, verbose_name='Created datetime')),
+                ('next_attempt_datetime', models.DateTimeField(blank=True, db_index=True, default=django.utils.timezone.now, null=True, verbose_name='Next attempt datetime')),
+                ('sent_datetime', models.DateTimeField(blank=True, null=True, verbose_name='Sent datetime')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Attempts')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last error')),
+            ],
+            options={
+                'verbose_name': 'outbound message',
+                'verbose_name_plural': 'outbound messages',
+            },
+        ),
+    ]
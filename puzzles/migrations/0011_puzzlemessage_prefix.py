@@ -0,0 +1,18 @@
+# Generated by Django 3.2.23 on 2026-10-17 00:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puzzles', '0010_outboundmessage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='puzzlemessage',
+            name='guess',
+            field=models.CharField(help_text='End with * to match every guess that starts with this', max_length=255, verbose_name='Guess'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.23 on 2026-10-17 01:07
+
+from django.db import migrations, models
+
+
+def fill_allowances(apps, schema_editor):
+    Team = apps.get_model('puzzles', 'Team')
+    Hint = apps.get_model('puzzles', 'Hint')
+    AnswerSubmission = apps.get_model('puzzles', 'AnswerSubmission')
+    for team_id in Team.objects.values_list('id', flat=True):
+        Team.objects.filter(id=team_id).update(
+            hints_used=Hint.objects.filter(team_id=team_id, is_followup=False)
+            .exclude(status__in=('REF', 'OBS')).count(),
+            free_answers_used=AnswerSubmission.objects.filter(
+                team_id=team_id, used_free_answer=True).count(),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puzzles', '0011_puzzlemessage_prefix'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='free_answers_used',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Free answers used'),
+        ),
+        migrations.AddField(
+            model_name='team',
+            name='hints_used',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Hints used'),
+        ),
+        migrations.RunPython(fill_allowances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.23 on 2026-10-17 01:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puzzles', '0012_team_allowances'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboundmessage',
+            name='kind',
+            field=models.CharField(choices=[('DIS', 'Discord'), ('EML', 'Email'), ('HNT', 'Hint')], max_length=3, verbose_name='Kind'),
+        ),
+    ]
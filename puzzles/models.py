@@ -1,5 +1,6 @@
 import collections
 import datetime
+import itertools
 import re
 import unicodedata
 from urllib.parse import quote
@@ -8,15 +9,22 @@ from django import forms
 from django.core.exceptions import ValidationError
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models import F, FilteredRelation, Q, Case, When, Count, Min
-from django.db.models.functions import Coalesce
-from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import F, Func, Q, Case, When, BooleanField, Count, Exists, IntegerField, Max, Min, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.translation import gettext as _
 
+from puzzles import bigboard
+from puzzles import catalog
+from puzzles import guesses
+from puzzles import puzzle_views
+from puzzles import ranking
+from puzzles import surge
 from puzzles.context import context_cache
 
 from puzzles.messaging import (
@@ -28,6 +36,8 @@ from puzzles.messaging import (
     show_unlock_notification,
     show_solve_notification,
     show_hint_notification,
+    show_unclaimed_hints,
+    show_wrong_answer,
 )
 
 from puzzles.hunt_config import (
@@ -47,6 +57,26 @@ from puzzles.hunt_config import (
     META_META_SLUG,
 )
 
+class IsNull(Func):
+    '''
+    Like __isnull, but usable in ORDER BY and index expressions. SQLite can't
+    index "NULLS LAST", so sort by this first instead.
+    '''
+    template = '%(expressions)s IS NULL'
+    output_field = BooleanField()
+
+
+# How long Team.snapshot keeps a team's progress in the cache. Snapshots are
+# never updated in place, so this only bounds how long stale ones stick around.
+TEAM_SNAPSHOT_TIMEOUT = 60 * 60
+# (Change the version when changing what's in one.)
+TEAM_SNAPSHOT_KEY = 'team-snapshot:v3:%d:%d'
+
+# How many hints (free answers) teams get in total after each interval (day);
+# the first entry is for before the first one.
+HINTS_BY_INTERVAL = (0, *itertools.accumulate(HINTS_PER_INTERVAL))
+FREE_ANSWERS_BY_DAY = (0, *itertools.accumulate(FREE_ANSWERS_PER_DAY))
+
 
 class Round(models.Model):
     name = models.CharField(max_length=255, verbose_name=_('Name'))
@@ -197,7 +227,22 @@ class Team(models.Model):
         top of the default amount per day)'''),
     )
 
-    last_solve_time = models.DateTimeField(null=True, blank=True, verbose_name=_('Last solve time'))
+    # How many hints and free answers the team has used, kept up to date as
+    # hints and submissions change; see update_allowances.
+    hints_used = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('Hints used'))
+    free_answers_used = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('Free answers used'))
+
+    # The leaderboard columns, kept up to date as answers are submitted; see
+    # update_scoreboard. Only non-free correct answers before the hunt ends
+    # count.
+    total_solves = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('Total solves'))
+    last_solve_time = models.DateTimeField(
+        null=True, blank=True, editable=False, verbose_name=_('Last solve time'))
+    metameta_solve_time = models.DateTimeField(
+        null=True, blank=True, editable=False, verbose_name=_('Metameta solve time'))
 
     is_prerelease_testsolver = models.BooleanField(
         default=False, verbose_name=_('Is prerelease testsolver'),
@@ -210,13 +255,73 @@ class Team(models.Model):
         help_text=_('If a team is hidden, it will not be visible to the public')
     )
 
+    # The team's PuzzleUnlocks are known to be up to date until this time (the
+    # next time unlock). See compute_unlocks and invalidate_unlocks.
+    unlocks_valid_until = models.DateTimeField(
+        null=True, blank=True, editable=False, verbose_name=_('Unlocks valid until'))
+
+    # Incremented whenever anything in the team's snapshot changes.
+    state_version = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_('State version'))
+
+    # These are only ever written with UPDATE queries, so that saving a Team
+    # that was loaded a while ago doesn't overwrite newer values.
+    # Awards are changed with award (the admin does too), so that concurrent
+    # awards add up.
+    DERIVED_FIELDS = (
+        'total_hints_awarded',
+        'total_free_answers_awarded',
+        'hints_used',
+        'free_answers_used',
+        'unlocks_valid_until',
+        'state_version',
+        'total_solves',
+        'last_solve_time',
+        'metameta_solve_time',
+    )
+
+    # The order of teams on the leaderboard, with ties broken arbitrarily.
+    LEADERBOARD_ORDERING = (
+        IsNull('metameta_solve_time').asc(),
+        F('metameta_solve_time').asc(),
+        F('total_solves').desc(),
+        Coalesce('last_solve_time', 'creation_time').asc(),
+    )
+
     class Meta:
         verbose_name = _('team')
         verbose_name_plural = _('teams')
+        indexes = [
+            models.Index(
+                IsNull('metameta_solve_time'),
+                F('metameta_solve_time'),
+                F('total_solves').desc(),
+                Coalesce('last_solve_time', 'creation_time'),
+                name='puzzles_team_leaderboard',
+            ),
+        ]
 
     def __str__(self):
         return self.team_name
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        hidden_changed = False
+        if not self._state.adding:
+            if update_fields is None:
+                update_fields = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name not in Team.DERIVED_FIELDS
+                ]
+            # Puzzle stats only count visible teams, so they need recomputing
+            # when that changes. This is rare enough to just redo them all.
+            hidden_changed = 'is_hidden' in update_fields and Team.objects.filter(
+                id=self.id).exclude(is_hidden=self.is_hidden).exists()
+        super().save(force_insert, force_update, using, update_fields)
+        if hidden_changed:
+            PuzzleStats.recompute()
+            bigboard.reset()
+            guesses.reset()
+
     def get_emails(self, with_names=False):
         return [
             ((member.email, str(member)) if with_names else member.email)
@@ -224,19 +329,23 @@ class Team(models.Model):
         ]
 
     def puzzle_submissions(self, puzzle):
-        return [
-            submission for submission in self.submissions
-            if submission.puzzle == puzzle
-        ]
+        return self.snapshot['submissions_by_puzzle'].get(puzzle.id, ())
+
+    def tried_answers(self, puzzle):
+        '''The answers the team has submitted for the puzzle, as a set.'''
+        return self.snapshot['answers_by_puzzle'].get(puzzle.id, frozenset())
+
+    def hints_by_puzzle(self):
+        return self.snapshot['hints_by_puzzle']
+
+    def puzzle_hints(self, puzzle):
+        return self.hints_by_puzzle.get(puzzle.id, ())
 
     def puzzle_answer(self, puzzle):
         return puzzle.answer if puzzle.id in self.solves else None
 
     def num_wrong_guesses(self, puzzle):
-        return sum(
-            1 for submission in self.puzzle_submissions(puzzle)
-            if not submission.is_correct
-        )
+        return self.snapshot['wrong_guesses'].get(puzzle.id, 0)
 
     def num_extra_guesses(self, puzzle):
         return self.extra_guesses.get(puzzle.slug, 0)
@@ -278,12 +387,9 @@ class Team(models.Model):
     def leaderboard_teams(current_team, hide_hidden=True):
         '''
         Returns a (lazy, not-yet-evaluated) QuerySet of teams, in the order
-        they should appear on the leaderboard, with the following annotations:
-          - 'total_solves': number of solves (before hunt end)
+        they should appear on the leaderboard, with the following annotation:
           - 'last_solve_or_creation_time': last non-free solve (before hunt
             end), or if none, team creation time
-          - 'metameta_solve_time': time of finishing the hunt (if before hunt
-            end)
 
         This depends on the viewing team for hidden teams.
         '''
@@ -301,33 +407,12 @@ class Team(models.Model):
 
         all_teams = Team.objects.filter(q, creation_time__lt=HUNT_END_TIME)
 
-        # https://docs.djangoproject.com/en/3.1/ref/models/querysets/#filteredrelation-objects
-        # FilteredRelation does a LEFT OUTER JOIN with additional conditions in
-        # the ON clause, so every team survives; the other stuff aggregates it
+        # The totals are denormalized onto the team (see update_scoreboard),
+        # so this is a scan of the leaderboard index.
         all_teams = all_teams.annotate(
-            scoring_submissions=FilteredRelation(
-                'answersubmission',
-                condition=Q(
-                    answersubmission__used_free_answer=False,
-                    answersubmission__is_correct=True,
-                    answersubmission__submitted_datetime__lt=HUNT_END_TIME,
-                )
-            ),
-            total_solves=Count('scoring_submissions'),
-            metameta_solve_time=Min(Case(
-                When(
-                    scoring_submissions__puzzle__slug=META_META_SLUG,
-                    then='scoring_submissions__submitted_datetime',
-                )
-                # else, null by default
-            )),
             # Coalesce(things) = the first of things that isn't null
             last_solve_or_creation_time=Coalesce('last_solve_time', 'creation_time'),
-        ).order_by(
-            F('metameta_solve_time').asc(nulls_last=True),
-            F('total_solves').desc(),
-            F('last_solve_or_creation_time'),
-        )
+        ).order_by(*Team.LEADERBOARD_ORDERING)
 
         return all_teams
 
@@ -368,11 +453,168 @@ class Team(models.Model):
         #     )
         # )
 
+    def is_on_leaderboard(self, current_team, hide_hidden=True):
+        '''Whether this team is in leaderboard_teams(current_team, hide_hidden).'''
+        if self.creation_time >= HUNT_END_TIME:
+            return False
+        return not (hide_hidden and self.is_hidden and self != current_team)
+
+    @staticmethod
+    def leaderboard_ahead_of(team):
+        '''
+        A filter for leaderboard_teams matching the teams strictly ahead of the
+        given one (not counting teams tied with it).
+        '''
+        tiebreak = Q(last_solve_or_creation_time__lt=team.last_solve_time or team.creation_time)
+        ahead = Q(total_solves__gt=team.total_solves) | Q(total_solves=team.total_solves) & tiebreak
+        if team.metameta_solve_time is None:
+            return Q(metameta_solve_time__isnull=False) | Q(metameta_solve_time__isnull=True) & ahead
+        return (
+            Q(metameta_solve_time__lt=team.metameta_solve_time) |
+            Q(metameta_solve_time=team.metameta_solve_time) & ahead
+        )
+
+    def leaderboard_rank(self, current_team, hide_hidden=True):
+        '''
+        Returns this team's 1-indexed position in leaderboard_teams, or None if
+        it isn't on that leaderboard. Tied teams share a rank. Prefer
+        puzzles.ranking.get_rank, which avoids the query when it can.
+        '''
+        if not self.is_on_leaderboard(current_team, hide_hidden):
+            return None
+        return Team.leaderboard_teams(current_team, hide_hidden).filter(
+            Team.leaderboard_ahead_of(self)).count() + 1
+
+    @staticmethod
+    def update_scoreboard(team_ids):
+        '''Recomputes the leaderboard columns of the given teams from scratch.'''
+        for team_id in team_ids:
+            Team.objects.filter(id=team_id).update(**AnswerSubmission.objects.filter(
+                team_id=team_id,
+                used_free_answer=False,
+                is_correct=True,
+                submitted_datetime__lt=HUNT_END_TIME,
+            ).aggregate(
+                total_solves=Coalesce(Count('id'), 0),
+                last_solve_time=Max('submitted_datetime'),
+                metameta_solve_time=Min(Case(When(
+                    puzzle__slug=META_META_SLUG, then='submitted_datetime'))),
+            ))
+
+    @staticmethod
+    def update_allowances(team_ids):
+        '''Recounts the hints and free answers the given teams have used.'''
+        Team.objects.filter(id__in=team_ids).update(
+            hints_used=Coalesce(Subquery(
+                Hint.objects.filter(team_id=OuterRef('id'), is_followup=False)
+                .exclude(status__in=(Hint.REFUNDED, Hint.OBSOLETE))
+                .values('team_id').annotate(count=Count('id')).values('count')
+            ), 0),
+            free_answers_used=Coalesce(Subquery(
+                AnswerSubmission.objects.filter(team_id=OuterRef('id'), used_free_answer=True)
+                .values('team_id').annotate(count=Count('id')).values('count')
+            ), 0),
+        )
+
+    @staticmethod
+    def award(teams, hints=0, free_answers=0):
+        '''
+        Gives the given QuerySet of teams this many more hints and free answers
+        (or takes them away, if negative).
+        '''
+        teams.update(
+            total_hints_awarded=F('total_hints_awarded') + hints,
+            total_free_answers_awarded=F('total_free_answers_awarded') + free_answers,
+        )
+
     def team(self):
         return self
 
+    def snapshot(self):
+        '''
+        The team's submissions, hints, unlocks and extra guesses, as compact
+        rows (see Row), shared across requests through the cache. The key
+        includes state_version, which is bumped whenever any of these change,
+        so an out-of-date snapshot is never read again and just expires. The
+        submissions and hints are also indexed by puzzle (see
+        index_by_puzzle), so that looking up a puzzle's doesn't go through all
+        of them.
+        '''
+        key = TEAM_SNAPSHOT_KEY % (self.id, self.state_version)
+        snapshot = cache.get(key)
+        if snapshot is None:
+            snapshot = {
+                'submissions': SubmissionRow.load(
+                    self.answersubmission_set.order_by('-submitted_datetime')),
+                'asked_hints': HintRow.load(self.hint_set.all()),
+                'db_unlocks': {
+                    unlock.puzzle_id: unlock
+                    for unlock in UnlockRow.load(self.puzzleunlock_set.all())
+                },
+                'extra_guesses': {
+                    grant.puzzle.slug: grant.extra_guesses
+                    for grant in self.extraguessgrant_set.select_related('puzzle')
+                },
+            }
+            Team.index_by_puzzle(snapshot)
+            cache.set(key, snapshot, TEAM_SNAPSHOT_TIMEOUT)
+        return snapshot
+
+    def record_puzzle_view(self, unlock, now):
+        '''
+        Marks the unlock as viewed. The database is updated shortly (see
+        puzzle_views.py).
+        '''
+        unlock.view_datetime = now
+        puzzle_views.record(unlock)
+        self.unviewed_puzzles.discard(unlock.puzzle_id)
+
+    def unviewed_puzzles(self):
+        '''The ids of the puzzles the team has unlocked but not opened yet.'''
+        unviewed = {
+            puzzle_id for (puzzle_id, unlock) in self.db_unlocks.items()
+            if not unlock.view_datetime
+        }
+        if unviewed:
+            unviewed -= puzzle_views.recorded(self.id, unviewed)
+        return unviewed
+
+    @staticmethod
+    def index_by_puzzle(snapshot):
+        '''
+        Adds to a snapshot, from puzzle ids to each puzzle's:
+        - submissions_by_puzzle: submissions, newest first, as in submissions
+        - wrong_guesses: number of wrong ones
+        - answers_by_puzzle: set of submitted answers
+        - hints_by_puzzle: hints, as in asked_hints
+        Puzzles without any are left out.
+        '''
+        submissions = collections.defaultdict(list)
+        wrong_guesses = collections.Counter()
+        answers = collections.defaultdict(set)
+        for submission in snapshot['submissions']:
+            submissions[submission.puzzle_id].append(submission)
+            answers[submission.puzzle_id].add(submission.submitted_answer)
+            if not submission.is_correct:
+                wrong_guesses[submission.puzzle_id] += 1
+        hints = collections.defaultdict(list)
+        for hint in snapshot['asked_hints']:
+            hints[hint.puzzle_id].append(hint)
+        # Plain dicts, so that looking up a missing puzzle doesn't add it.
+        snapshot['submissions_by_puzzle'] = {
+            puzzle_id: tuple(value) for (puzzle_id, value) in submissions.items()}
+        snapshot['wrong_guesses'] = dict(wrong_guesses)
+        snapshot['answers_by_puzzle'] = {
+            puzzle_id: frozenset(value) for (puzzle_id, value) in answers.items()}
+        snapshot['hints_by_puzzle'] = {
+            puzzle_id: tuple(value) for (puzzle_id, value) in hints.items()}
+
+    @staticmethod
+    def invalidate_snapshot(team_id):
+        Team.objects.filter(id=team_id).update(state_version=F('state_version') + 1)
+
     def asked_hints(self):
-        return tuple(self.hint_set.select_related('puzzle', 'puzzle__round'))
+        return self.snapshot['asked_hints']
 
     def num_hints_total(self):
         '''
@@ -384,15 +626,17 @@ class Team(models.Model):
         if self.now < self.creation_time + TEAM_AGE_BEFORE_HINTS:
             return self.total_hints_awarded
         intervals = max(0, (self.now - (HINT_TIME - self.start_offset)) // HINT_INTERVAL + 1)
-        return self.total_hints_awarded + sum(HINTS_PER_INTERVAL[:intervals])
+        return self.total_hints_awarded + HINTS_BY_INTERVAL[min(intervals, len(HINTS_PER_INTERVAL))]
 
     def num_hints_used(self):
-        return sum(hint.consumes_hint for hint in self.asked_hints)
+        return self.hints_used
 
     def num_hints_remaining(self):
         return self.num_hints_total - self.num_hints_used
 
     def num_intro_hints_used(self):
+        if not INTRO_HINTS:
+            return 0
         return min(INTRO_HINTS, sum(hint.consumes_hint for hint in
             self.asked_hints if hint.puzzle.round.slug == INTRO_ROUND_SLUG))
 
@@ -408,29 +652,19 @@ class Team(models.Model):
         if self.now < self.creation_time + TEAM_AGE_BEFORE_FREE_ANSWERS:
             return self.total_free_answers_awarded
         days = max(0, (self.now - (FREE_ANSWER_TIME - self.start_offset)).days + 1)
-        return self.total_free_answers_awarded + sum(FREE_ANSWERS_PER_DAY[:days])
+        return self.total_free_answers_awarded + FREE_ANSWERS_BY_DAY[min(days, len(FREE_ANSWERS_PER_DAY))]
 
     def num_free_answers_used(self):
-        return sum(
-            1 for submission in self.submissions
-            if submission.used_free_answer
-        )
+        return self.free_answers_used
 
     def num_free_answers_remaining(self):
         return self.num_free_answers_total - self.num_free_answers_used
 
     def extra_guesses(self):
-        return {
-            grant.puzzle.slug: grant.extra_guesses
-            for grant in self.extraguessgrant_set.select_related('puzzle')
-        }
+        return self.snapshot['extra_guesses']
 
     def submissions(self):
-        return tuple(
-            self.answersubmission_set
-            .select_related('puzzle', 'puzzle__round')
-            .order_by('-submitted_datetime')
-        )
+        return self.snapshot['submissions']
 
     def solves(self):
         return {
@@ -440,10 +674,12 @@ class Team(models.Model):
         }
 
     def db_unlocks(self):
+        # The scheduler inserts time unlocks a little before they're due (see
+        # scheduler.py), so leave out any that aren't yet.
         return {
-            unlock.puzzle_id: unlock
-            for unlock in self.puzzleunlock_set
-            .select_related('puzzle', 'puzzle__round')
+            puzzle_id: unlock
+            for (puzzle_id, unlock) in self.snapshot['db_unlocks'].items()
+            if unlock.unlock_datetime <= self.now
         }
 
     def main_round_solves(self):
@@ -460,22 +696,49 @@ class Team(models.Model):
 
     @staticmethod
     def compute_unlocks(context):
+        '''
+        Returns an OrderedDict from each puzzle the context has access to, in
+        order, to the time it was unlocked.
+
+        For teams, everything this unlocks is persisted as a PuzzleUnlock, so
+        after running the full computation once, we remember (in
+        unlocks_valid_until) when the next time unlock is due. Until then, the
+        team's PuzzleUnlocks are the answer, unless something that could
+        unlock more puzzles happens first (a solve, or a change to the puzzles
+        or the team), which calls invalidate_unlocks.
+        '''
+
+        if context.hunt_is_prereleased or context.hunt_is_over:
+            return collections.OrderedDict(
+                (puzzle, context.start_time) for puzzle in context.all_puzzles)
+
+        team = context.team
+        valid_until = team.unlocks_valid_until if team else None
+        if valid_until and context.now < valid_until:
+            surge.record(context, True)
+            return collections.OrderedDict(
+                (puzzle, team.db_unlocks[puzzle.id].unlock_datetime)
+                for puzzle in context.all_puzzles if puzzle.id in team.db_unlocks)
+
+        if team:
+            surge.record(context, False)
         metas_solved = []
         puzzles_unlocked = collections.OrderedDict()
         unlocks = []
+        next_unlock_time = context.end_time
         for puzzle in context.all_puzzles:
             unlocked_at = None
             if 0 <= puzzle.unlock_hours and (
                 puzzle.unlock_hours == 0 or
-                not context.team or
-                context.team.allow_time_unlocks):
+                not team or
+                team.allow_time_unlocks):
                 unlock_time = context.start_time + datetime.timedelta(hours=puzzle.unlock_hours)
                 if unlock_time <= context.now:
                     unlocked_at = unlock_time
-            if context.hunt_is_prereleased or context.hunt_is_over:
-                unlocked_at = context.start_time
-            elif context.team:
-                (global_solves, local_solves) = context.team.main_round_solves
+                else:
+                    next_unlock_time = min(next_unlock_time, unlock_time)
+            if team:
+                (global_solves, local_solves) = team.main_round_solves
                 if 0 <= puzzle.unlock_global <= global_solves and (global_solves or any(metas_solved)):
                     unlocked_at = context.now
                 if 0 <= puzzle.unlock_local <= local_solves[puzzle.round.slug]:
@@ -483,17 +746,43 @@ class Team(models.Model):
                 if puzzle.slug == META_META_SLUG and all(metas_solved):
                     unlocked_at = context.now
                 if puzzle.is_meta:
-                    metas_solved.append(puzzle.id in context.team.solves)
-                if puzzle.id in context.team.db_unlocks:
-                    unlocked_at = context.team.db_unlocks[puzzle.id].unlock_datetime
+                    metas_solved.append(puzzle.id in team.solves)
+                if puzzle.id in team.db_unlocks:
+                    unlocked_at = team.db_unlocks[puzzle.id].unlock_datetime
                 elif unlocked_at:
                     unlocks.append(Team.unlock_puzzle(context, puzzle, unlocked_at))
             if unlocked_at:
                 puzzles_unlocked[puzzle] = unlocked_at
         if unlocks:
             PuzzleUnlock.objects.bulk_create(unlocks, ignore_conflicts=True)
+            # If the scheduler already inserted a later time unlock for any of
+            # these, that row is the one that stuck, so move it up.
+            for unlock in unlocks:
+                if unlock.puzzle_id in team.snapshot['db_unlocks']:
+                    PuzzleUnlock.objects.filter(
+                        team=team, puzzle_id=unlock.puzzle_id,
+                        unlock_datetime__gt=unlock.unlock_datetime,
+                    ).update(unlock_datetime=unlock.unlock_datetime)
+            Team.invalidate_snapshot(team.id)
+            for unlock in unlocks:
+                bigboard.record('unlock', team.is_hidden, team.id, unlock.puzzle_id)
+        if team:
+            # Only record this if nothing invalidated the unlocks since we
+            # loaded the team; otherwise we might be missing a new solve.
+            if Team.objects.filter(id=team.id, unlocks_valid_until=valid_until).update(
+                unlocks_valid_until=next_unlock_time):
+                team.unlocks_valid_until = next_unlock_time
         return puzzles_unlocked
 
+    @staticmethod
+    def invalidate_unlocks(teams):
+        '''
+        Makes the given QuerySet of teams recompute their unlocks on their next
+        request. This sets a past time rather than None so that a computation
+        that's already in progress can tell it's out of date.
+        '''
+        teams.update(unlocks_valid_until=timezone.now())
+
     @staticmethod
     def unlock_puzzle(context, puzzle, unlocked_at):
         unlock = PuzzleUnlock(
@@ -511,6 +800,26 @@ def notify_on_team_creation(sender, instance, created, **kwargs):
     if created:
         dispatch_general_alert(_('Team created: {}').format(instance.team_name))
 
+@receiver(post_save, sender=Team)
+def invalidate_unlocks_on_team_update(sender, instance, created, update_fields, **kwargs):
+    # Changing start_offset, allow_time_unlocks, or is_prerelease_testsolver
+    # (e.g. through the admin or the shortcuts) can change what's unlocked.
+    if not created and (update_fields is None or not update_fields.isdisjoint(
+        ('start_offset', 'allow_time_unlocks', 'is_prerelease_testsolver'))):
+        Team.invalidate_unlocks(Team.objects.filter(id=instance.id))
+
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+def update_ranking_on_team_update(sender, instance, **kwargs):
+    ranking.update_team(instance.id)
+
+@receiver(post_save, sender=Round)
+@receiver(post_delete, sender=Round)
+@receiver(post_save, sender=Puzzle)
+@receiver(post_delete, sender=Puzzle)
+def invalidate_unlocks_on_puzzle_update(sender, instance, **kwargs):
+    Team.invalidate_unlocks(Team.objects.all())
+
 
 class TeamMember(models.Model):
     '''A person on a team.'''
@@ -555,6 +864,11 @@ class PuzzleUnlock(models.Model):
         verbose_name_plural = _('puzzle unlocks')
 
 
+@receiver(post_delete, sender=PuzzleUnlock)
+def invalidate_unlocks_on_unlock_deletion(sender, instance, **kwargs):
+    Team.invalidate_unlocks(Team.objects.filter(id=instance.team_id))
+
+
 class AnswerSubmission(models.Model):
     '''Represents a team making a solve attempt on a puzzle (right or wrong).'''
 
@@ -577,8 +891,43 @@ class AnswerSubmission(models.Model):
         verbose_name = _('answer submission')
         verbose_name_plural = _('answer submissions')
 
+    @property
+    def is_scoring(self):
+        '''Whether this counts towards the team's leaderboard position.'''
+        return (
+            self.is_correct and not self.used_free_answer and
+            self.submitted_datetime < HUNT_END_TIME
+        )
 
 
+@receiver(post_save, sender=AnswerSubmission)
+def update_scoreboard_on_submission(sender, instance, created, **kwargs):
+    if not created:
+        Team.update_scoreboard([instance.team_id])
+        ranking.update_team(instance.team_id)
+    elif instance.is_scoring:
+        solve_time = Value(instance.submitted_datetime)
+        updates = {
+            'total_solves': F('total_solves') + 1,
+            'last_solve_time': Greatest(Coalesce('last_solve_time', solve_time), solve_time),
+        }
+        if instance.puzzle_id == catalog.get_catalog().meta_meta_id:
+            updates['metameta_solve_time'] = solve_time
+        Team.objects.filter(id=instance.team_id).update(**updates)
+        ranking.update_team(instance.team_id)
+
+@receiver(post_delete, sender=AnswerSubmission)
+def update_scoreboard_on_submission_deletion(sender, instance, **kwargs):
+    if instance.is_scoring:
+        Team.update_scoreboard([instance.team_id])
+        ranking.update_team(instance.team_id)
+
+
+@receiver(post_save, sender=AnswerSubmission)
+def invalidate_unlocks_on_solve(sender, instance, created, **kwargs):
+    if created and instance.is_correct:
+        Team.invalidate_unlocks(Team.objects.filter(id=instance.team_id))
+
 @receiver(post_save, sender=AnswerSubmission)
 def notify_on_answer_submission(sender, instance, created, **kwargs):
     if created:
@@ -599,7 +948,8 @@ def notify_on_answer_submission(sender, instance, created, **kwargs):
                 if hours:
                     parts[1] = _('%dh') % hours
             return _(' {} ago').format(''.join(parts))
-        hints = Hint.objects.filter(team=instance.team, puzzle=instance.puzzle)
+        # From the team's snapshot, which the submit view has usually loaded.
+        hints = instance.team.puzzle_hints(instance.puzzle)
         hint_line = ''
         if len(hints):
             hint_line = _('\nHints:') + ','.join('%s (%s%s)' % (
@@ -612,12 +962,7 @@ def notify_on_answer_submission(sender, instance, created, **kwargs):
                 _(':question: {} Team {} used a free answer on {}!{}').format(
                     instance.puzzle.emoji, instance.team, instance.puzzle, hint_line))
         else:
-            submitted_teams = AnswerSubmission.objects.filter(
-                puzzle=instance.puzzle,
-                submitted_answer=instance.submitted_answer,
-                used_free_answer=False,
-                team__is_hidden=False,
-            ).values_list('team_id', flat=True).distinct().count()
+            submitted_teams = guesses.record(instance)
             sigil = ':x:'
             if instance.is_correct:
                 sigil = {
@@ -634,6 +979,9 @@ def notify_on_answer_submission(sender, instance, created, **kwargs):
                 ),
                 correct=instance.is_correct)
         if not instance.is_correct:
+            if not instance.used_free_answer and not instance.team.is_hidden:
+                transaction.on_commit(lambda: show_wrong_answer(
+                    instance.puzzle, instance.submitted_answer, submitted_teams))
             return
         show_solve_notification(instance)
         obsoleted_hints = Hint.objects.filter(
@@ -674,7 +1022,9 @@ class PuzzleMessage(models.Model):
 
     puzzle = models.ForeignKey(Puzzle, on_delete=models.CASCADE, verbose_name=_('puzzle'))
 
-    guess = models.CharField(max_length=255, verbose_name=_('Guess'))
+    guess = models.CharField(
+        max_length=255, verbose_name=_('Guess'),
+        help_text=_('End with * to match every guess that starts with this'))
     response = models.TextField(verbose_name=_('Response'))
 
     class Meta:
@@ -688,6 +1038,10 @@ class PuzzleMessage(models.Model):
     def semicleaned_guess(self):
         return PuzzleMessage.semiclean_guess(self.guess)
 
+    @property
+    def is_prefix(self):
+        return self.guess.rstrip().endswith('*')
+
     @staticmethod
     def semiclean_guess(s):
         if s is None: return s
@@ -722,18 +1076,6 @@ class Erratum(models.Model):
         return self.updates_text.replace('$PUZZLE', '<a href="%s">%s</a>' % (
             reverse('puzzle', args=(self.puzzle.slug,)), self.puzzle))
 
-    @staticmethod
-    def get_visible_errata(context):
-        errata = []
-        for erratum in Erratum.objects.select_related('puzzle').order_by('timestamp'):
-            if not context.is_superuser:
-                if not erratum.published:
-                    continue
-                if erratum.puzzle and erratum.puzzle not in context.unlocks and not (context.team and erratum.puzzle_id in context.team.db_unlocks):
-                    continue
-            errata.append(erratum)
-        return errata
-
     def get_emails(self):
         unlocks = set(PuzzleUnlock.objects.filter(puzzle=self.puzzle).exclude(view_datetime=None).values_list('team_id', flat=True))
         solves = set(AnswerSubmission.objects.filter(puzzle=self.puzzle, is_correct=True).values_list('team_id', flat=True))
@@ -744,6 +1086,18 @@ class Erratum(models.Model):
         verbose_name_plural = _('errata')
 
 
+@receiver(post_save, sender=Round)
+@receiver(post_delete, sender=Round)
+@receiver(post_save, sender=Puzzle)
+@receiver(post_delete, sender=Puzzle)
+@receiver(post_save, sender=PuzzleMessage)
+@receiver(post_delete, sender=PuzzleMessage)
+@receiver(post_save, sender=Erratum)
+@receiver(post_delete, sender=Erratum)
+def invalidate_catalog(sender, instance, **kwargs):
+    catalog.invalidate()
+
+
 class RatingField(models.PositiveSmallIntegerField):
     '''Represents a single numeric rating (either fun or difficulty) of a puzzle.'''
     def __init__(self, max_rating, adjective, **kwargs):
@@ -856,6 +1210,25 @@ class Hint(models.Model):
             o = o + ' {}'.format(self.get_status_display())
         return o
 
+    # How many hints need answering, for the admin nav bar. Kept in the cache
+    # and recounted whenever a hint changes, and at least every so often in
+    # case two recounts race.
+    UNCLAIMED_KEY = 'unclaimed-hints'
+    UNCLAIMED_TIMEOUT = 30  # seconds
+
+    @staticmethod
+    def unclaimed_count():
+        count = cache.get(Hint.UNCLAIMED_KEY)
+        if count is None:
+            count = Hint.recount_unclaimed()
+        return count
+
+    @staticmethod
+    def recount_unclaimed():
+        count = Hint.objects.filter(status=Hint.NO_RESPONSE, claimer='').count()
+        cache.set(Hint.UNCLAIMED_KEY, count, Hint.UNCLAIMED_TIMEOUT)
+        return count
+
     @property
     def consumes_hint(self):
         if self.status == Hint.REFUNDED:
@@ -923,3 +1296,304 @@ def notify_on_hint_update(sender, instance, created, update_fields, **kwargs):
                 {'hint': instance, 'link': link},
                 instance.recipients())
             show_hint_notification(instance)
+
+
+# Team snapshots hold these instead of model instances, so that a team's whole
+# history is cheap to pickle and load: each row is just the fields that pages
+# use, with the puzzle (and its round) looked up in the catalog rather than
+# loaded and stored again for every row. They're read-only.
+class Row:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for (name, value) in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def load(cls, queryset):
+        return tuple(cls(*values) for values in queryset.values_list(*cls.__slots__))
+
+    @property
+    def puzzle(self):
+        puzzle = catalog.get_catalog().puzzles_by_id.get(self.puzzle_id)
+        if puzzle is None:
+            # This worker's catalog hasn't caught up with a new puzzle yet.
+            puzzle = catalog.reload().puzzles_by_id.get(self.puzzle_id)
+            if puzzle is None:
+                raise LookupError('Puzzle %d is not in the catalog' % self.puzzle_id)
+        return puzzle
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__slots__))
+
+
+class SubmissionRow(Row):
+    __slots__ = (
+        'id', 'puzzle_id', 'submitted_answer', 'submitted_datetime',
+        'is_correct', 'used_free_answer',
+    )
+
+
+class HintRow(Row):
+    __slots__ = (
+        'id', 'puzzle_id', 'is_followup', 'submitted_datetime', 'hint_question',
+        'answered_datetime', 'status', 'response',
+    )
+
+    consumes_hint = Hint.consumes_hint
+
+    def get_status_display(self):
+        return dict(Hint.STATUSES)[self.status]
+
+
+class UnlockRow(Row):
+    __slots__ = ('id', 'team_id', 'puzzle_id', 'unlock_datetime', 'view_datetime')
+
+
+class PuzzleStats(models.Model):
+    '''
+    Running totals for a puzzle over visible teams, for the puzzles and stats
+    pages. Only answers that weren't free and were submitted before the hunt
+    ended count. New submissions and hints increment these; anything else
+    that could change them recomputes them from scratch.
+    '''
+
+    puzzle = models.OneToOneField(
+        Puzzle, primary_key=True, on_delete=models.CASCADE,
+        related_name='stats', verbose_name=_('puzzle'))
+
+    solves = models.PositiveIntegerField(default=0, verbose_name=_('Solves'))
+    guesses = models.PositiveIntegerField(default=0, verbose_name=_('Guesses'))
+    guess_teams = models.PositiveIntegerField(default=0, verbose_name=_('Guessing teams'))
+    hints = models.PositiveIntegerField(default=0, verbose_name=_('Hints'))
+
+    class Meta:
+        verbose_name = _('puzzle stats')
+        verbose_name_plural = _('puzzle stats')
+
+    def __str__(self):
+        return str(self.puzzle)
+
+    # Each team can only solve a puzzle once.
+    @property
+    def solve_teams(self):
+        return self.solves
+
+    @staticmethod
+    def get_all():
+        return {stats.puzzle_id: stats for stats in PuzzleStats.objects.all()}
+
+    @staticmethod
+    def recompute(puzzle_ids=None):
+        '''Recomputes the stats for the given puzzles, or all of them.'''
+        if puzzle_ids is None:
+            puzzle_ids = list(Puzzle.objects.values_list('id', flat=True))
+            PuzzleStats.objects.bulk_create(
+                [PuzzleStats(puzzle_id=puzzle_id) for puzzle_id in puzzle_ids],
+                ignore_conflicts=True)
+        submission_counts = {
+            row.pop('puzzle_id'): row
+            for row in AnswerSubmission.objects.filter(
+                puzzle_id__in=puzzle_ids,
+                used_free_answer=False,
+                team__is_hidden=False,
+                submitted_datetime__lt=HUNT_END_TIME,
+            ).values('puzzle_id').annotate(
+                solves=Count('id', filter=Q(is_correct=True)),
+                guesses=Count('id'),
+                guess_teams=Count('team_id', distinct=True),
+            )
+        }
+        hint_counts = dict(
+            Hint.objects.filter(puzzle_id__in=puzzle_ids, team__is_hidden=False)
+            .values('puzzle_id').annotate(hints=Count('id'))
+            .values_list('puzzle_id', 'hints')
+        )
+        # Only update existing rows (made along with each puzzle), so that
+        # this is harmless while a puzzle is being deleted.
+        for puzzle_id in puzzle_ids:
+            PuzzleStats.objects.filter(puzzle_id=puzzle_id).update(**{
+                'solves': 0,
+                'guesses': 0,
+                'guess_teams': 0,
+                **submission_counts.get(puzzle_id, {}),
+                'hints': hint_counts.get(puzzle_id, 0),
+            })
+
+    @staticmethod
+    def increment(puzzle_id, **counts):
+        PuzzleStats.objects.filter(puzzle_id=puzzle_id).update(**{
+            name: F(name) + count for (name, count) in counts.items()
+        })
+
+
+class OutboundMessage(models.Model):
+    '''
+    A Discord alert or email waiting to be sent by the send_outbound_messages
+    command, or a hint's Discord message waiting to be sent by the
+    run_discord_bot command, so that requests never wait on (or fail because
+    of) Discord or the mail server. Messages are created in the same
+    transaction as whatever caused them, so they're only sent if that's
+    committed.
+    '''
+
+    DISCORD = 'DIS'
+    EMAIL = 'EML'
+    HINT = 'HNT'
+    KINDS = (
+        (DISCORD, _('Discord')),
+        (EMAIL, _('Email')),
+        (HINT, _('Hint')),
+    )
+
+    kind = models.CharField(choices=KINDS, max_length=3, verbose_name=_('Kind'))
+    # The webhook URL for Discord messages, or the hint id for hints.
+    destination = models.CharField(blank=True, max_length=255, verbose_name=_('Destination'))
+    payload = models.TextField(verbose_name=_('Payload'))
+
+    created_datetime = models.DateTimeField(auto_now_add=True, verbose_name=_('Created datetime'))
+    # Null once the message is sent or we've given up on it.
+    next_attempt_datetime = models.DateTimeField(
+        null=True, blank=True, default=timezone.now, db_index=True,
+        verbose_name=_('Next attempt datetime'))
+    sent_datetime = models.DateTimeField(null=True, blank=True, verbose_name=_('Sent datetime'))
+    attempts = models.PositiveIntegerField(default=0, verbose_name=_('Attempts'))
+    last_error = models.TextField(blank=True, verbose_name=_('Last error'))
+
+    class Meta:
+        verbose_name = _('outbound message')
+        verbose_name_plural = _('outbound messages')
+
+    def __str__(self):
+        return '%s #%s' % (self.get_kind_display(), self.id)
+
+
+@receiver(post_save, sender=Puzzle)
+def create_puzzle_stats(sender, instance, created, **kwargs):
+    if created:
+        PuzzleStats.objects.get_or_create(puzzle=instance)
+
+@receiver(post_save, sender=AnswerSubmission)
+def update_stats_on_submission(sender, instance, created, **kwargs):
+    if not created:
+        PuzzleStats.recompute([instance.puzzle_id])
+    elif (
+        not instance.used_free_answer and
+        instance.submitted_datetime < HUNT_END_TIME and
+        not instance.team.is_hidden
+    ):
+        earlier_guesses = AnswerSubmission.objects.filter(
+            team_id=instance.team_id,
+            puzzle_id=instance.puzzle_id,
+            used_free_answer=False,
+            submitted_datetime__lt=HUNT_END_TIME,
+        ).exclude(id=instance.id)
+        # Whether it's the team's first guess is checked in the same UPDATE.
+        PuzzleStats.increment(
+            instance.puzzle_id,
+            solves=int(instance.is_correct),
+            guesses=1,
+            guess_teams=Case(
+                When(Exists(earlier_guesses), then=Value(0)),
+                default=Value(1),
+                output_field=IntegerField(),
+            ),
+        )
+
+@receiver(post_save, sender=Hint)
+@receiver(post_delete, sender=Hint)
+def update_unclaimed_hints(sender, instance, **kwargs):
+    transaction.on_commit(lambda: show_unclaimed_hints(Hint.recount_unclaimed()))
+
+@receiver(post_save, sender=Hint)
+def update_stats_on_hint(sender, instance, created, **kwargs):
+    if created and not instance.team.is_hidden:
+        PuzzleStats.increment(instance.puzzle_id, hints=1)
+
+@receiver(post_delete, sender=AnswerSubmission)
+@receiver(post_delete, sender=Hint)
+def update_stats_on_deletion(sender, instance, **kwargs):
+    PuzzleStats.recompute([instance.puzzle_id])
+
+
+def refresh_allowances(instance):
+    # Like in invalidate_snapshot_on_update, bring a Team that's in use up to
+    # date.
+    if type(instance).team.is_cached(instance):
+        instance.team.refresh_from_db(fields=('hints_used', 'free_answers_used'))
+        instance.team.invalidate('num_hints_used', 'num_free_answers_used')
+
+# These recount rather than add one, even for new hints and free answers:
+# other receivers (like the one making hints obsolete) can recount in between.
+@receiver(post_save, sender=AnswerSubmission)
+def update_allowances_on_submission(sender, instance, created, **kwargs):
+    if not created or instance.used_free_answer:
+        Team.update_allowances([instance.team_id])
+        refresh_allowances(instance)
+
+@receiver(post_save, sender=Hint)
+def update_allowances_on_hint(sender, instance, created, update_fields, **kwargs):
+    # Only a change of status (a refund, say) can change whether an existing
+    # hint counts.
+    if created or update_fields is None or {'status', 'is_followup'} & set(update_fields):
+        Team.update_allowances([instance.team_id])
+        refresh_allowances(instance)
+
+@receiver(post_delete, sender=AnswerSubmission)
+@receiver(post_delete, sender=Hint)
+def update_allowances_on_deletion(sender, instance, **kwargs):
+    Team.update_allowances([instance.team_id])
+    refresh_allowances(instance)
+
+
+@receiver(post_save, sender=AnswerSubmission)
+@receiver(post_delete, sender=AnswerSubmission)
+@receiver(post_save, sender=Hint)
+@receiver(post_delete, sender=Hint)
+@receiver(post_save, sender=PuzzleUnlock)
+@receiver(post_delete, sender=PuzzleUnlock)
+@receiver(post_save, sender=ExtraGuessGrant)
+@receiver(post_delete, sender=ExtraGuessGrant)
+def invalidate_snapshot_on_update(sender, instance, **kwargs):
+    Team.invalidate_snapshot(instance.team_id)
+    # If this came from a view, its Team (and anything computed from it) is
+    # probably still in use, so bring it up to date too.
+    if sender.team.is_cached(instance):
+        instance.team.refresh_from_db(fields=('state_version',))
+        instance.team.invalidate('snapshot')
+
+
+@receiver(post_save, sender=AnswerSubmission)
+def update_bigboard_on_submission(sender, instance, created, **kwargs):
+    if created:
+        bigboard.record_submission(instance)
+    else:
+        bigboard.reset()
+
+@receiver(post_save, sender=AnswerSubmission)
+@receiver(post_delete, sender=AnswerSubmission)
+def reset_guess_counts(sender, instance, created=False, **kwargs):
+    # New submissions are counted in notify_on_answer_submission.
+    if not created:
+        guesses.reset()
+
+@receiver(post_save, sender=Hint)
+@receiver(post_delete, sender=Hint)
+def update_bigboard_on_hint(sender, instance, **kwargs):
+    if not instance.is_followup:
+        bigboard.record_hints(instance)
+
+@receiver(post_save, sender=PuzzleUnlock)
+def update_bigboard_on_unlock(sender, instance, created, **kwargs):
+    if created:
+        bigboard.record('unlock', instance.team.is_hidden, instance.team_id, instance.puzzle_id)
+
+@receiver(post_delete, sender=AnswerSubmission)
+@receiver(post_delete, sender=PuzzleUnlock)
+@receiver(post_save, sender=Round)
+@receiver(post_delete, sender=Round)
+@receiver(post_save, sender=Puzzle)
+@receiver(post_delete, sender=Puzzle)
+def reset_bigboard(sender, instance, **kwargs):
+    bigboard.reset()
@@ -0,0 +1,204 @@
+# Sends the Discord alerts and emails queued as OutboundMessages (hint messages
+# are the Discord bot's; see DiscordInterface in messaging.py). This runs in
+# the send_outbound_messages command, not in the web workers: the database work
+# happens on the command's main thread, and only the network I/O is farmed out
+# to a thread pool, one task per Discord webhook (so each webhook's messages
+# stay in order and respect its rate limit) and one per email.
+#
+# Consecutive queued alerts for the same webhook and username are coalesced
+# into as few Discord messages as will fit, which matters when lots of teams
+# are submitting at once and Discord starts rate limiting us.
+import datetime
+import json
+import logging
+import traceback
+
+import requests
+
+from django.conf import settings
+from django.core.mail.message import EmailMultiAlternatives
+from django.db.models import F
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from puzzles import models
+from puzzles.hunt_config import CONTACT_EMAIL, MESSAGING_SENDER_EMAIL
+
+logger = logging.getLogger('puzzles.messaging')
+
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 8
+MAX_DISCORD_LENGTH = 2000
+REQUEST_TIMEOUT = 10  # seconds
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class LiveSink:
+    def send_discord(self, webhook, username, content):
+        response = requests.post(webhook, json={
+            'username': username,
+            'content': content,
+            'allowed_mentions': {'parse': []},
+        }, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.json()['retry_after'])
+            except Exception:
+                retry_after = float(response.headers.get('Retry-After', 1))
+            raise RateLimited(retry_after)
+        response.raise_for_status()
+
+    def send_email(self, subject, body, html, recipients):
+        mail = EmailMultiAlternatives(
+            subject=subject,
+            body=body,
+            from_email=MESSAGING_SENDER_EMAIL,
+            to=recipients,
+            alternatives=[(html, 'text/html')],
+            reply_to=[CONTACT_EMAIL])
+        if mail.send() != 1:
+            raise RuntimeError(_('Unknown failure???'))
+
+
+class StubSink:
+    '''Logs messages instead of sending them. Keeps them in sent for tests.'''
+
+    def __init__(self):
+        self.sent = []
+
+    def send_discord(self, webhook, username, content):
+        logger.info(_('(Test) Discord alert:\n') + content)
+        self.sent.append(('discord', webhook, username, content))
+
+    def send_email(self, subject, body, html, recipients):
+        logger.info(_('(Test) Sending mail <{}> to <{}>:\n{}').format(
+            subject, ', '.join(recipients), body))
+        self.sent.append(('email', subject, body, recipients))
+
+
+def default_sink():
+    return StubSink() if settings.IS_TEST else LiveSink()
+
+
+def _coalesce(messages):
+    # Groups consecutive messages with the same username into chunks whose
+    # contents fit in one Discord message. Yields (username, content, messages).
+    chunk = []
+    for message in messages:
+        if chunk and (
+            message.data['username'] != chunk[0].data['username'] or
+            sum(len(m.data['content']) + 1 for m in chunk) +
+            len(message.data['content']) > MAX_DISCORD_LENGTH
+        ):
+            yield chunk[0].data['username'], '\n'.join(m.data['content'] for m in chunk), chunk
+            chunk = []
+        chunk.append(message)
+    if chunk:
+        yield chunk[0].data['username'], '\n'.join(m.data['content'] for m in chunk), chunk
+
+
+def _send_to_webhook(sink, webhook, messages):
+    # Returns a list of (messages, error) pairs, where error is None on
+    # success, a RateLimited, or a traceback string. Stops at the first
+    # failure, since everything after it would be sent out of order. A
+    # traceback is only charged to the chunk that failed. The messages after
+    # it are left as they are, and wait without being charged an attempt,
+    # since the webhook is paused until that chunk is retried.
+    results = []
+    sent = 0
+    for username, content, chunk in _coalesce(messages):
+        try:
+            sink.send_discord(webhook, username, content)
+        except RateLimited as e:
+            results.append((messages[sent:], e))
+            break
+        except Exception:
+            results.append((chunk, traceback.format_exc()))
+            break
+        results.append((chunk, None))
+        sent += len(chunk)
+    return results
+
+
+def _send_email(sink, message):
+    try:
+        sink.send_email(**message.data)
+    except Exception:
+        return [([message], traceback.format_exc())]
+    return [([message], None)]
+
+
+def record(messages, error, now):
+    '''
+    Marks the messages as sent if error is None, or else schedules them to be
+    tried again (or gives up on them).
+    '''
+    ids = [message.id for message in messages]
+    queryset = models.OutboundMessage.objects.filter(id__in=ids)
+    if error is None:
+        queryset.update(sent_datetime=now, next_attempt_datetime=None,
+            attempts=F('attempts') + 1, last_error='')
+        return
+    if isinstance(error, RateLimited):
+        # Not the messages' fault, so don't count it as an attempt.
+        queryset.update(
+            next_attempt_datetime=now + datetime.timedelta(seconds=error.retry_after),
+            last_error=_('Rate limited for {}s').format(error.retry_after))
+        return
+    for message in messages:
+        message.attempts += 1
+        message.last_error = error
+        if message.attempts >= MAX_ATTEMPTS:
+            message.next_attempt_datetime = None
+            logger.error(_('Giving up on outbound message {}:\n{}').format(message, error))
+            if message.kind == models.OutboundMessage.EMAIL:
+                # Lazy import to avoid a cycle.
+                from puzzles.messaging import dispatch_general_alert
+                dispatch_general_alert(_('Could not send mail <{}> to <{}>:\n{}').format(
+                    message.data['subject'], ', '.join(message.data['recipients']), error))
+        else:
+            message.next_attempt_datetime = now + datetime.timedelta(
+                seconds=2 ** message.attempts)
+        message.save(update_fields=('attempts', 'last_error', 'next_attempt_datetime'))
+
+
+def deliver_pending(executor, sink=None, limit=BATCH_SIZE):
+    '''
+    Sends up to limit due messages using the threads in executor and records
+    the results. Returns the number of messages it tried to send.
+    '''
+    if sink is None:
+        sink = default_sink()
+    now = timezone.now()
+    messages = list(models.OutboundMessage.objects
+        .exclude(kind=models.OutboundMessage.HINT)
+        .filter(next_attempt_datetime__lte=now)
+        .order_by('id')[:limit])
+    # Webhooks with messages waiting out a rate limit or backoff are paused
+    # entirely, so that their messages still go out in order.
+    paused = set(models.OutboundMessage.objects
+        .filter(kind=models.OutboundMessage.DISCORD, next_attempt_datetime__gt=now)
+        .values_list('destination', flat=True))
+    by_webhook = {}
+    futures = []
+    count = 0
+    for message in messages:
+        message.data = json.loads(message.payload)
+        if message.kind == models.OutboundMessage.DISCORD:
+            if message.destination in paused:
+                continue
+            by_webhook.setdefault(message.destination, []).append(message)
+        else:
+            futures.append(executor.submit(_send_email, sink, message))
+        count += 1
+    for webhook, webhook_messages in by_webhook.items():
+        futures.append(executor.submit(_send_to_webhook, sink, webhook, webhook_messages))
+    for future in futures:
+        for group, error in future.result():
+            record(group, error, timezone.now())
+    return count
@@ -0,0 +1,121 @@
+# Records when each team first views each puzzle (PuzzleUnlock.view_datetime)
+# without a write per view. At the start of the hunt, thousands of teams open
+# dozens of puzzles within seconds, so instead each worker collects views in
+# memory and writes them in batches: when enough have piled up, or after a
+# request finishes and the oldest has waited FLUSH_INTERVAL, or when the
+# worker exits. A view is only lost if the worker dies before writing it, and
+# then the puzzle just shows up as new for that team again.
+#
+# Views are keyed by team and puzzle rather than by PuzzleUnlock id, since an
+# unlock made earlier in the same request hasn't been given an id.
+#
+# Until a view is written, it's also kept under its own key in the shared
+# cache, which Team.unviewed_puzzles checks, so the team stops seeing the
+# puzzle as new right away. (One key per view, so that concurrent requests
+# can't overwrite each other's.) Writing a batch bumps the teams'
+# state_version, so that their snapshots are loaded again with the views.
+import atexit
+import functools
+import logging
+import operator
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db.models import Case, DateTimeField, F, Q, Value, When
+from django.dispatch import receiver
+
+from puzzles import models
+
+logger = logging.getLogger('puzzles.puzzle_views')
+
+FLUSH_INTERVAL = 2  # seconds
+MAX_PENDING = 500
+BATCH_SIZE = 200
+VIEW_KEY = 'puzzle-view:%d:%d'
+# Long enough to outlast any wait to be written.
+VIEW_TIMEOUT = 24 * 60 * 60
+
+_lock = threading.Lock()
+# (team id, puzzle id) => view time
+_pending = {}
+_oldest = None
+
+
+def record(unlock):
+    '''Queues up writing unlock.view_datetime.'''
+    global _oldest
+    key = (unlock.team_id, unlock.puzzle_id)
+    cache.set(VIEW_KEY % key, unlock.view_datetime, VIEW_TIMEOUT)
+    with _lock:
+        if key in _pending:
+            return
+        _pending[key] = unlock.view_datetime
+        if _oldest is None:
+            _oldest = time.monotonic()
+        full = len(_pending) >= MAX_PENDING
+    if full:
+        try:
+            flush()
+        except Exception:
+            # They'll be tried again; don't fail the page over it.
+            logger.exception('Could not write puzzle views')
+
+
+def recorded(team_id, puzzle_ids):
+    '''Which of the team's puzzles have views that might not be written yet.'''
+    views = cache.get_many([VIEW_KEY % (team_id, puzzle_id) for puzzle_id in puzzle_ids])
+    return {puzzle_id for puzzle_id in puzzle_ids if VIEW_KEY % (team_id, puzzle_id) in views}
+
+
+def flush():
+    '''
+    Writes all the queued views. If that fails, the views not written are
+    queued again before the error is raised.
+    '''
+    global _pending, _oldest
+    with _lock:
+        pending, _pending, _oldest = _pending, {}, None
+    items = list(pending.items())
+    for i in range(0, len(items), BATCH_SIZE):
+        try:
+            _write(items[i:i + BATCH_SIZE])
+        except Exception:
+            with _lock:
+                # These are older than any views queued since.
+                _pending.update(items[i:])
+                if _oldest is None:
+                    _oldest = time.monotonic()
+            raise
+
+
+def _write(batch):
+    # Only the first view counts, so skip any that somehow got one.
+    models.PuzzleUnlock.objects.filter(
+        functools.reduce(operator.or_, (
+            Q(team_id=team_id, puzzle_id=puzzle_id)
+            for ((team_id, puzzle_id), _) in batch)),
+        view_datetime__isnull=True,
+    ).update(view_datetime=Case(
+        *(When(team_id=team_id, puzzle_id=puzzle_id, then=Value(view_time))
+            for ((team_id, puzzle_id), view_time) in batch),
+        output_field=DateTimeField(),
+    ))
+    models.Team.objects.filter(
+        id__in={team_id for ((team_id, _), _) in batch},
+    ).update(state_version=F('state_version') + 1)
+
+
+@receiver(request_finished)
+def flush_if_due(**kwargs):
+    oldest = _oldest
+    if oldest is not None and time.monotonic() - oldest >= FLUSH_INTERVAL:
+        try:
+            flush()
+        except Exception:
+            # The response has been sent, so there's no one else to tell.
+            logger.exception('Could not write puzzle views')
+
+
+atexit.register(flush)
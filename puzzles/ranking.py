@@ -0,0 +1,182 @@
+# Leaderboard positions without scanning the leaderboard. When the cache is
+# Redis, every visible team has a member in a sorted set; all scores are 0, so
+# Redis orders the members lexicographically, and each member starts with a
+# fixed-width string that sorts the same way as Team.LEADERBOARD_ORDERING. A
+# team's rank is then the number of members before its key (ZLEXCOUNT), and
+# its neighbours are the adjacent members.
+#
+# With any other cache (e.g. in development) this falls back to counting in the
+# database; see Team.leaderboard_rank.
+#
+# Every update also adds the team to a set of changed teams. A rebuild empties
+# that set before it reads the database and updates whatever's in it after it
+# writes, so a solve that lands in between isn't lost.
+import datetime
+
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from puzzles import models
+
+NEIGHBORS = 3
+
+MAX_SOLVES = 999999
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Replace a team's old member (if any) with its new one (if any) atomically.
+UPDATE_SCRIPT = '''
+local old = redis.call('HGET', KEYS[2], ARGV[1])
+if old then redis.call('ZREM', KEYS[1], old) end
+if ARGV[2] == '' then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('ZADD', KEYS[1], 0, ARGV[2])
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+'''
+
+
+def _keys():
+    # (the sorted set, team id => member, marker that the set has been built,
+    # teams changed since the last rebuild started)
+    return (
+        cache.make_key('leaderboard'),
+        cache.make_key('leaderboard-members'),
+        cache.make_key('leaderboard-built'),
+        cache.make_key('leaderboard-changed'),
+    )
+
+
+def _redis():
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        return None
+
+
+def _timestamp(time):
+    return '%017d' % ((time - EPOCH) // datetime.timedelta(microseconds=1))
+
+
+def _sort_key(team):
+    if team.metameta_solve_time is None:
+        finish = '1' + '0' * 17
+    else:
+        finish = '0' + _timestamp(team.metameta_solve_time)
+    return '%s%06d%s' % (
+        finish,
+        MAX_SOLVES - min(team.total_solves, MAX_SOLVES),
+        _timestamp(team.last_solve_time or team.creation_time),
+    )
+
+
+def _member(team):
+    return '%s:%d' % (_sort_key(team), team.id)
+
+
+def _team_id(member):
+    return int(member.rsplit(b':', 1)[1])
+
+
+def rebuild():
+    '''Reloads the sorted set from the database. Does nothing without Redis.'''
+    redis = _redis()
+    if redis is None:
+        return
+    zset_key, members_key, built_key, changed_key = _keys()
+    redis.delete(changed_key)
+    members = {
+        team.id: _member(team) for team in models.Team.leaderboard_teams(None)
+    }
+    pipe = redis.pipeline()
+    pipe.delete(zset_key, members_key)
+    if members:
+        pipe.zadd(zset_key, {member: 0 for member in members.values()})
+        pipe.hset(members_key, mapping=members)
+    pipe.set(built_key, 1)
+    pipe.execute()
+    # Teams that changed after we started reading may have been read too
+    # early, or had their update overwritten just now.
+    pipe = redis.pipeline()
+    pipe.smembers(changed_key)
+    pipe.delete(changed_key)
+    changed, _ = pipe.execute()
+    for team_id in changed:
+        _write_team(redis, int(team_id))
+
+
+def _update_team(team_id):
+    redis = _redis()
+    if redis is None:
+        return
+    _, _, built_key, changed_key = _keys()
+    redis.sadd(changed_key, team_id)
+    if not redis.exists(built_key):
+        return  # whoever builds it will read the new data
+    _write_team(redis, team_id)
+
+
+def _write_team(redis, team_id):
+    zset_key, members_key, _, _ = _keys()
+    team = models.Team.objects.filter(id=team_id).first()
+    member = _member(team) if team and team.is_on_leaderboard(None) else ''
+    redis.register_script(UPDATE_SCRIPT)(keys=[zset_key, members_key], args=[team_id, member])
+
+
+def update_team(team_id):
+    '''Re-sorts the given team once the current transaction commits.'''
+    transaction.on_commit(lambda: _update_team(team_id))
+
+
+def _ready_redis(current_team, hide_hidden):
+    # The sorted set only has visible teams, so it can't answer questions
+    # about leaderboards that include hidden ones.
+    if not hide_hidden or (current_team and current_team.is_hidden):
+        return None
+    redis = _redis()
+    if redis is not None and not redis.exists(_keys()[2]):
+        rebuild()
+    return redis
+
+
+def get_rank(team, current_team, hide_hidden=True):
+    '''
+    Returns the team's 1-indexed position in
+    Team.leaderboard_teams(current_team, hide_hidden), or None if it isn't on
+    that leaderboard. Tied teams share a rank.
+    '''
+    if not team.is_on_leaderboard(current_team, hide_hidden):
+        return None
+    redis = _ready_redis(current_team, hide_hidden)
+    if redis is None:
+        return team.leaderboard_rank(current_team, hide_hidden)
+    return redis.zlexcount(_keys()[0], '-', '(' + _sort_key(team)) + 1
+
+
+def get_neighbors(team, current_team, hide_hidden=True, count=NEIGHBORS):
+    '''
+    Returns two lists of up to count teams each: those just ahead of the given
+    team on the leaderboard and those just behind it, both in leaderboard
+    order.
+    '''
+    if not team.is_on_leaderboard(current_team, hide_hidden):
+        return [], []
+    redis = _ready_redis(current_team, hide_hidden)
+    if redis is None:
+        teams = models.Team.leaderboard_teams(current_team, hide_hidden)
+        ahead = teams.filter(models.Team.leaderboard_ahead_of(team))
+        ahead = list(ahead.reverse()[:count])[::-1]
+        behind = list(teams.exclude(models.Team.leaderboard_ahead_of(team))
+            .exclude(id=team.id)[:count])
+        return ahead, behind
+    zset_key = _keys()[0]
+    member = '(' + _member(team)
+    ahead_ids = [_team_id(m) for m in redis.zrevrangebylex(zset_key, member, '-', 0, count)]
+    behind_ids = [_team_id(m) for m in redis.zrangebylex(zset_key, member, '+', 0, count)]
+    teams = models.Team.objects.in_bulk(ahead_ids + behind_ids)
+    return (
+        [teams[team_id] for team_id in reversed(ahead_ids) if team_id in teams],
+        [teams[team_id] for team_id in behind_ids if team_id in teams],
+    )
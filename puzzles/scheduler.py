@@ -0,0 +1,162 @@
+# Releases time unlocks and hint and free answer allowances on schedule (see
+# ./manage.py run_scheduler). Otherwise each team only finds out about them on
+# its next request, so at every release boundary thousands of teams reload at
+# once, each computing and inserting the same unlocks, and nobody gets a
+# notification until they do.
+#
+# Every boundary depends only on the puzzles, hunt_config.py and a team's
+# start_offset, so the scheduler works out the upcoming ones per start_offset.
+# LEAD_TIME before a time unlock, it inserts the PuzzleUnlocks for every team
+# that gets it, in large batches. Those rows stay invisible until their
+# unlock_datetime (see Team.db_unlocks), and teams whose unlocks were only
+# valid until this boundary are extended to the next one, so when it comes
+# nobody needs to compute anything. At the boundary itself, it sends each
+# team a notification over its websocket. Allowances are computed on the fly
+# from the time anyway, so they only need the notification.
+import collections
+import datetime
+
+from django.db.models import F, Q
+
+from puzzles import bigboard
+from puzzles import models
+from puzzles.catalog import get_catalog
+from puzzles.hunt_config import (
+    HUNT_START_TIME,
+    HUNT_END_TIME,
+    HINTS_ENABLED,
+    HINTS_PER_INTERVAL,
+    HINT_INTERVAL,
+    HINT_TIME,
+    TEAM_AGE_BEFORE_HINTS,
+    FREE_ANSWERS_ENABLED,
+    FREE_ANSWERS_PER_DAY,
+    FREE_ANSWER_TIME,
+    TEAM_AGE_BEFORE_FREE_ANSWERS,
+    META_META_SLUG,
+)
+from puzzles.messaging import (
+    show_new_free_answers_notification,
+    show_new_hints_notification,
+    show_time_unlock_notification,
+)
+
+LEAD_TIME = datetime.timedelta(minutes=2)
+BATCH_SIZE = 1000
+
+UNLOCK = 'unlock'
+HINTS = 'hints'
+FREE_ANSWERS = 'free_answers'
+
+# puzzles is a list of the puzzles unlocked, for UNLOCK events only.
+Event = collections.namedtuple('Event', ('time', 'kind', 'start_offset', 'puzzles'))
+
+
+def _events_for_offset(start_offset, puzzles_by_hours):
+    start_time = HUNT_START_TIME - start_offset
+    for (hours, puzzles) in puzzles_by_hours.items():
+        yield Event(start_time + datetime.timedelta(hours=hours), UNLOCK, start_offset, puzzles)
+    if HINTS_ENABLED:
+        for (i, count) in enumerate(HINTS_PER_INTERVAL):
+            if count:
+                yield Event(HINT_TIME - start_offset + i * HINT_INTERVAL, HINTS, start_offset, None)
+    if FREE_ANSWERS_ENABLED:
+        for (i, count) in enumerate(FREE_ANSWERS_PER_DAY):
+            if count:
+                yield Event(FREE_ANSWER_TIME - start_offset + datetime.timedelta(days=i),
+                    FREE_ANSWERS, start_offset, None)
+
+
+def _unlocked_at_start(catalog):
+    # The ids of everything compute_unlocks gives a team that hasn't solved
+    # anything, so that the whole initial set is ready at the start (see
+    # surge.py). Like there, the meta-meta only needs the metas before it
+    # solved, so it's in if none come before it.
+    unlocked = set()
+    metas_before = False
+    for puzzle in catalog.puzzles:
+        if (puzzle.unlock_hours == 0 or
+                puzzle.unlock_local == 0 or
+                (puzzle.slug == META_META_SLUG and not metas_before)):
+            unlocked.add(puzzle.id)
+        metas_before = metas_before or puzzle.is_meta
+    return unlocked
+
+
+def events(after, until):
+    '''
+    Returns every boundary, for every start_offset that some team has, that
+    comes after the first time and no later than the second, in order.
+    '''
+    catalog = get_catalog()
+    puzzles_by_hours = collections.defaultdict(list)
+    at_start = _unlocked_at_start(catalog)
+    for puzzle in catalog.puzzles:
+        if puzzle.id in at_start:
+            puzzles_by_hours[0].append(puzzle)
+        elif puzzle.unlock_hours >= 0:
+            puzzles_by_hours[puzzle.unlock_hours].append(puzzle)
+    until = min(until, HUNT_END_TIME)
+    return sorted((
+        event
+        for start_offset in models.Team.objects.values_list('start_offset', flat=True).distinct()
+        for event in _events_for_offset(start_offset, puzzles_by_hours)
+        if after < event.time <= until
+    ), key=lambda event: event.time)
+
+
+def _teams(event):
+    teams = models.Team.objects.filter(start_offset=event.start_offset)
+    if event.kind == UNLOCK:
+        if event.time != HUNT_START_TIME - event.start_offset:
+            teams = teams.filter(allow_time_unlocks=True)
+    elif event.kind == HINTS:
+        teams = teams.filter(creation_time__lte=event.time - TEAM_AGE_BEFORE_HINTS)
+    elif event.kind == FREE_ANSWERS:
+        teams = teams.filter(creation_time__lte=event.time - TEAM_AGE_BEFORE_FREE_ANSWERS)
+    return teams
+
+
+def prepare(event):
+    '''
+    Inserts the PuzzleUnlocks for a time unlock ahead of time. Does nothing
+    for other events, and nothing twice.
+    '''
+    if event.kind != UNLOCK:
+        return
+    team_ids = list(_teams(event).values_list('id', flat=True))
+    unlocks = [
+        models.PuzzleUnlock(team_id=team_id, puzzle_id=puzzle.id, unlock_datetime=event.time)
+        for team_id in team_ids for puzzle in event.puzzles
+    ]
+    models.PuzzleUnlock.objects.bulk_create(unlocks, batch_size=BATCH_SIZE, ignore_conflicts=True)
+    # Teams whose unlocks are valid until exactly this time now have
+    # everything they'll need then, so they can skip ahead to the next time.
+    later = events(event.time, HUNT_END_TIME)
+    valid_until = next((
+        later_event.time for later_event in later
+        if later_event.kind == UNLOCK and later_event.start_offset == event.start_offset
+    ), HUNT_END_TIME)
+    up_to_date = Q(unlocks_valid_until=event.time)
+    if event.time == HUNT_START_TIME - event.start_offset:
+        # Teams that have never computed their unlocks haven't done anything
+        # else either (or it would have invalidated them), so these are all
+        # they have at the start.
+        up_to_date |= Q(unlocks_valid_until__isnull=True)
+    for i in range(0, len(team_ids), BATCH_SIZE):
+        teams = models.Team.objects.filter(id__in=team_ids[i:i + BATCH_SIZE])
+        teams.update(state_version=F('state_version') + 1)
+        teams.filter(up_to_date).update(unlocks_valid_until=valid_until)
+
+
+def fire(event):
+    '''Tells every team the event applies to about it.'''
+    teams = list(_teams(event).only('id', 'user_id'))
+    if event.kind == UNLOCK:
+        show_time_unlock_notification(teams, event.puzzles)
+        # Rebuilding once is cheaper than an event for every new unlock.
+        bigboard.reset()
+    elif event.kind == HINTS:
+        show_new_hints_notification(teams)
+    elif event.kind == FREE_ANSWERS:
+        show_new_free_answers_notification(teams)
@@ -38,7 +38,7 @@ def dispatch_shortcut(request):
     if 'puzzle' in params:
         slug = request.POST.get('puzzle')
         assert slug, _('Missing puzzle')
-        puzzle = models.Puzzle.objects.filter(slug=slug).first()
+        puzzle = request.context.catalog.puzzles_by_slug.get(slug)
         assert puzzle, _('Invalid puzzle %r') % slug
         params['puzzle'] = puzzle
     if 'team' in params:
@@ -96,22 +96,18 @@ class Shortcuts:
 
         def hint_1(team):
             '+1'
-            team.total_hints_awarded += 1
-            team.save()
+            models.Team.award(models.Team.objects.filter(id=team.id), hints=1)
 
         def hint_5(team):
             '+5'
-            team.total_hints_awarded += 5
-            team.save()
+            models.Team.award(models.Team.objects.filter(id=team.id), hints=5)
 
         def hint_0(team):
             '=0'
-            team.total_hints_awarded -= team.num_hints_remaining
-            team.save()
+            models.Team.award(models.Team.objects.filter(id=team.id), hints=-team.num_hints_remaining)
 
         def reset_hints(team):
-            team.total_hints_awarded = 0
-            team.save()
+            models.Team.objects.filter(id=team.id).update(total_hints_awarded=0)
         reset_hints.__doc__ = _('Reset')
 
     if hunt_config.FREE_ANSWERS_ENABLED:
@@ -121,22 +117,18 @@ class Shortcuts:
 
         def free_answer_1(team):
             '+1'
-            team.total_free_answers_awarded += 1
-            team.save()
+            models.Team.award(models.Team.objects.filter(id=team.id), free_answers=1)
 
         def free_answer_5(team):
             '+5'
-            team.total_free_answers_awarded += 5
-            team.save()
+            models.Team.award(models.Team.objects.filter(id=team.id), free_answers=5)
 
         def free_answer_0(team):
             '=0'
-            team.total_free_answers_awarded -= team.num_free_answers_remaining
-            team.save()
+            models.Team.award(models.Team.objects.filter(id=team.id), free_answers=-team.num_free_answers_remaining)
 
         def reset_free_answers(team):
-            team.total_free_answers_awarded = 0
-            team.save()
+            models.Team.objects.filter(id=team.id).update(total_free_answers_awarded=0)
         reset_free_answers.__doc__ = _('Reset')
 
     @heading
@@ -32,6 +32,8 @@ askName(false);
 function getUpdates() {
     openSocket('/ws/hints', data => {
         const {id, content} = JSON.parse(data);
+        if (id === undefined)
+            return;
         const elt = document.getElementById('h' + id);
         if (content && elt)
             elt.outerHTML = content;
@@ -0,0 +1,125 @@
+# Surge mode, for the first few minutes after the hunt starts, when every team
+# loads the puzzles page at once. Ahead of the start:
+# - the scheduler inserts every team's initial unlocks (see scheduler.py), so
+#   that nobody has to compute them when it comes;
+# - each worker loads the catalog and compiles the templates for the busiest
+#   pages and every puzzle and round, so the first requests don't pay for
+#   that (see warm, which gph/gunicorn.py runs as each worker starts and again
+#   WARM_LEAD before the start);
+# - the countdown page reloads itself at the start, after a random delay of up
+#   to REFRESH_JITTER, rather than having everyone refresh in the same second.
+# For SURGE_WINDOW after each team's start, compute_unlocks counts whether the
+# team's unlocks were ready (warm) or had to be computed (cold), which the
+# /metrics page shows. Each worker counts in memory and adds its counts to the
+# shared cache every FLUSH_INTERVAL, rather than hitting the cache on every
+# request just when it's busiest.
+import atexit
+import collections
+import datetime
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.dispatch import receiver
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.utils import timezone
+
+from puzzles import catalog
+from puzzles.hunt_config import HUNT_START_TIME
+
+logger = logging.getLogger('puzzles.surge')
+
+WARM_LEAD = datetime.timedelta(minutes=1)
+SURGE_WINDOW = datetime.timedelta(minutes=10)
+REFRESH_JITTER = 10  # seconds
+FLUSH_INTERVAL = 5  # seconds
+
+COUNT_KEY = 'surge-%s'
+TEMPLATES = ('puzzles.html', 'puzzles_list.html', 'puzzle.html', 'countdown.html')
+
+_lock = threading.Lock()
+# 'warm' or 'cold' => count not yet in the cache
+_pending = collections.Counter()
+_oldest = None
+
+
+def warm():
+    '''Loads everything the first requests of the hunt will need.'''
+    hunt = catalog.get_catalog()
+    names = list(TEMPLATES)
+    names.extend('puzzle_bodies/{}'.format(puzzle.body_template) for puzzle in hunt.puzzles)
+    names.extend('round_bodies/{}.html'.format(round.slug) for round in hunt.rounds)
+    for name in names:
+        try:
+            get_template(name)
+        except (TemplateDoesNotExist, IsADirectoryError):
+            # The views fall back to a generic template for these.
+            pass
+
+
+def _warm():
+    try:
+        warm()
+    except Exception:
+        logger.exception('Could not warm up')
+
+
+def schedule_warmup():
+    '''Warms up now, and again just before the hunt starts.'''
+    _warm()
+    delay = (HUNT_START_TIME - WARM_LEAD - timezone.now()).total_seconds()
+    if delay > 0:
+        timer = threading.Timer(delay, _warm)
+        timer.daemon = True
+        timer.start()
+
+
+def record(context, warm):
+    '''Counts a team's unlocks as ready or not, if it's in its surge window.'''
+    if not context.start_time <= context.now < context.start_time + SURGE_WINDOW:
+        return
+    global _oldest
+    with _lock:
+        _pending['warm' if warm else 'cold'] += 1
+        if _oldest is None:
+            _oldest = time.monotonic()
+
+
+def flush():
+    '''Adds this worker's counts to the shared ones.'''
+    global _pending, _oldest
+    with _lock:
+        pending, _pending, _oldest = _pending, collections.Counter(), None
+    for (kind, count) in pending.items():
+        key = COUNT_KEY % kind
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            if not cache.add(key, count, None):
+                cache.incr(key, count)
+
+
+@receiver(request_finished)
+def flush_if_due(**kwargs):
+    oldest = _oldest
+    if oldest is not None and time.monotonic() - oldest >= FLUSH_INTERVAL:
+        try:
+            flush()
+        except Exception:
+            logger.exception('Could not write surge counts')
+
+
+atexit.register(flush)
+
+
+def counts():
+    # Other workers' latest counts won't be in yet, but ours can be.
+    flush()
+    values = cache.get_many([COUNT_KEY % 'warm', COUNT_KEY % 'cold'])
+    return {
+        'warm': values.get(COUNT_KEY % 'warm', 0),
+        'cold': values.get(COUNT_KEY % 'cold', 0),
+    }
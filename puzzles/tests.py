@@ -1,11 +1,32 @@
+import csv
+import gzip
+import io
+import json
 import logging
-from datetime import datetime
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest import mock
 
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 import django.urls as urls
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
 from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from .models import Puzzle, Round, Team, AnswerSubmission
+from . import catalog, guesses, puzzle_views, scheduler, surge
+from .catalog import get_catalog
+from .hunt_config import HUNT_START_TIME, HUNT_END_TIME, META_META_SLUG
+from .messaging import DiscordInterface
+from .models import Puzzle, PuzzleMessage, PuzzleStats, Round, Team, AnswerSubmission, PuzzleUnlock, OutboundMessage, Erratum, Hint, TeamMember
+from .outbound import StubSink, deliver_pending
 
 # wow, we log a lot of things as INFO
 logging.disable(logging.INFO)
@@ -15,9 +36,24 @@ def create_user(name):
         username=name, email=name + "@example.com", password=name + "secret"
     )
 
+class FakeDiscordHttp:
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, channel, content, embeds):
+        self.calls.append(("send", content))
+        return {"id": "1234"}
+
+    async def edit_message(self, channel, message_id, **fields):
+        self.calls.append(("edit", message_id))
+
 
 class Misc(TestCase):
     def setUp(self):
+        # The cache isn't rolled back between tests like the database is, and
+        # nor are the counts surge.py keeps until it adds them to the cache.
+        surge.flush()
+        cache.clear()
         self.user_a = User.objects.create_user(
             username="a", email="a@example.com", password="secret"
         )
@@ -118,3 +154,718 @@ class Misc(TestCase):
 
         response = c.get(urls.reverse("team", args=(self.team_b.team_name,)))
         self.assertEqual(response.status_code, 200)
+
+    def test_unlocks_persisted(self):
+        now = timezone.now()
+        self.team_a.start_offset = HUNT_START_TIME - now
+        self.team_a.save()
+        first_puzzle = Puzzle.objects.create(
+            name="First",
+            slug="first",
+            answer="FIRST",
+            round=self.sample_round,
+            unlock_hours=0,
+        )
+        Puzzle.objects.create(
+            name="Later",
+            slug="later",
+            answer="LATER",
+            round=self.sample_round,
+            unlock_hours=5,
+        )
+
+        c = Client()
+        c.login(username="a", password="secret")
+        response = c.get(urls.reverse("puzzles"))
+        self.assertEqual(response.status_code, 200)
+        self.team_a.refresh_from_db()
+        # valid until the next time unlock
+        self.assertEqual(self.team_a.unlocks_valid_until, now + timedelta(hours=5))
+        self.assertEqual(
+            set(self.team_a.puzzleunlock_set.values_list('puzzle__slug', flat=True)),
+            {"first"})
+
+        AnswerSubmission.objects.create(
+            team=self.team_a,
+            puzzle=first_puzzle,
+            submitted_answer="FIRST",
+            is_correct=True,
+            used_free_answer=False,
+        )
+        self.team_a.refresh_from_db()
+        self.assertLess(self.team_a.unlocks_valid_until, timezone.now())
+
+        response = c.get(urls.reverse("puzzles"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            set(self.team_a.puzzleunlock_set.values_list('puzzle__slug', flat=True)),
+            {"first", "sample"})
+
+    def test_team_snapshot(self):
+        self.assertEqual(self.team_a.submissions, ())
+        team = Team.objects.get(id=self.team_a.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(team.submissions, ())
+
+        AnswerSubmission.objects.create(
+            team=self.team_a,
+            puzzle=self.sample_puzzle,
+            submitted_answer="WRONG",
+            is_correct=False,
+            used_free_answer=False,
+        )
+        team = Team.objects.get(id=self.team_a.id)
+        self.assertEqual(
+            [submission.submitted_answer for submission in team.submissions],
+            ["WRONG"])
+        # Rows find their puzzles in the catalog, not the database.
+        get_catalog()
+        with self.assertNumQueries(0):
+            self.assertEqual(team.submissions[0].puzzle, self.sample_puzzle)
+
+        # Or, if this worker's catalog is behind, in a new one.
+        stale = get_catalog()
+        new = Puzzle.objects.create(name="New", slug="new", answer="NEW", round=self.sample_round)
+        AnswerSubmission.objects.create(
+            team=self.team_a,
+            puzzle=new,
+            submitted_answer="NEWER",
+            is_correct=False,
+            used_free_answer=False,
+        )
+        with mock.patch.object(catalog, "_catalog", stale), \
+                mock.patch.object(catalog, "_checked_at", time.monotonic()):
+            team = Team.objects.get(id=self.team_a.id)
+            self.assertEqual(team.submissions[0].puzzle, new)
+
+        # Saving an old copy of the team doesn't roll back the version.
+        self.team_a.save()
+        self.assertEqual(Team.objects.get(id=self.team_a.id).state_version, team.state_version)
+
+    def test_catalog(self):
+        catalog = get_catalog()
+        self.assertIs(get_catalog(), catalog)
+        self.assertEqual(catalog.puzzles_by_slug["sample"], self.sample_puzzle)
+        self.assertEqual(catalog.puzzle_messages(self.sample_puzzle, "KEEPGOING"), ())
+
+        PuzzleMessage.objects.create(
+            puzzle=self.sample_puzzle, guess="keep going", response="Keep going!")
+        catalog = get_catalog()
+        self.assertEqual(
+            [message.response for message in catalog.puzzle_messages(self.sample_puzzle, "KEEPGOING")],
+            ["Keep going!"])
+
+        self.sample_puzzle.name = "Renamed"
+        self.sample_puzzle.save()
+        self.assertEqual(get_catalog().puzzles_by_slug["sample"].name, "Renamed")
+
+    def test_check_answer(self):
+        PuzzleMessage.objects.create(puzzle=self.sample_puzzle, guess="SAMPLE*", response="Nearly")
+        PuzzleMessage.objects.create(puzzle=self.sample_puzzle, guess="Sample ans*", response="Closer")
+        catalog = get_catalog()
+        def check(guess):
+            answer, is_correct, messages = catalog.check_answer(self.sample_puzzle, guess)
+            return answer, is_correct, [message.response for message in messages]
+        self.assertEqual(check("sample answer"), ("SAMPLEANSWER", True, []))
+        self.assertEqual(check("sample answers"), ("SAMPLEANSWERS", False, ["Closer"]))
+        self.assertEqual(check("samples"), ("SAMPLES", False, ["Nearly"]))
+        self.assertEqual(check("sam"), ("SAM", False, []))
+
+    def test_leaderboard(self):
+        self.assertEqual(self.team_a.leaderboard_rank(None), 1)
+        AnswerSubmission.objects.create(
+            team=self.team_b,
+            puzzle=self.sample_puzzle,
+            submitted_answer="SAMPLEANSWER",
+            is_correct=True,
+            used_free_answer=False,
+        )
+        self.team_a.refresh_from_db()
+        self.team_b.refresh_from_db()
+        self.assertEqual(self.team_b.total_solves, 1)
+        self.assertIsNotNone(self.team_b.last_solve_time)
+        self.assertEqual(
+            [team['id'] for team in Team.leaderboard(None)],
+            [self.team_b.id, self.team_a.id])
+        self.assertEqual(self.team_b.leaderboard_rank(None), 1)
+        self.assertEqual(self.team_a.leaderboard_rank(None), 2)
+
+        self.team_b.answersubmission_set.all().delete()
+        self.team_b.refresh_from_db()
+        self.assertEqual(self.team_b.total_solves, 0)
+        self.assertIsNone(self.team_b.last_solve_time)
+
+    def test_team_rank(self):
+        AnswerSubmission.objects.create(
+            team=self.team_a,
+            puzzle=self.sample_puzzle,
+            submitted_answer="SAMPLEANSWER",
+            is_correct=True,
+            used_free_answer=False,
+        )
+        c = Client()
+        response = c.get(urls.reverse("team-rank", args=["Team A"]))
+        self.assertEqual(response.json(), {
+            "rank": 1, "ahead": [], "behind": ["Team 🐉 B+B/B <script>&mdash;"]})
+        response = c.get(urls.reverse("team-rank", args=["Team 🐉 B+B/B <script>&mdash;"]))
+        self.assertEqual(response.json(), {"rank": 2, "ahead": ["Team A"], "behind": []})
+
+    def test_puzzle_stats(self):
+        for answer, is_correct in (("WRONG", False), ("SAMPLEANSWER", True)):
+            submission = AnswerSubmission(
+                team=self.team_a,
+                puzzle=self.sample_puzzle,
+                submitted_answer=answer,
+                is_correct=is_correct,
+                used_free_answer=False,
+            )
+            # Counting it takes one UPDATE, with no separate query to tell if
+            # it's the team's first guess.
+            with CaptureQueriesContext(connection) as queries:
+                submission.save()
+            sql = [query["sql"] for query in queries]
+            self.assertEqual(len([query for query in sql if "puzzles_puzzlestats" in query]), 1)
+            self.assertFalse([query for query in sql if query.startswith('SELECT (1) AS "a"')])
+        stats = PuzzleStats.get_all()[self.sample_puzzle.id]
+        self.assertEqual((stats.solves, stats.guesses, stats.guess_teams), (1, 2, 1))
+
+        self.team_a.is_hidden = True
+        self.team_a.save()
+        stats = PuzzleStats.get_all()[self.sample_puzzle.id]
+        self.assertEqual((stats.solves, stats.guesses, stats.guess_teams), (0, 0, 0))
+
+        self.team_a.is_hidden = False
+        self.team_a.save()
+        self.team_a.answersubmission_set.filter(is_correct=True).delete()
+        stats = PuzzleStats.get_all()[self.sample_puzzle.id]
+        self.assertEqual((stats.solves, stats.guesses, stats.guess_teams), (0, 1, 1))
+
+    def test_bigboard(self):
+        User.objects.create_superuser(username="admin", email="", password="admin")
+        c = Client()
+        c.login(username="admin", password="admin")
+        response = c.get(urls.reverse("bigboard"))
+        self.assertEqual(response.status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            AnswerSubmission.objects.create(
+                team=self.team_a,
+                puzzle=self.sample_puzzle,
+                submitted_answer="WRONG",
+                is_correct=False,
+                used_free_answer=False,
+            )
+            AnswerSubmission.objects.create(
+                team=self.team_a,
+                puzzle=self.sample_puzzle,
+                submitted_answer="SAMPLEANSWER",
+                is_correct=True,
+                used_free_answer=False,
+            )
+        response = c.get(urls.reverse("bigboard"))
+        board = response.context["board"]
+        self.assertEqual(board[0]["name"], "Team A")
+        self.assertEqual(board[0]["total_solves"], 1)
+        self.assertEqual(board[0]["wrong_guesses"], 1)
+        column = [entry["puzzle"] for entry in response.context["puzzles"]].index(self.sample_puzzle)
+        # flags (solved | wrong), solve position, wrong guesses, hints
+        self.assertEqual(board[0]["cells"][4 * column:4 * column + 4], [2 | 4, 1, 1, 0])
+        self.assertEqual(response.context["puzzles"][column]["total_guesses"], 2)
+
+    def test_outbound_messages(self):
+        OutboundMessage.objects.all().delete()
+        AnswerSubmission.objects.create(
+            team=self.team_a,
+            puzzle=self.sample_puzzle,
+            submitted_answer="WRONG",
+            is_correct=False,
+            used_free_answer=False,
+        )
+        AnswerSubmission.objects.create(
+            team=self.team_a,
+            puzzle=self.sample_puzzle,
+            submitted_answer="ALSOWRONG",
+            is_correct=False,
+            used_free_answer=False,
+        )
+        self.assertEqual(OutboundMessage.objects.filter(sent_datetime=None).count(), 2)
+
+        sink = StubSink()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(deliver_pending(executor, sink), 2)
+            self.assertEqual(deliver_pending(executor, sink), 0)
+        # both alerts go to the same webhook, so they're sent as one message
+        self.assertEqual(len(sink.sent), 1)
+        self.assertIn("ALSOWRONG", sink.sent[0][3])
+        self.assertFalse(OutboundMessage.objects.filter(sent_datetime=None).exists())
+
+        # A failure is only charged to the message that failed, and the ones
+        # after it wait their turn.
+        class FailingSink(StubSink):
+            def send_discord(self, webhook, username, content):
+                if content == "BAD":
+                    raise RuntimeError(content)
+                super().send_discord(webhook, username, content)
+
+        good, bad, later = [OutboundMessage.objects.create(
+            kind=OutboundMessage.DISCORD,
+            destination="webhook",
+            payload=json.dumps({"username": username, "content": content}),
+        ) for (username, content) in (("a", "GOOD"), ("b", "BAD"), ("c", "LATER"))]
+        sink = FailingSink()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(deliver_pending(executor, sink), 3)
+            self.assertEqual(deliver_pending(executor, sink), 0)
+        self.assertEqual([message[3] for message in sink.sent], ["GOOD"])
+        for message in (good, bad, later):
+            message.refresh_from_db()
+        self.assertIsNotNone(good.sent_datetime)
+        self.assertEqual(bad.attempts, 1)
+        self.assertGreater(bad.next_attempt_datetime, timezone.now())
+        self.assertEqual(later.attempts, 0)
+        self.assertIsNone(later.sent_datetime)
+
+    def test_discord_hints(self):
+        hint = Hint.objects.create(team=self.team_a, puzzle=self.sample_puzzle, hint_question="Help?")
+        OutboundMessage.objects.all().delete()
+        interface = DiscordInterface()
+        interface.enabled = True
+        interface.client = mock.Mock(http=FakeDiscordHttp())
+        # Don't look up avatars.
+        interface.avatars_fetched_at = time.monotonic()
+        interface.update_hint(hint)
+        interface.update_hint(hint)
+        # Left for the bot, not send_outbound_messages.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(deliver_pending(executor, StubSink()), 0)
+        # Only the latest state of a hint gets sent.
+        self.assertEqual(async_to_sync(interface.deliver_pending)(), 1)
+        self.assertEqual(len(interface.client.http.calls), 1)
+        self.assertEqual(interface.client.http.calls[0][0], "send")
+        hint.refresh_from_db()
+        self.assertEqual(hint.discord_id, "1234")
+
+        hint.status = Hint.ANSWERED
+        hint.claimer = "Alice"
+        hint.response = "Yes"
+        interface.clear_hint(hint)
+        self.assertEqual(async_to_sync(interface.deliver_pending)(), 1)
+        self.assertEqual(interface.client.http.calls[1], ("edit", "1234"))
+        self.assertEqual(async_to_sync(interface.deliver_pending)(), 0)
+        self.assertFalse(OutboundMessage.objects.filter(sent_datetime=None).exists())
+
+    def test_benchmark(self):
+        User.objects.create_superuser(username="admin", email="", password="admin")
+        out = io.StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = os.path.join(directory, "baseline.json")
+            call_command("benchmark", iterations=1, listeners=5, team=self.team_b.team_name,
+                save_baseline=baseline, stdout=out)
+            with open(baseline) as f:
+                self.assertIn("solve", json.load(f))
+            call_command("benchmark", iterations=1, team=self.team_b.team_name, only=["puzzles"],
+                baseline=baseline, threshold=1000, stdout=out)
+        self.assertIn("No regressions", out.getvalue())
+
+    def test_generate_random_teams(self):
+        call_command("generate_random_teams", 30, seed=1, stdout=io.StringIO())
+        self.assertEqual(Team.objects.count(), 32)
+        self.assertTrue(AnswerSubmission.objects.filter(is_correct=True).exists())
+        # The generator fills in the leaderboard columns itself.
+        teams = list(Team.objects.order_by("id").values_list("total_solves", "last_solve_time"))
+        Team.update_scoreboard(Team.objects.values_list("id", flat=True))
+        self.assertEqual(teams, list(Team.objects.order_by("id").values_list("total_solves", "last_solve_time")))
+        # And recounts the hints they've used.
+        self.assertTrue(Hint.objects.exists())
+        for team in Team.objects.all():
+            self.assertEqual(team.hints_used, team.hint_set.count())
+        stats = PuzzleStats.objects.get(puzzle=self.sample_puzzle)
+        self.assertEqual(stats.solves, AnswerSubmission.objects.filter(
+            puzzle=self.sample_puzzle, is_correct=True).count())
+
+    def test_guess_export(self):
+        User.objects.create_superuser(username="admin", email="", password="admin")
+        c = Client()
+        c.login(username="admin", password="admin")
+        for answer in ("WRONG", "SAMPLEANSWER"):
+            AnswerSubmission.objects.create(
+                team=self.team_a,
+                puzzle=self.sample_puzzle,
+                submitted_answer=answer,
+                is_correct=answer == "SAMPLEANSWER",
+                used_free_answer=False,
+            )
+        response = c.get(urls.reverse("guess-csv"))
+        rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual([row[3:] for row in rows], [["WRONG", "N"], ["SAMPLEANSWER", "Y"]])
+
+        response = c.get(urls.reverse("guess-csv"), {"format": "jsonl", "gzip": "1", "puzzle": "sample-ii"})
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), b"")
+        response = c.get(urls.reverse("guess-csv"), {"format": "jsonl", "gzip": "1", "puzzle": "sample"})
+        lines = gzip.decompress(b"".join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(json.loads(lines[1])["result"], "Y")
+
+    def test_metrics(self):
+        User.objects.create_superuser(username="admin", email="", password="admin")
+        c = Client()
+        self.assertEqual(c.get(urls.reverse("metrics-json")).status_code, 404)
+        c.login(username="admin", password="admin")
+        for _ in range(3):
+            c.get(urls.reverse("teams"))
+        rows = {row["name"]: row for row in c.get(urls.reverse("metrics-json")).json()["urls"]}
+        self.assertGreaterEqual(rows["teams"]["requests"], 3)
+        self.assertGreater(rows["teams"]["mean_queries"], 0)
+        self.assertGreater(rows["teams"]["mean_computations"], 0)
+        self.assertGreater(rows["teams"]["mean_cache_hits"] + rows["teams"]["mean_cache_misses"], 0)
+        self.assertEqual(c.get(urls.reverse("metrics")).status_code, 200)
+
+    def test_context_profiling(self):
+        User.objects.create_superuser(username="admin", email="", password="admin")
+        c = Client()
+        c.login(username="admin", password="admin")
+        with self.settings(DEBUG=True):
+            timing = c.get(urls.reverse("teams"))["Server-Timing"]
+        self.assertIn("Context.team;dur=", timing)
+        self.assertIn("first by views.py:teams_generic", timing)
+        self.assertIn("first by base.html", timing)
+        properties = {row["name"]: row for row in c.get(urls.reverse("metrics-json")).json()["properties"]}
+        self.assertGreater(properties["Context.team"]["computations"], 0)
+
+    def test_context_invalidation(self):
+        team = Team.objects.get(id=self.team_a.id)
+        self.assertEqual(team.num_hints_remaining, team.num_hints_total)
+        self.assertEqual(team.solves, {})
+        team.invalidate("submissions")
+        self.assertFalse(team.is_computed("solves"))
+        self.assertTrue(team.is_computed("num_hints_remaining"))
+
+        # Saving a submission for this team updates what it has computed.
+        AnswerSubmission.objects.create(
+            team=team,
+            puzzle=self.sample_puzzle,
+            submitted_answer="SAMPLEANSWER",
+            is_correct=True,
+            used_free_answer=False,
+        )
+        self.assertEqual(list(team.solves), [self.sample_puzzle.id])
+
+    def test_errata(self):
+        Erratum.objects.create(updates_text="Everything is fine.", published=True)
+        Erratum.objects.create(puzzle=self.sample_puzzle, updates_text="$PUZZLE is broken.", published=True)
+        Erratum.objects.create(updates_text="Not yet.")
+        valid_until = Team.objects.get(id=self.team_a.id).unlocks_valid_until
+        c = Client()
+        c.login(username="a", password="secret")
+        response = c.get(urls.reverse("errata"))
+        self.assertContains(response, "Everything is fine.")
+        self.assertNotContains(response, "is broken.")
+        self.assertNotContains(response, "Not yet.")
+        # Seeing errata doesn't need the team's unlocks.
+        self.assertEqual(Team.objects.get(id=self.team_a.id).unlocks_valid_until, valid_until)
+
+        PuzzleUnlock.objects.create(team=self.team_a, puzzle=self.sample_puzzle, unlock_datetime=timezone.now())
+        self.assertContains(c.get(urls.reverse("errata")), "is broken.")
+
+    def test_unclaimed_hints(self):
+        self.assertEqual(Hint.unclaimed_count(), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            hint = Hint.objects.create(team=self.team_a, puzzle=self.sample_puzzle, hint_question="Help?")
+        with self.assertNumQueries(0):
+            self.assertEqual(Hint.unclaimed_count(), 1)
+        hint.claimer = "Alice"
+        hint.claimed_datetime = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            hint.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(Hint.unclaimed_count(), 0)
+
+    def test_claim_hint(self):
+        hint = Hint.objects.create(team=self.team_a, puzzle=self.sample_puzzle, hint_question="Help?")
+        User.objects.create_superuser(username="admin", email="", password="admin")
+        c = Client()
+        c.login(username="admin", password="admin")
+        c.cookies["claimer"] = "Alice"
+        # Claiming doesn't change what the hint costs the team.
+        with mock.patch.object(Team, "update_allowances") as update_allowances:
+            c.get(urls.reverse("hint", args=(hint.id,)), {"claim": "1"})
+            hint.refresh_from_db()
+            self.assertEqual(hint.claimer, "Alice")
+            c.post(urls.reverse("hint", args=(hint.id,)), {"action": "unclaim"})
+            hint.refresh_from_db()
+            self.assertEqual(hint.claimer, "")
+        update_allowances.assert_not_called()
+
+    def test_guess_counts(self):
+        User.objects.create_superuser(username="admin", email="", password="admin")
+        for team in (self.team_a, self.team_b):
+            with self.captureOnCommitCallbacks(execute=True):
+                AnswerSubmission.objects.create(
+                    team=team,
+                    puzzle=self.sample_puzzle,
+                    submitted_answer="WRONG",
+                    is_correct=False,
+                    used_free_answer=False,
+                )
+        self.assertIn(":skull_crossbones:", OutboundMessage.objects.order_by("-id")[0].payload)
+        with self.assertNumQueries(0):
+            self.assertEqual(guesses.get(self.sample_puzzle.id, "WRONG"), 2)
+
+        # Submissions that are rolled back don't count.
+        with self.captureOnCommitCallbacks(execute=True):
+            AnswerSubmission.objects.create(
+                team=self.team_a,
+                puzzle=self.sample_puzzle,
+                submitted_answer="OTHER",
+                is_correct=False,
+                used_free_answer=False,
+            )
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                AnswerSubmission.objects.create(
+                    team=self.team_b,
+                    puzzle=self.sample_puzzle,
+                    submitted_answer="OTHER",
+                    is_correct=False,
+                    used_free_answer=False,
+                )
+                raise RuntimeError
+        with self.assertNumQueries(0):
+            self.assertEqual(guesses.get(self.sample_puzzle.id, "OTHER"), 1)
+
+        c = Client()
+        c.login(username="admin", password="admin")
+        response = c.get(urls.reverse("wrong-answers"))
+        self.assertContains(response, "<tr><td>WRONG</td><td>2</td></tr>", html=True)
+
+    def test_puzzle_views(self):
+        # Write any views left over from other tests, which would otherwise be
+        # due to be written after the first request here.
+        puzzle_views.flush()
+        unlock = PuzzleUnlock.objects.create(
+            team=self.team_a, puzzle=self.sample_puzzle, unlock_datetime=timezone.now())
+        c = Client()
+        c.login(username="a", password="secret")
+        self.assertEqual(c.get(urls.reverse("puzzle", args=("sample",))).status_code, 200)
+        # Not written yet, but the team already sees it as viewed.
+        unlock.refresh_from_db()
+        self.assertIsNone(unlock.view_datetime)
+        team = Team.objects.get(id=self.team_a.id)
+        self.assertNotIn(self.sample_puzzle.id, team.unviewed_puzzles)
+
+        # Views that fail to be written are kept for the next try.
+        with mock.patch("django.db.models.query.QuerySet.update", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                puzzle_views.flush()
+        unlock.refresh_from_db()
+        self.assertIsNone(unlock.view_datetime)
+
+        puzzle_views.flush()
+        unlock.refresh_from_db()
+        self.assertIsNotNone(unlock.view_datetime)
+        team = Team.objects.get(id=self.team_a.id)
+        self.assertIsNotNone(team.db_unlocks[self.sample_puzzle.id].view_datetime)
+
+    def test_puzzle_view_on_unlock(self):
+        # Opening a puzzle in the same request that unlocks it, so the unlock
+        # hasn't been given an id.
+        puzzle_views.flush()
+        self.team_a.start_offset = HUNT_START_TIME - timezone.now()
+        self.team_a.save()
+        puzzle = Puzzle.objects.create(
+            name="Opener",
+            slug="opener",
+            answer="OPENER",
+            round=self.sample_round,
+            unlock_hours=0,
+        )
+        self.assertFalse(PuzzleUnlock.objects.filter(team=self.team_a, puzzle=puzzle).exists())
+        c = Client()
+        c.login(username="a", password="secret")
+        self.assertEqual(c.get(urls.reverse("puzzle", args=("opener",))).status_code, 200)
+        team = Team.objects.get(id=self.team_a.id)
+        self.assertNotIn(puzzle.id, team.unviewed_puzzles)
+
+        puzzle_views.flush()
+        unlock = PuzzleUnlock.objects.get(team=self.team_a, puzzle=puzzle)
+        self.assertIsNotNone(unlock.view_datetime)
+
+    def test_scheduler(self):
+        now = timezone.now()
+        self.team_a.start_offset = HUNT_START_TIME - (now - timedelta(hours=1))
+        self.team_a.save()
+        later = Puzzle.objects.create(
+            name="Later",
+            slug="later",
+            answer="LATER",
+            round=self.sample_round,
+            unlock_hours=2,
+        )
+        c = Client()
+        c.login(username="a", password="secret")
+        self.assertNotContains(c.get(urls.reverse("puzzles")), "Later")
+
+        [event] = [event for event in scheduler.events(now, now + timedelta(hours=2))
+            if event.kind == scheduler.UNLOCK and event.start_offset == self.team_a.start_offset]
+        self.assertEqual(event.puzzles, [later])
+        scheduler.prepare(event)
+        self.assertTrue(PuzzleUnlock.objects.filter(team=self.team_a, puzzle=later).exists())
+        # Inserted, but not visible until it's due.
+        self.assertNotContains(c.get(urls.reverse("puzzles")), "Later")
+
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)('team-%d' % self.user_a.id, channel)
+        real_localtime = timezone.localtime
+        with mock.patch('django.utils.timezone.localtime',
+                lambda value=None, *args: real_localtime(value or event.time, *args)):
+            scheduler.fire(event)
+            self.assertContains(c.get(urls.reverse("puzzles")), "Later")
+        message = json.loads(async_to_sync(layer.receive)(channel)['data'])
+        self.assertEqual(message['link'], urls.reverse("puzzle", args=("later",)))
+
+    def test_scheduler_meta_meta(self):
+        self.team_a.start_offset = HUNT_START_TIME - timezone.now()
+        self.team_a.save()
+        meta_meta = Puzzle.objects.create(
+            name="Meta-meta",
+            slug=META_META_SLUG,
+            answer="METAMETA",
+            round=self.sample_round,
+            order=1,
+        )
+        meta = Puzzle.objects.create(
+            name="Meta",
+            slug="meta",
+            answer="META",
+            round=self.sample_round,
+            order=2,
+            is_meta=True,
+        )
+        # The only meta comes after the meta-meta, so it doesn't hold it back.
+        self.assertIn(meta_meta.id, scheduler._unlocked_at_start(get_catalog()))
+        c = Client()
+        c.login(username="a", password="secret")
+        self.assertContains(c.get(urls.reverse("puzzles")), "Meta-meta")
+
+        meta.order = 0
+        meta.save()
+        self.assertNotIn(meta_meta.id, scheduler._unlocked_at_start(get_catalog()))
+
+    def test_erratum_emails(self):
+        now = timezone.now()
+        for (team, email, unlocked) in (
+                (self.team_a, "a@example.com", now - timedelta(hours=1)),
+                # Inserted by the scheduler, but not due yet.
+                (self.team_b, "b@example.com", now + timedelta(minutes=1))):
+            TeamMember.objects.create(team=team, name="Member", email=email)
+            PuzzleUnlock.objects.create(team=team, puzzle=self.sample_puzzle, unlock_datetime=unlocked)
+        out = io.StringIO()
+        call_command("erratum_emails", "sample", stdout=out)
+        self.assertIn("a@example.com", out.getvalue())
+        self.assertNotIn("b@example.com", out.getvalue())
+
+    def test_surge(self):
+        now = timezone.now()
+        self.team_a.start_offset = HUNT_START_TIME - (now + timedelta(minutes=1))
+        self.team_a.save()
+        Puzzle.objects.create(
+            name="First",
+            slug="first",
+            answer="FIRST",
+            round=self.sample_round,
+            unlock_hours=0,
+        )
+        c = Client()
+        c.login(username="a", password="secret")
+        self.assertContains(c.get(urls.reverse("puzzles")), "location.reload()")
+
+        surge.warm()
+        # As if the team had been registered like this.
+        Team.objects.filter(id=self.team_a.id).update(unlocks_valid_until=None)
+        [event] = [event for event in scheduler.events(now, now + timedelta(minutes=2))
+            if event.start_offset == self.team_a.start_offset]
+        scheduler.prepare(event)
+        self.team_a.refresh_from_db()
+        self.assertEqual(self.team_a.unlocks_valid_until, HUNT_END_TIME)
+
+        real_localtime = timezone.localtime
+        with mock.patch('django.utils.timezone.localtime',
+                lambda value=None, *args: real_localtime(value or event.time, *args)):
+            self.assertContains(c.get(urls.reverse("puzzles")), "First")
+        self.assertEqual(surge.counts(), {'warm': 1, 'cold': 0})
+
+    def test_allowance_ledger(self):
+        stale = Team.objects.get(id=self.team_a.id)
+        Team.award(Team.objects.filter(id=self.team_a.id), hints=2, free_answers=1)
+        Team.award(Team.objects.filter(id=self.team_a.id), hints=1)
+        # Saving a team loaded before the awards doesn't undo them.
+        stale.team_name = "Team A2"
+        stale.save()
+
+        hint = Hint.objects.create(team=self.team_a, puzzle=self.sample_puzzle, hint_question="Help?")
+        Hint.objects.create(team=self.team_a, puzzle=self.sample_puzzle, hint_question="More?", is_followup=True)
+        AnswerSubmission.objects.create(
+            team=self.team_a,
+            puzzle=self.sample_puzzle_2,
+            submitted_answer="SAMPLE",
+            is_correct=True,
+            used_free_answer=True,
+        )
+        team = Team.objects.get(id=self.team_a.id)
+        self.assertEqual((team.total_hints_awarded, team.total_free_answers_awarded), (3, 1))
+        self.assertEqual((team.num_hints_used, team.num_free_answers_used), (1, 1))
+
+        hint.status = Hint.REFUNDED
+        hint.save(update_fields=('status',))
+        team = Team.objects.get(id=self.team_a.id)
+        self.assertEqual(team.num_hints_used, 0)
+        self.assertEqual(team.num_hints_used, sum(hint.consumes_hint for hint in team.asked_hints))
+
+    def test_puzzle_index(self):
+        for answer in ("WRONG", "ALSOWRONG", "SAMPLEANSWER"):
+            AnswerSubmission.objects.create(
+                team=self.team_a,
+                puzzle=self.sample_puzzle,
+                submitted_answer=answer,
+                is_correct=answer == "SAMPLEANSWER",
+                used_free_answer=False,
+            )
+        Hint.objects.create(team=self.team_a, puzzle=self.sample_puzzle, hint_question="Help?")
+        team = Team.objects.get(id=self.team_a.id)
+        self.assertEqual(
+            [submission.submitted_answer for submission in team.puzzle_submissions(self.sample_puzzle)],
+            ["SAMPLEANSWER", "ALSOWRONG", "WRONG"])
+        self.assertEqual(team.num_wrong_guesses(self.sample_puzzle), 2)
+        self.assertIn("ALSOWRONG", team.tried_answers(self.sample_puzzle))
+        self.assertEqual(len(team.puzzle_hints(self.sample_puzzle)), 1)
+        self.assertEqual(team.puzzle_submissions(self.sample_puzzle_2), ())
+        self.assertEqual(team.num_wrong_guesses(self.sample_puzzle_2), 0)
+
+    def test_history_rows(self):
+        self.team_a.start_offset = HUNT_START_TIME - timezone.now()
+        self.team_a.save()
+        AnswerSubmission.objects.create(
+            team=self.team_a,
+            puzzle=self.sample_puzzle,
+            submitted_answer="WRONGANSWER",
+            is_correct=False,
+            used_free_answer=False,
+        )
+        AnswerSubmission.objects.create(
+            team=self.team_a,
+            puzzle=self.sample_puzzle,
+            submitted_answer="SAMPLEANSWER",
+            is_correct=True,
+            used_free_answer=False,
+        )
+        Hint.objects.create(team=self.team_a, puzzle=self.sample_puzzle, hint_question="Help?")
+        team = Team.objects.get(id=self.team_a.id)
+        for row in (*team.submissions, *team.asked_hints, *team.snapshot["db_unlocks"].values()):
+            self.assertFalse(hasattr(row, "__dict__"))
+        # Puzzles come from the catalog rather than being stored per row.
+        self.assertIs(team.submissions[0].puzzle, get_catalog().puzzles_by_id[self.sample_puzzle.id])
+
+        c = Client()
+        c.login(username="a", password="secret")
+        self.assertContains(c.get(urls.reverse("team", args=(self.team_a.team_name,))), "Sample")
+        self.assertContains(c.get(urls.reverse("solve", args=("sample",))), "WRONGANSWER")
+        self.assertContains(c.get(urls.reverse("hints", args=("sample",))), "Help?")
@@ -7,6 +7,7 @@ import os
 import re
 import requests
 import traceback
+import zlib
 from collections import defaultdict, OrderedDict, Counter
 from functools import wraps
 from urllib.parse import quote, unquote
@@ -19,10 +20,13 @@ from django.contrib.auth.models import User
 from django.contrib.auth.tokens import default_token_generator
 from django.db.models import F, Q, Avg, Count
 from django.forms import formset_factory, modelformset_factory
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
 from django.template import TemplateDoesNotExist
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_datetime
 from django.utils.encoding import force_bytes
 from django.utils.html import escape
 from django.utils.http import urlsafe_base64_encode
@@ -33,13 +37,12 @@ from django.views.decorators.http import require_GET, require_POST
 from django.views.static import serve
 
 from puzzles.models import (
-    Round,
     Puzzle,
     Team,
     TeamMember,
     PuzzleUnlock,
     AnswerSubmission,
-    PuzzleMessage,
+    PuzzleStats,
     Survey,
     Hint,
 )
@@ -70,8 +73,14 @@ from puzzles.hunt_config import (
     META_META_SLUG,
 )
 
+from puzzles import guesses
+from puzzles import metrics as request_metrics
+from puzzles import surge
+from puzzles.bigboard import bigboard_data
 from puzzles.messaging import send_mail_wrapper, dispatch_victory_alert, show_victory_notification
+from puzzles.ranking import get_rank, get_neighbors
 from puzzles.shortcuts import dispatch_shortcut
+from puzzles.templatetags.puzzle_tags import format_time
 
 
 def validate_puzzle(require_team=False):
@@ -83,16 +92,15 @@ def validate_puzzle(require_team=False):
     def decorator(f):
         @wraps(f)
         def inner(request, slug):
-            puzzle = Puzzle.objects.select_related().filter(slug=slug).first()
+            puzzle = request.context.catalog.puzzles_by_slug.get(slug)
             request.context.puzzle = puzzle
             if not puzzle or puzzle not in request.context.unlocks:
                 messages.error(request, _('Invalid puzzle name.'))
                 return redirect('puzzles')
             if request.context.team:
-                unlock = request.context.team.db_unlocks.get(puzzle.id)
-                if unlock and not unlock.view_datetime:
-                    unlock.view_datetime = request.context.now
-                    unlock.save()
+                if puzzle.id in request.context.team.unviewed_puzzles:
+                    request.context.team.record_puzzle_view(
+                        request.context.team.db_unlocks[puzzle.id], request.context.now)
             elif require_team:
                 messages.error(
                     request,
@@ -313,16 +321,7 @@ def team(request, team_name):
         messages.error(request, _('Team “{}” not found.').format(team_name))
         return redirect('teams')
 
-    # This Team.leaderboard_teams() call is expensive, but is
-    # the only way right now to calculate rank accurately.
-    # Hopefully it is not an issue in practice (especially
-    # after all this database optimization --beta)
-    leaderboard_ids = Team.leaderboard_teams(user_team).values_list('id', flat=True)
-    rank = None
-    for i, leaderboard_id in enumerate(leaderboard_ids):
-        if team.id == leaderboard_id:
-            rank = i + 1 # ranks are 1-indexed
-            break
+    rank = get_rank(team, user_team)
 
     guesses = defaultdict(int)
     correct = {}
@@ -376,6 +375,23 @@ def team(request, team_name):
         'rank': rank,
     })
 
+@require_GET
+def team_rank(request, team_name):
+    '''A team's leaderboard rank and the teams around it, as JSON.'''
+    user_team = request.context.team
+    team_query = Team.objects.filter(team_name=team_name)
+    if not request.context.is_superuser:
+        team_query = team_query.exclude(Q(is_hidden=True) & ~Q(id=getattr(user_team, 'id', None)))
+    team = team_query.first()
+    if not team:
+        raise Http404
+    ahead, behind = get_neighbors(team, user_team)
+    return JsonResponse({
+        'rank': get_rank(team, user_team),
+        'ahead': [neighbor.team_name for neighbor in ahead],
+        'behind': [neighbor.team_name for neighbor in behind],
+    })
+
 def teams_generic(request, hide_hidden):
     '''List all teams on a leaderboard.'''
     team_name = request.GET.get('team')
@@ -464,13 +480,16 @@ def puzzles(request):
     if request.context.hunt_has_started:
         return render(request, 'puzzles.html', {'rounds': render_puzzles(request)})
     elif request.context.hunt_has_almost_started:
-        return render(request, 'countdown.html', {'start': request.context.start_time})
+        return render(request, 'countdown.html', {
+            'start': request.context.start_time,
+            'jitter': surge.REFRESH_JITTER,
+        })
     else:
         raise Http404
 
 @require_GET
 def round(request, slug):
-    round = Round.objects.filter(slug=slug).first()
+    round = request.context.catalog.rounds_by_slug.get(slug)
     if round:
         rounds = render_puzzles(request)
         if slug in rounds:
@@ -491,22 +510,12 @@ def render_puzzles(request):
     hints = {}
     if team is not None:
         solved = team.solves
-        hints = Counter(hint.puzzle_id for hint in team.asked_hints)
+        hints = team.hints_by_puzzle
 
-    correct = defaultdict(int)
-    guesses = defaultdict(int)
-    teams = defaultdict(set)
+    stats = {}
     full_stats = request.context.is_superuser or request.context.hunt_is_over
     if full_stats or INITIAL_STATS_AVAILABLE:
-        for submission in AnswerSubmission.objects.filter(
-            used_free_answer=False,
-            team__is_hidden=False,
-            submitted_datetime__lt=HUNT_END_TIME,
-        ):
-            if submission.is_correct:
-                correct[submission.puzzle_id] += 1
-            guesses[submission.puzzle_id] += 1
-            teams[submission.puzzle_id].add(submission.team_id)
+        stats = PuzzleStats.get_all()
 
     fields = Survey.fields()
     survey_averages = dict() # puzzle.id -> [average rating for field in fields]
@@ -534,13 +543,13 @@ def render_puzzles(request):
             if puzzle.is_meta:
                 rounds[puzzle.round.slug]['meta_answer'] = puzzle.answer
         if puzzle.id in hints:
-            data['hints'] = hints[puzzle.id]
+            data['hints'] = len(hints[puzzle.id])
         data['full_stats'] = full_stats
-        if puzzle.id in guesses:
+        if puzzle.id in stats and stats[puzzle.id].guesses:
             data['solve_stats'] = {
-                'correct': correct[puzzle.id],
-                'guesses': guesses[puzzle.id],
-                'teams': len(teams[puzzle.id]),
+                'correct': stats[puzzle.id].solves,
+                'guesses': stats[puzzle.id].guesses,
+                'teams': stats[puzzle.id].guess_teams,
             }
         if puzzle.id in survey_averages:
             data['survey_stats'] = [{
@@ -548,8 +557,7 @@ def render_puzzles(request):
                 'adjective': field.adjective,
                 'max_rating': field.max_rating,
             } for (field, average) in zip(fields, survey_averages[puzzle.id])]
-        data['new'] = (team and puzzle.id in team.db_unlocks and
-            not team.db_unlocks[puzzle.id].view_datetime)
+        data['new'] = team and puzzle.id in team.unviewed_puzzles
         rounds[puzzle.round.slug]['puzzles'].append(data)
     return rounds
 
@@ -597,17 +605,9 @@ def solve(request):
             messages.error(request, _('You have no more guesses for this puzzle!'))
             return redirect('solve', puzzle.slug)
 
-        semicleaned_guess = PuzzleMessage.semiclean_guess(request.POST.get('answer'))
-        normalized_answer = Puzzle.normalize_answer(request.POST.get('answer'))
-        puzzle_messages = [
-            message for message in puzzle.puzzlemessage_set.all()
-            if semicleaned_guess == message.semicleaned_guess
-        ]
-        tried_before = any(
-            normalized_answer == submission.submitted_answer
-            for submission in request.context.puzzle_submissions
-        )
-        is_correct = normalized_answer == puzzle.normalized_answer
+        normalized_answer, is_correct, puzzle_messages = request.context.catalog.check_answer(
+            puzzle, request.POST.get('answer'))
+        tried_before = normalized_answer in team.tried_answers(puzzle)
 
         form = SubmitAnswerForm(request.POST)
         if puzzle_messages:
@@ -629,9 +629,6 @@ def solve(request):
             ).save()
 
             if is_correct:
-                if not request.context.hunt_is_over:
-                    team.last_solve_time = request.context.now
-                    team.save()
                 messages.success(request, _('%s is correct!') % puzzle.answer)
                 if puzzle.slug == META_META_SLUG:
                     dispatch_victory_alert(
@@ -715,13 +712,8 @@ def post_hunt_solve(request):
     puzzle = request.context.puzzle
     answer = request.GET.get('answer')
     if answer:
-        semicleaned_guess = PuzzleMessage.semiclean_guess(answer)
-        normalized_answer = Puzzle.normalize_answer(answer)
-        is_correct = normalized_answer == puzzle.normalized_answer
-        puzzle_messages = [
-            message for message in puzzle.puzzlemessage_set.all()
-            if semicleaned_guess == message.semicleaned_guess
-        ]
+        normalized_answer, is_correct, puzzle_messages = request.context.catalog.check_answer(
+            puzzle, answer)
         form = SubmitAnswerForm(request.GET)
         if puzzle_messages:
             for message in puzzle_messages:
@@ -842,7 +834,7 @@ def hints(request):
     relevant_hints_remaining = (team.num_hints_remaining
         if puzzle.round.slug == INTRO_ROUND_SLUG
         else team.num_nonintro_hints_remaining)
-    puzzle_hints = [hint for hint in reversed(team.asked_hints) if hint.puzzle == puzzle]
+    puzzle_hints = team.puzzle_hints(puzzle)[::-1]
     can_followup = bool(puzzle_hints) and puzzle_hints[0].status == Hint.ANSWERED
 
     error = None
@@ -866,9 +858,7 @@ def hints(request):
         form = RequestHintForm(team, request.POST)
         if form.is_valid():
             if relevant_hints_remaining <= 0 and not is_followup:
-                team.total_hints_awarded += 1
-                team.total_free_answers_awarded -= 1
-                team.save()
+                Team.award(Team.objects.filter(id=team.id), hints=1, free_answers=-1)
             Hint(
                 team=team,
                 puzzle=puzzle,
@@ -907,7 +897,7 @@ def hint(request, id):
         if hint.status == Hint.NO_RESPONSE:
             hint.claimed_datetime = None
             hint.claimer = ''
-            hint.save()
+            hint.save(update_fields=('claimed_datetime', 'claimer'))
             messages.warning(request, _('Unclaimed.'))
         return redirect('hint-list')
     elif request.method == 'POST':
@@ -942,7 +932,7 @@ def hint(request, id):
         if claimer:
             hint.claimed_datetime = request.context.now
             hint.claimer = claimer
-            hint.save()
+            hint.save(update_fields=('claimed_datetime', 'claimer'))
             messages.success(request, _('You have claimed this hint!'))
         else:
             messages.error(request, _('Please set your name before claiming hints! '
@@ -986,50 +976,51 @@ def hunt_stats(request):
             solve_times[puzzle.id, team_id] <=
             solve_times[puzzle.round.meta_id, team_id] - datetime.timedelta(minutes=5))
 
-    total_hints = 0
-    hints_by_puzzle = defaultdict(int)
+    # The totals come from PuzzleStats; only the breakdown by hints and
+    # backsolves needs to look at individual solves.
+    stats = PuzzleStats.get_all()
+    empty_stats = PuzzleStats()
+
     hint_counts = defaultdict(int)
-    for hint in Hint.objects.exclude(team__is_hidden=True):
-        total_hints += 1
-        hints_by_puzzle[hint.puzzle_id] += 1
-        if hint.consumes_hint:
-            hint_counts[hint.puzzle_id, hint.team_id] += 1
-
-    total_guesses = 0
-    total_solves = 0
-    total_metas = 0
-    guesses_by_puzzle = defaultdict(int)
-    solves_by_puzzle = defaultdict(int)
-    guess_teams = defaultdict(set)
+    for hint in Hint.objects.exclude(team__is_hidden=True).exclude(
+        status__in=(Hint.REFUNDED, Hint.OBSOLETE),
+    ).filter(is_followup=False):
+        hint_counts[hint.puzzle_id, hint.team_id] += 1
+
     solve_teams = defaultdict(set)
     solve_times = defaultdict(lambda: HUNT_CLOSE_TIME)
-    for submission in (
+    for (puzzle_id, team_id, submitted_datetime) in (
         AnswerSubmission.objects
-        .filter(used_free_answer=False, team__is_hidden=False, submitted_datetime__lt=HUNT_END_TIME)
+        .filter(
+            used_free_answer=False,
+            is_correct=True,
+            team__is_hidden=False,
+            submitted_datetime__lt=HUNT_END_TIME,
+        )
+        .values_list('puzzle_id', 'team_id', 'submitted_datetime')
     ):
-        total_guesses += 1
-        guesses_by_puzzle[submission.puzzle_id] += 1
-        guess_teams[submission.puzzle_id].add(submission.team_id)
-        if submission.is_correct:
-            total_solves += 1
-            solves_by_puzzle[submission.puzzle_id] += 1
-            solve_teams[submission.puzzle_id].add(submission.team_id)
-            solve_times[submission.puzzle_id, submission.team_id] = submission.submitted_datetime
+        solve_teams[puzzle_id].add(team_id)
+        solve_times[puzzle_id, team_id] = submitted_datetime
 
+    total_hints = sum(puzzle_stats.hints for puzzle_stats in stats.values())
+    total_guesses = sum(puzzle_stats.guesses for puzzle_stats in stats.values())
+    total_solves = sum(puzzle_stats.solves for puzzle_stats in stats.values())
+    total_metas = 0
     data = []
     for puzzle in request.context.all_puzzles:
+        puzzle_stats = stats.get(puzzle.id, empty_stats)
         if puzzle.is_meta:
-            total_metas += solves_by_puzzle[puzzle.id]
+            total_metas += puzzle_stats.solves
         data.append({'puzzle': puzzle, 'numbers': [
-            solves_by_puzzle[puzzle.id],
-            guesses_by_puzzle[puzzle.id],
-            hints_by_puzzle[puzzle.id],
+            puzzle_stats.solves,
+            puzzle_stats.guesses,
+            puzzle_stats.hints,
             len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id)]),
             len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id) and hint_counts[puzzle.id, team_id] < 1]),
             len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id) and hint_counts[puzzle.id, team_id] == 1]),
             len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id) and hint_counts[puzzle.id, team_id] > 1]),
             len([1 for team_id in solve_teams[puzzle.id] if not is_forward_solve(puzzle, team_id)]),
-            len(guess_teams[puzzle.id] - solve_teams[puzzle.id]),
+            puzzle_stats.guess_teams - puzzle_stats.solve_teams,
         ]})
 
     return render(request, 'hunt_stats.html', {
@@ -1208,153 +1199,58 @@ def bridge(request):
         'recipients_list': recipients_list,
     })
 
-def bigboard_generic(request, hide_hidden):
-    puzzles = request.context.all_puzzles
-    puzzle_map = {}
-    puzzle_metas = {}
-    meta_meta_id = None
-    for puzzle in puzzles:
-        puzzle_map[puzzle.id] = puzzle
-        if puzzle.slug == META_META_SLUG:
-            meta_meta_id = puzzle.id
-        if not puzzle.is_meta:
-            puzzle_metas[puzzle.id] = puzzle.round.meta_id
-
-    wrong_guesses_map = defaultdict(int) # key (team, puzzle)
-    wrong_guesses_by_team_map = defaultdict(int) # key team
-    solve_position_map = dict() # key (team, puzzle); value n if team is nth to solve this puzzle
-    solve_count_map = defaultdict(int) # puzzle -> number of counts
-    total_guess_map = defaultdict(int) # puzzle -> number of guesses
-    used_hints_map = defaultdict(int) # (team, puzzle) -> number of hints
-    used_hints_by_team_map = defaultdict(int) # team -> number of hints
-    used_hints_by_puzzle_map = defaultdict(int) # puzzle -> number of hints
-    meta_solves_map = defaultdict(int) # team -> number of meta solves
-    solve_time_map = defaultdict(dict) # team -> {puzzle id -> solve time}
-    during_hunt_solve_time_map = defaultdict(dict) # team -> {puzzle id -> solve time}
-    free_answer_map = defaultdict(set) # team -> {puzzle id}
-    free_answer_by_puzzle_map = defaultdict(int) # puzzle -> number of free answers
-
-    correct_q = Q(is_correct=True)
-    incorrect_q = Q(is_correct=False)
-    if hide_hidden:
-        correct_q &= Q(team__is_hidden=False)
-        incorrect_q &= Q(team__is_hidden=False)
+@require_GET
+@require_admin
+def wrong_answers(request):
+    answers = guesses.top_wrong_answers()
+    return render(request, 'wrong_answers.html', {
+        'puzzles': [{
+            'puzzle': puzzle,
+            'answers': answers.get(puzzle.id, ()),
+        } for puzzle in request.context.all_puzzles],
+        'limit': guesses.TOP_WRONG_ANSWERS,
+    })
 
-    for team_id, puzzle_id, used_free_answer, submitted_datetime in (
-        AnswerSubmission.objects
-        .filter(correct_q)
-        .order_by('submitted_datetime')
-        .values_list('team_id', 'puzzle_id', 'used_free_answer', 'submitted_datetime')
-    ):
-        total_guess_map[puzzle_id] += 1
-        if used_free_answer:
-            free_answer_map[team_id].add(puzzle_id)
-            free_answer_by_puzzle_map[puzzle_id] += 1
-        else:
-            solve_count_map[puzzle_id] += 1
-            solve_position_map[(team_id, puzzle_id)] = solve_count_map[puzzle_id]
-            solve_time_map[team_id][puzzle_id] = submitted_datetime
-            if submitted_datetime < HUNT_END_TIME:
-                during_hunt_solve_time_map[team_id][puzzle_id] = submitted_datetime
-        if puzzle_id not in puzzle_metas:
-            meta_solves_map[team_id] += 1
-
-    for aggregate in (
-        AnswerSubmission.objects
-        .filter(incorrect_q)
-        .values('team_id', 'puzzle_id')
-        .annotate(count=Count('*'))
-    ):
-        team_id = aggregate['team_id']
-        puzzle_id = aggregate['puzzle_id']
-        total_guess_map[puzzle_id] += aggregate['count']
-        wrong_guesses_map[(team_id, puzzle_id)] += aggregate['count']
-        wrong_guesses_by_team_map[team_id] += aggregate['count']
+@require_GET
+@require_admin
+def metrics(request):
+    return render(request, 'metrics.html', request_metrics.summary())
 
-    for aggregate in (
-        Hint.objects
-        .filter(status=Hint.ANSWERED, is_followup=False)
-        .values('team_id', 'puzzle_id')
-        .annotate(count=Count('*'))
-    ):
-        team_id = aggregate['team_id']
-        puzzle_id = aggregate['puzzle_id']
-        used_hints_map[(team_id, puzzle_id)] += aggregate['count']
-        used_hints_by_team_map[team_id] += aggregate['count']
-        used_hints_by_puzzle_map[puzzle_id] += aggregate['count']
+@require_GET
+def metrics_json(request):
+    # Monitors that can't log in can pass the token instead.
+    token = request.GET.get('token', '')
+    if not (settings.METRICS_TOKEN and constant_time_compare(token, settings.METRICS_TOKEN) or
+            request.context.is_superuser):
+        raise Http404
+    return JsonResponse(request_metrics.summary())
 
+def bigboard_generic(request, hide_hidden):
+    teams = Team.objects.all()
     if hide_hidden:
-        teams = Team.objects.filter(is_hidden=False)
-    else:
-        teams = Team.objects.all()
-
-    # Reproduce Team.leaderboard behavior for ignoring solves after hunt end,
-    # but not _teams_ created after hunt end. They'll just all be at the bottom.
-    leaderboard = sorted(teams, key=lambda team: (
-        during_hunt_solve_time_map[team.id].get(meta_meta_id, HUNT_END_TIME),
-        -len(during_hunt_solve_time_map[team.id]),
-        team.last_solve_time or team.creation_time,
-    ))
+        teams = teams.filter(is_hidden=False)
+    # Same order as the leaderboard, but including teams created after the
+    # hunt ended. They'll just all be at the bottom.
+    teams = teams.order_by(*Team.LEADERBOARD_ORDERING)
     limit = request.META.get('QUERY_STRING', '')
     limit = int(limit) if limit.isdigit() else 0
     if limit:
-        leaderboard = leaderboard[:limit]
-    unlocks = set(PuzzleUnlock.objects.values_list('team_id', 'puzzle_id'))
-    unlock_count_map = defaultdict(int)
-
-    def classes_of(team_id, puzzle_id):
-        unlocked = (team_id, puzzle_id) in unlocks
-        if unlocked:
-            unlock_count_map[puzzle_id] += 1
-        solve_time = solve_time_map[team_id].get(puzzle_id)
-        if puzzle_id in free_answer_map[team_id]:
-            yield 'F' # free answer
-        elif solve_time:
-            yield 'S' # solved
-        elif wrong_guesses_map.get((team_id, puzzle_id)):
-            yield 'W' # wrong
-        elif unlocked:
-            yield 'U' # unlocked
-        if used_hints_map.get((team_id, puzzle_id)):
-            yield 'H' # hinted
-        if solve_time and solve_time > HUNT_END_TIME:
-            yield 'P' # post-hunt solve
-        if solve_time and puzzle_id in puzzle_metas:
-            meta_time = solve_time_map[team_id].get(puzzle_metas[puzzle_id])
-            if meta_time and solve_time > meta_time - datetime.timedelta(minutes=5):
-                yield 'B' # backsolved
-
-    board = []
-    for team in leaderboard:
-        board.append({
-            'team': team,
-            'last_solve_time': max([team.creation_time, *solve_time_map[team.id].values()]),
-            'total_solves': len(solve_time_map[team.id]),
-            'free_solves': len(free_answer_map[team.id]),
-            'wrong_guesses': wrong_guesses_by_team_map[team.id],
-            'used_hints': used_hints_by_team_map[team.id],
-            'finished': solve_position_map.get((team.id, meta_meta_id)),
-            'meta_solves': meta_solves_map[team.id],
-            'entries': [{
-                'wrong_guesses': wrong_guesses_map[(team.id, puzzle.id)],
-                'solve_position': solve_position_map.get((team.id, puzzle.id)),
-                'hints': used_hints_map[(team.id, puzzle.id)],
-                'cls': ' '.join(classes_of(team.id, puzzle.id)),
-            } for puzzle in puzzles]
-        })
-
-    annotated_puzzles = [{
-        'puzzle': puzzle,
-        'solves': solve_count_map[puzzle.id],
-        'free_solves': free_answer_by_puzzle_map[puzzle.id],
-        'total_guesses': total_guess_map[puzzle.id],
-        'total_unlocks': unlock_count_map[puzzle.id],
-        'hints': used_hints_by_puzzle_map[puzzle.id],
-    } for puzzle in puzzles]
+        teams = teams[:limit]
+
+    puzzles, rows = bigboard_data(hide_hidden, teams)
+    team_url = reverse('team', args=['_'])[:-1]
+    board = [{
+        'name': team.team_name,
+        'url': team_url + quote(team.team_name, safe=''),
+        'num_hints_total': team.num_hints_total,
+        'last_solve_time': format_time(totals.pop('last_solve_time')),
+        **totals,
+        'cells': cells,
+    } for (team, totals, cells) in rows]
 
     return render(request, 'bigboard.html', {
         'board': board,
-        'puzzles': annotated_puzzles,
+        'puzzles': puzzles,
     })
 
 @require_GET
@@ -1422,49 +1318,100 @@ def biggraph(request):
         'teams': leaderboard
     })
 
+# Exports stream straight from the database, so they take constant memory no
+# matter how big the hunt was. Both take these optional query parameters:
+#   format=jsonl    one JSON object per line instead of CSV
+#   gzip=1          compress on the fly
+#   since=, until=  ISO datetimes bounding submitted_datetime
+#   puzzle=         a puzzle slug
+EXPORT_CHUNK_SIZE = 2000
+
+class _Echo:
+    def write(self, value):
+        return value
+
+def _export_time(value):
+    return None if value is None else value.strftime('%Y-%m-%d %H:%M:%S')
+
+def _export_bound(request, name):
+    value = request.GET.get(name)
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise Http404
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+def _stream_export(request, basename, queryset, fields, names, convert):
+    '''
+    Streams queryset as CSV or JSONL. convert turns a tuple of the given
+    fields into a row of values, and names are what JSONL calls them.
+    '''
+    since = _export_bound(request, 'since')
+    until = _export_bound(request, 'until')
+    if since:
+        queryset = queryset.filter(submitted_datetime__gte=since)
+    if until:
+        queryset = queryset.filter(submitted_datetime__lt=until)
+    if request.GET.get('puzzle'):
+        queryset = queryset.filter(puzzle__slug=request.GET['puzzle'])
+    rows = (convert(row) for row in queryset
+        .order_by('submitted_datetime')
+        .values_list(*fields)
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE))
+
+    if request.GET.get('format') == 'jsonl':
+        extension, content_type = 'jsonl', 'application/jsonl'
+        lines = (json.dumps(dict(zip(names, row))) + '\n' for row in rows)
+    else:
+        extension, content_type = 'csv', 'text/csv'
+        writer = csv.writer(_Echo())
+        lines = (writer.writerow(row) for row in rows)
+
+    compress = bool(request.GET.get('gzip'))
+    def chunks():
+        # Join lines into reasonably sized pieces rather than sending (and
+        # maybe compressing) each one separately.
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+        for batch in iter(lambda: ''.join(itertools.islice(lines, EXPORT_CHUNK_SIZE)), ''):
+            batch = batch.encode('utf-8')
+            yield compressor.compress(batch) if compressor else batch
+        if compressor:
+            yield compressor.flush()
+
+    fname = '{}_{}.{}'.format(basename, request.context.now.strftime('%Y%m%dT%H%M%S'), extension)
+    if compress:
+        content_type = 'application/gzip'
+        fname += '.gz'
+    response = StreamingHttpResponse(chunks(), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(fname)
+    return response
+
 @require_GET
 @require_after_hunt_end_or_admin
 def guess_csv(request):
-    response = HttpResponse(content_type='text/csv')
-    fname = 'gph_guesslog_{}.csv'.format(request.context.now.strftime('%Y%m%dT%H%M%S'))
-    response['Content-Disposition'] = 'attachment; filename="{}"'.format(fname)
-    writer = csv.writer(response)
-    for ans in (
-        AnswerSubmission.objects
-        .annotate(team_name=F('team__team_name'), puzzle_name=F('puzzle__name'))
-        .order_by('submitted_datetime')
-        .exclude(team__is_hidden=True)
-    ):
-        writer.writerow([
-            ans.submitted_datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            ans.team_name,
-            ans.puzzle_name,
-            ans.submitted_answer,
-            'F' if ans.used_free_answer else ('Y' if ans.is_correct else 'N')])
-    return response
+    return _stream_export(
+        request, 'gph_guesslog',
+        AnswerSubmission.objects.exclude(team__is_hidden=True),
+        ('submitted_datetime', 'team__team_name', 'puzzle__name', 'submitted_answer',
+            'used_free_answer', 'is_correct'),
+        ('submitted_datetime', 'team', 'puzzle', 'answer', 'result'),
+        lambda row: (
+            _export_time(row[0]), row[1], row[2], row[3],
+            'F' if row[4] else ('Y' if row[5] else 'N'),
+        ),
+    )
 
 @require_GET
 @require_admin
 def hint_csv(request):
-    response = HttpResponse(content_type='text/csv')
-    fname = 'gph_hintlog_{}.csv'.format(request.context.now.strftime('%Y%m%dT%H%M%S'))
-    response['Content-Disposition'] = 'attachment; filename="{}"'.format(fname)
-    writer = csv.writer(response)
-    for hint in (
-        Hint.objects
-        .annotate(team_name=F('team__team_name'), puzzle_name=F('puzzle__name'))
-        .order_by('submitted_datetime')
-        .exclude(team__is_hidden=True)
-    ):
-        writer.writerow([
-            hint.submitted_datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            None if hint.answered_datetime is None else (
-                hint.answered_datetime.strftime('%Y-%m-%d %H:%M:%S')
-            ),
-            hint.team_name,
-            hint.puzzle_name,
-            hint.response])
-    return response
+    return _stream_export(
+        request, 'gph_hintlog',
+        Hint.objects.exclude(team__is_hidden=True),
+        ('submitted_datetime', 'answered_datetime', 'team__team_name', 'puzzle__name', 'response'),
+        ('submitted_datetime', 'answered_datetime', 'team', 'puzzle', 'response'),
+        lambda row: (_export_time(row[0]), _export_time(row[1]), row[2], row[3], row[4]),
+    )
 
 @require_GET
 @require_admin